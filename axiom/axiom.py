@@ -6,15 +6,18 @@
 
 __version__ = "0.2.1"
 
-import argcomplete
 import argparse
 import logging
+import multiprocessing
+import os
 import sys
 
 from argh import ArghParser, completion, arg
 
-from .pmschedulevalidator import schedulevalidator
-from .pmeventparser import eventparser
+# Only the argument declarations. The modules of the commands, and cx_Oracle,
+# NumPy and the rest, are imported when a command runs, not for --help or
+# shell completion.
+from .commands import schedulevalidator, eventparser, snapshot, forecast, serve
 
 # These arguments are used by this global dispatcher and each individual
 # stand-alone commands.
@@ -25,32 +28,55 @@ COMMON_PARSER.add_argument('--debug',
                            help="Enable debug logging.")
 
 def schedulevalidator_entry():
-    parser = ArghParser(parents=[COMMON_PARSER])
-    parser.set_default_command(schedulevalidator)
-    completion.autocomplete(parser)
+    # Needed for --processes to work in the frozen Windows executable
+    multiprocessing.freeze_support()
 
-    # Parse ahead
-    args = parser.parse_args()
-    if args.debug:
-        logging.basicConfig(
-            level=logging.DEBUG,
-            format='%(asctime)s %(levelname)s: %(message)s'
-        )
-
-    parser.dispatch()
+    # The validator is the default command. Others are run by name as the
+    # first argument, e.g. ``axiom snapshot``. A PM Schedule ID that is the
+    # name of a command goes after ``--``.
+    argv = sys.argv[1:]
+    if "_ARGCOMPLETE" in os.environ:
+        # Shell completion passes the command line in the environment
+        argv = os.environ.get("COMP_LINE", "").split()[1:]
+    if argv and argv[0] in COMMANDS:
+        run_command(COMMANDS[argv[0]], argv[1:], prog="axiom " + argv[0])
+    else:
+        run_command(schedulevalidator, argv, epilog=commands_epilog())
 
 def eventparser_entry():
-    parser = ArghParser(parents=[COMMON_PARSER])
-    parser.set_default_command(eventparser)
+    run_command(eventparser, sys.argv[1:])
+
+def make_parser(command, prog=None, epilog=None):
+    parser = ArghParser(prog=prog, epilog=epilog, parents=[COMMON_PARSER])
+    parser.set_default_command(command)
+    return parser
+
+def run_command(command, argv, prog=None, epilog=None):
+    parser = make_parser(command, prog, epilog)
     completion.autocomplete(parser)
 
     # Parse ahead
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     if args.debug:
         logging.basicConfig(
             level=logging.DEBUG,
             format='%(asctime)s %(levelname)s: %(message)s'
         )
 
-    parser.dispatch()
+    parser.dispatch(argv=argv)
+
+# Commands of ``axiom`` other than the validator
+COMMANDS = {
+    'snapshot': snapshot,
+    'forecast': forecast,
+    'serve': serve,
+}
 
+def commands_epilog():
+    """
+    The other commands, for ``axiom --help``.
+    """
+    return ("Other commands: {}.\n"
+            "Run 'axiom <command> --help' for their options. The command must be the first argument.\n"
+            "A PM Schedule ID that is the name of a command goes last, after '--', e.g.\n"
+            "'axiom --from-snapshot prod.snapshot -- serve'.".format(", ".join(COMMANDS)))
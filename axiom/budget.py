@@ -0,0 +1,146 @@
+"""
+Time and occurrence budgets for validating a PM Schedule.
+
+Some recurrence rules make dateutil search for a long time before it finds
+the next date, or never find one. While a rule is expanded under a
+``Budget`` with a time limit, a trace function checks the deadline on every
+function call, so even a single long search is cut off.
+"""
+
+import contextlib
+import sys
+import threading
+import time
+
+_local = threading.local()
+
+class BudgetExceeded(Exception):
+    pass
+
+class Budget:
+    """
+    The budget of one PM Schedule. Only the time spent with it entered is
+    charged, so fetching the tasks and writing the rows don't count.
+
+    Use it as a context manager around the work of the PM Schedule, so that
+    ``current_budget`` returns it. It can be entered again, e.g. for each row
+    of a generator.
+    """
+
+    def __init__(self, seconds=None, max_occurrences=None):
+        self.seconds = seconds
+        self.max_occurrences = max_occurrences
+        self.used = 0.0
+        self.depth = 0
+        self.since = None
+        self.outers = []
+
+    def __enter__(self):
+        self.outers.append(getattr(_local, 'budget', None))
+        _local.budget = self
+        if self.depth == 0:
+            self.since = time.monotonic()
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0:
+            self.used += time.monotonic() - self.since
+        _local.budget = self.outers.pop()
+        return False
+
+    def elapsed(self):
+        """
+        The seconds charged so far.
+        """
+        if self.depth:
+            return self.used + time.monotonic() - self.since
+        return self.used
+
+    @contextlib.contextmanager
+    def paused(self):
+        """
+        A context manager that stops the time while it is entered.
+        """
+        if not self.depth:
+            yield
+            return
+        self.used += time.monotonic() - self.since
+        try:
+            yield
+        finally:
+            self.since = time.monotonic()
+
+    def exclude(self, items):
+        """
+        Yields ``items`` without charging the time spent getting each one,
+        e.g. rows fetched from the database.
+        """
+        items = iter(items)
+        while True:
+            with self.paused():
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+
+    def check(self):
+        if self.seconds and self.elapsed() > self.seconds:
+            raise BudgetExceeded("Took more than {} seconds.".format(self.seconds))
+
+    def check_occurrences(self, count):
+        if self.max_occurrences and count > self.max_occurrences:
+            raise BudgetExceeded("Needs more than {} occurrences.".format(self.max_occurrences))
+
+    def expanding(self, count):
+        """
+        A context manager around expanding a rule to ``count`` occurrences.
+        Raises ``BudgetExceeded`` if that is too many or the time runs out
+        while expanding.
+        """
+        self.check_occurrences(count)
+        self.check()
+        return Deadline(self) if self.seconds else _NO_DEADLINE
+
+def current_budget():
+    """
+    The ``Budget`` entered in this thread, or None.
+    """
+    return getattr(_local, 'budget', None)
+
+class Deadline:
+    """
+    Checks the deadline of a budget on every function call in this thread.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+
+    def __enter__(self):
+        seconds = self.budget.seconds
+        deadline = time.monotonic() + seconds - self.budget.elapsed()
+
+        def trace(frame, event, arg):
+            if time.monotonic() > deadline:
+                # Raising here also turns the trace off
+                raise BudgetExceeded("Took more than {} seconds.".format(seconds))
+            return None
+
+        self.previous = sys.gettrace()
+        sys.settrace(trace)
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.settrace(self.previous)
+        return False
+
+class _NoDeadline:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_DEADLINE = _NoDeadline()
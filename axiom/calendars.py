@@ -0,0 +1,219 @@
+"""
+Working calendars read from a calendar file.
+
+A calendar file is a JSON object of calendar names to definitions::
+
+    {
+        "Plant": {
+            "hours": {
+                "Monday": ["07:00-15:30"],
+                "Tuesday": ["07:00-15:30"],
+                "Saturday": ["08:00-12:00"]
+            },
+            "breaks": ["11:30-12:00"],
+            "holidays": ["2016-07-04", "2016-12-26"]
+        }
+    }
+
+``hours`` are the working hours of each weekday. Days that are not listed
+are not worked. ``breaks`` apply to every day and ``holidays`` are whole days
+off.
+
+Like the built-in 8to5 calendar, a time is working time if its hour and
+minute are within the working hours, the end included. A time that is not
+is moved to the start of the next working hours, keeping its seconds.
+"""
+
+import json
+import numpy
+
+from argh.exceptions import CommandError
+from datetime import date
+
+# The calendars that need no calendar file
+BUILTIN_CALENDARS = ('8to5', '24/7')
+
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+MINUTES_PER_DAY = 24 * 60
+US_PER_MINUTE = 60 * 1000000
+
+# Days from 0001-01-01 to 1970-01-01
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def get_working_calendar(name, calendar_file=None):
+    """
+    Returns the calendar called ``name`` from ``calendar_file`` or, if it is
+    not there, the name of the built-in calendar.
+    """
+    if calendar_file:
+        calendars = load_calendars(calendar_file)
+        if name in calendars:
+            return calendars[name]
+    else:
+        calendars = {}
+
+    if name.lower() in BUILTIN_CALENDARS:
+        return name
+
+    raise CommandError("Unknown working calendar '{}'. Choose one of: {}"
+                       .format(name, ", ".join(list(BUILTIN_CALENDARS) + sorted(calendars))))
+
+def load_calendars(calendar_file):
+    """
+    Read a calendar file. Returns a dict of names to ``WorkingCalendar``.
+    """
+    with open(calendar_file, encoding="utf-8") as f:
+        definitions = json.load(f)
+
+    return {name: WorkingCalendar(name, **definition) for name, definition in definitions.items()}
+
+def parse_time(value):
+    """
+    Convert ``HH:MM`` to minutes since midnight.
+    """
+    hour, minute = value.split(":")
+    minutes = int(hour) * 60 + int(minute)
+    if not 0 <= minutes < MINUTES_PER_DAY:
+        raise Exception("'{}' is not a valid time of day.".format(value))
+    return minutes
+
+def parse_range(value):
+    """
+    Convert ``HH:MM-HH:MM`` to a tuple of minutes since midnight.
+    """
+    start, end = (parse_time(part.strip()) for part in value.split("-"))
+    if end < start:
+        raise Exception("'{}' ends before it starts.".format(value))
+    return (start, end)
+
+def subtract_break(intervals, break_start, break_end):
+    """
+    Remove the minutes strictly between ``break_start`` and ``break_end`` from
+    a list of (start, end) intervals. The ends of a break are still working
+    time, like the ends of the working hours.
+    """
+    result = []
+    for start, end in intervals:
+        if start <= min(end, break_start):
+            result.append((start, min(end, break_start)))
+        if max(start, break_end) <= end:
+            result.append((max(start, break_end), end))
+    return sorted(set(result))
+
+class WorkingCalendar:
+    """
+    A working calendar. The working hours are compiled into sorted arrays of
+    the start and end of every working interval, in minutes since 1970-01-01,
+    so finding the next working time is a binary search.
+
+    The arrays cover whole years and grow when a date outside them is looked
+    up.
+    """
+
+    def __init__(self, name, hours, breaks=None, holidays=None):
+        self.name = name
+
+        unknown = set(hours) - set(WEEKDAYS)
+        if unknown:
+            raise Exception("Calendar '{}': unknown weekdays {}".format(name, sorted(unknown)))
+
+        breaks = [parse_range(value) for value in breaks or []]
+
+        # Working intervals of each weekday. Monday is 0.
+        self.hours = []
+        for weekday in WEEKDAYS:
+            intervals = sorted(parse_range(value) for value in hours.get(weekday, []))
+            for break_start, break_end in breaks:
+                intervals = subtract_break(intervals, break_start, break_end)
+            self.hours.append(intervals)
+
+        if not any(self.hours):
+            raise Exception("Calendar '{}' has no working hours.".format(name))
+
+        self.holidays = sorted(date(*map(int, value.split("-"))) for value in holidays or [])
+
+        # (first year, last year, starts, ends)
+        self.index = None
+
+    def __repr__(self):
+        # Used in the fingerprints of saved results. Must not depend on the index.
+        return "WorkingCalendar({!r}, {!r}, {!r})".format(self.name, self.hours, self.holidays)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['index'] = None
+        return state
+
+    def compile(self, first_year, last_year):
+        """
+        Build the interval arrays for the years ``first_year`` to ``last_year``.
+        """
+        holidays = set(day.toordinal() for day in self.holidays)
+
+        starts = []
+        ends = []
+        for ordinal in range(date(first_year, 1, 1).toordinal(), date(last_year, 12, 31).toordinal() + 1):
+            if ordinal in holidays:
+                continue
+            day = (ordinal - EPOCH_ORDINAL) * MINUTES_PER_DAY
+            for start, end in self.hours[date.fromordinal(ordinal).weekday()]:
+                starts.append(day + start)
+                ends.append(day + end)
+
+        return (first_year, last_year, numpy.array(starts, numpy.int64), numpy.array(ends, numpy.int64))
+
+    def get_index(self, first_year, last_year):
+        """
+        Returns an index that covers at least the given years.
+        """
+        index = self.index
+        if index is None or first_year < index[0] or last_year > index[1]:
+            if index is not None:
+                first_year = min(first_year, index[0])
+                last_year = max(last_year, index[1])
+            index = self.compile(first_year, last_year)
+            # Replaced whole, so other threads see either index
+            self.index = index
+        return index
+
+    def restrict_array(self, dates):
+        """
+        Move each date of a ``datetime64`` array that is not working time to
+        the start of the next working hours. Returns a ``datetime64[us]``
+        array.
+        """
+        us = dates.astype('datetime64[us]').astype(numpy.int64)
+        if len(us) == 0:
+            return us.astype('datetime64[us]')
+
+        minutes = us // US_PER_MINUTE
+        seconds = us - minutes * US_PER_MINUTE
+
+        years = dates.astype('datetime64[Y]').astype(numpy.int64) + 1970
+        first_year = int(years.min())
+        # The next working time may be in the following year
+        last_year = int(years.max()) + 1
+
+        while True:
+            first_year, last_year, starts, ends = self.get_index(first_year, last_year)
+
+            # The first interval that ends at or after each minute
+            i = numpy.searchsorted(ends, minutes, side='left')
+            if (i < len(ends)).all():
+                break
+
+            if last_year - int(years.max()) > 10:
+                raise Exception("Calendar '{}' has no working time after {}."
+                                .format(self.name, dates.max()))
+            last_year += 1
+
+        start = starts[i]
+        return numpy.where(start <= minutes, us, start * US_PER_MINUTE + seconds).astype('datetime64[us]')
+
+    def restrict(self, expected_date):
+        """
+        Same as ``restrict_array`` for one naive datetime.
+        """
+        result = self.restrict_array(numpy.array([expected_date], 'datetime64[us]'))
+        return result.astype(object)[0]
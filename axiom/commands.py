@@ -0,0 +1,252 @@
+"""
+The command line arguments of each command.
+
+They are declared here, apart from the commands, so that ``--help`` and shell
+completion can build the parser without importing cx_Oracle, NumPy, dateutil,
+pytz, xlsxwriter and tqdm. Each command imports its module when it runs.
+"""
+
+import argparse
+
+from argh import arg
+from datetime import datetime
+
+def parse_date(value):
+    """
+    Parse a ``YYYY-MM-DD`` or ``YYYY-MM-DD HH:MM`` command line date.
+    """
+    for date_format in ("%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M"):
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("'{}' is not a YYYY-MM-DD or YYYY-MM-DD HH:MM date.".format(value))
+
+@arg('pm_id', nargs='*', help="One or more PM Schedule IDs. Leave blank to show all PM Schedules.", default=None)
+@arg('--id-file', help="A file with more PM Schedule IDs, one on each line.", default=None)
+@arg('-d', '--db-url', help="Database connection string. USERNAME/PASSWORD@HOST:PORT:SID or USERNAME/PASSWORD@HOST:PORT/SERVICE_NAME", default="tridata/tridata@localhost:1521:xe")
+@arg('-z', '--timezone', help="The local timezone", default="US/Eastern")
+@arg('-u', '--site-url', help="The URL to TRIRIGA. It will be used to generate links to records.", default="http://localhost:9080")
+@arg('-f', '--outputfile', help="The output file name. Default: axiom.<report format>", default=None)
+@arg('-r', '--report-format', choices=['xlsx', 'csv', 'jsonl', 'parquet'], help="The format of the report. Other than xlsx, a second file with a summary of each PM Schedule is also written.", default="xlsx")
+@arg('-s', '--strip-time', help="Remove time component from dates before comparing.", default=False)
+@arg('-w', '--working-calendar', help="Choose a working calendar: 8to5, 24/7 or a calendar from --calendar-file", default="8to5")
+@arg('--calendar-file', help="A JSON file with more working calendars. See README.", default=None)
+@arg('--since', type=parse_date, help="Only validate the tasks planned to start on or after this date. YYYY-MM-DD [HH:MM] in --timezone.", default=None)
+@arg('--until', type=parse_date, help="Only validate the tasks planned to start before this date. YYYY-MM-DD [HH:MM] in --timezone.", default=None)
+@arg('--epoch-ms', help="Fetch the planned start dates as milliseconds and convert and compare them a batch at a time. Faster for PM Schedules with many tasks.", default=False)
+@arg('-a', '--align', help="Match tasks to occurrences by date instead of by position, and report duplicate, missing and unexpected tasks.", default=False)
+@arg('--summary-only', help="Only count the valid and invalid tasks of each PM Schedule. No worksheet is written for each PM Schedule. The Index gets the counts and the first invalid task.", default=False)
+@arg('--time-budget', type=float, help="Stop validating a PM Schedule after this many seconds. It is marked TIMEOUT on the Index.", default=None)
+@arg('--max-occurrences', type=int, help="Stop validating a PM Schedule whose recurrence rule has to be expanded to more than this many dates. It is marked TIMEOUT on the Index.", default=None)
+@arg('--top', type=int, help="Number of PM Schedules with the most invalid tasks to print with --summary-only.", default=10)
+@arg('-b', '--bulk-load', help="Prefetch events and tasks for many PM Schedules at once instead of querying each PM Schedule separately.", default=False)
+@arg('--chunk-size', type=int, help="Number of PM Schedules to prefetch at once when --bulk-load is used.", default=500)
+@arg('-j', '--workers', type=int, help="Number of PM Schedules to validate at the same time. Each worker uses its own database session.", default=1)
+@arg('-p', '--processes', type=int, help="Number of processes used to parse recurrence rules and compare dates. The database is only queried by this process.", default=1)
+@arg('--pipeline', help="Fetch, validate and write PM Schedules in stages that run at the same time, connected by bounded queues. The queue depths are logged to show the slowest stage.", default=False)
+@arg('--queue-size', type=int, help="Number of PM Schedules each --pipeline queue holds.", default=8)
+@arg('--arraysize', type=int, help="Number of rows to fetch from the database at a time.", default=500)
+@arg('-m', '--constant-memory', help="Write each worksheet to disk as soon as it is done instead of keeping the whole workbook in memory.", default=False)
+@arg('--state-file', help="Save the results to this file and reuse them for PM Schedules that have not changed since the last run.", default=None)
+@arg('--from-snapshot', help="Read the data from a snapshot file made with 'axiom snapshot' instead of the database.", default=None)
+@arg('--profile', help="Record how long each stage takes for each PM Schedule and save it to this file as a Chrome trace. A summary of each stage is printed and saved next to it.", default=None)
+@arg('--cprofile', help="Also profile the main thread with cProfile and save the stats to this file.", default=None)
+@arg('-v', '--verbosity', choices=range(0,3), help="Choose how much output to print to console", default=0)
+def schedulevalidator(
+        pm_id,
+        id_file=None,
+        db_url=None,
+        timezone=None,
+        site_url=None,
+        outputfile=None,
+        report_format=None,
+        strip_time=None,
+        working_calendar=None,
+        calendar_file=None,
+        since=None,
+        until=None,
+        epoch_ms=None,
+        align=None,
+        summary_only=None,
+        time_budget=None,
+        max_occurrences=None,
+        top=None,
+        bulk_load=None,
+        chunk_size=None,
+        workers=None,
+        processes=None,
+        pipeline=None,
+        queue_size=None,
+        arraysize=None,
+        constant_memory=None,
+        state_file=None,
+        from_snapshot=None,
+        profile=None,
+        cprofile=None,
+        verbosity=None
+    ):
+    """
+    Produces a report to verify PM Schedules in TRIRIGA.
+
+    Example:
+
+        axiom --db-url=tridata/tridata@localhost:1521:xe --site-url=http://localhost:9080 --timezone=US/Eastern
+
+    """
+    options = locals()
+    from .pmschedulevalidator import schedulevalidator
+    return schedulevalidator(**options)
+
+@arg('pm_id', nargs='?', help="PM Schedule ID. Leave blank to show all PM Schedules.", default=None)
+@arg('-d', '--db-url', help="Database TNS connection string.", default="tridata/tridata@localhost:1521:xe")
+@arg('-t', '--count', help="The default number of events to generate for schedules with no end date", default="50")
+@arg('-z', '--timezone', help="The local timezone", default="US/Eastern")
+@arg('-w', '--working-calendar', help="Choose a working calendar: 8to5, 24/7 or a calendar from --calendar-file", default="8to5")
+@arg('--calendar-file', help="A JSON file with more working calendars. See README.", default=None)
+@arg('--since', type=parse_date, help="Only show the occurrences on or after this date. YYYY-MM-DD [HH:MM]", default=None)
+@arg('--until', type=parse_date, help="Only show the occurrences before this date. YYYY-MM-DD [HH:MM]", default=None)
+@arg('--arraysize', type=int, help="Number of rows to fetch from the database at a time.", default=500)
+@arg('--from-snapshot', help="Read the data from a snapshot file made with 'axiom snapshot' instead of the database.", default=None)
+@arg('-e', '--export', help="Write the rules and occurrences to this file instead of printing them. See README.", default=None)
+@arg('--export-format', choices=('ics', 'jsonl'), help="Format of --export. By default, the extension of the file.", default=None)
+@arg('--chunk-size', type=int, help="With --export, number of events to read the include and exclude dates of at once.", default=500)
+@arg('-v', '--verbosity', choices=range(0,3), help="Choose how much output to print to console", default=0)
+def eventparser(
+        pm_id,
+        db_url=None,
+        count=None,
+        timezone=None,
+        working_calendar=None,
+        calendar_file=None,
+        since=None,
+        until=None,
+        arraysize=None,
+        from_snapshot=None,
+        export=None,
+        export_format=None,
+        chunk_size=None,
+        verbosity=None
+    ):
+    """
+    Reads a PM Schedule recurrence rule from TRIRIGA database.
+    """
+    options = locals()
+    from .pmeventparser import eventparser
+    return eventparser(**options)
+
+@arg('pm_id', nargs='*', help="One or more PM Schedule IDs. Leave blank to save all PM Schedules.", default=None)
+@arg('--id-file', help="A file with more PM Schedule IDs, one on each line.", default=None)
+@arg('-d', '--db-url', help="Database connection string. USERNAME/PASSWORD@HOST:PORT:SID or USERNAME/PASSWORD@HOST:PORT/SERVICE_NAME", default="tridata/tridata@localhost:1521:xe")
+@arg('-f', '--outputfile', help="The snapshot file name.", default="axiom.snapshot")
+@arg('--chunk-size', type=int, help="Number of PM Schedules to query at once.", default=500)
+@arg('--arraysize', type=int, help="Number of rows to fetch from the database at a time.", default=500)
+@arg('-v', '--verbosity', choices=range(0,3), help="Choose how much output to print to console", default=0)
+def snapshot(
+        pm_id,
+        id_file=None,
+        db_url=None,
+        outputfile=None,
+        chunk_size=None,
+        arraysize=None,
+        verbosity=None
+    ):
+    """
+    Saves the PM Schedules, events and tasks to a local file. Use it with the
+    --from-snapshot option to validate PM Schedules without the database.
+
+    Example:
+
+        axiom snapshot --db-url=tridata/tridata@localhost:1521:xe --outputfile=axiom.snapshot
+
+    """
+    options = locals()
+    from .pmsnapshot import snapshot
+    return snapshot(**options)
+
+@arg('pm_id', nargs='*', help="One or more PM Schedule IDs. Leave blank to forecast all PM Schedules.", default=None)
+@arg('--id-file', help="A file with more PM Schedule IDs, one on each line.", default=None)
+@arg('-d', '--db-url', help="Database connection string. USERNAME/PASSWORD@HOST:PORT:SID or USERNAME/PASSWORD@HOST:PORT/SERVICE_NAME", default="tridata/tridata@localhost:1521:xe")
+@arg('--from-snapshot', help="Read the data from a snapshot file made with 'axiom snapshot' instead of the database.", default=None)
+@arg('-f', '--outputfile', help="The forecast file. A .xlsx file gets a heatmap worksheet, a .csv file a table.", default="forecast.xlsx")
+@arg('-z', '--timezone', help="The local timezone", default="US/Eastern")
+@arg('-w', '--working-calendar', help="Choose a working calendar: 8to5, 24/7 or a calendar from --calendar-file", default="8to5")
+@arg('--calendar-file', help="A JSON file with more working calendars. See README.", default=None)
+@arg('--since', type=parse_date, help="Start of the forecast. YYYY-MM-DD [HH:MM]. By default, today.", default=None)
+@arg('--until', type=parse_date, help="End of the forecast. YYYY-MM-DD [HH:MM]. By default, --years after --since.", default=None)
+@arg('--years', type=float, help="Length of the forecast in years.", default=1)
+@arg('-b', '--bin', choices=['day', 'week'], help="Count the tasks of each day or week.", default='week')
+@arg('-t', '--count', type=int, help="The number of occurrences of rules with no end date, from their start date.", default=100000)
+@arg('--chunk-size', type=int, help="Number of PM Schedules to query and count at once.", default=500)
+@arg('-p', '--processes', type=int, help="Number of processes to expand the rules in.", default=1)
+@arg('--arraysize', type=int, help="Number of rows to fetch from the database at a time.", default=500)
+@arg('-v', '--verbosity', choices=range(0,3), help="Choose how much output to print to console", default=0)
+def forecast(
+        pm_id,
+        id_file=None,
+        db_url=None,
+        from_snapshot=None,
+        outputfile=None,
+        timezone=None,
+        working_calendar=None,
+        calendar_file=None,
+        since=None,
+        until=None,
+        years=None,
+        bin=None,
+        count=None,
+        chunk_size=None,
+        processes=None,
+        arraysize=None,
+        verbosity=None
+    ):
+    """
+    Forecasts the number of PM tasks on each day or week for each building.
+    Grouped PM Schedules count the tasks created for each occurrence.
+
+    Example:
+
+        axiom forecast --db-url=tridata/tridata@localhost:1521:xe --years 5 --outputfile=forecast.xlsx
+
+    """
+    options = locals()
+    from .pmforecast import forecast
+    return forecast(**options)
+
+@arg('-d', '--db-url', help="Database connection string. USERNAME/PASSWORD@HOST:PORT:SID or USERNAME/PASSWORD@HOST:PORT/SERVICE_NAME", default="tridata/tridata@localhost:1521:xe")
+@arg('--from-snapshot', help="Read the data from a snapshot file made with 'axiom snapshot' instead of the database.", default=None)
+@arg('--host', help="The address to listen on.", default="127.0.0.1")
+@arg('--port', type=int, help="The port to listen on.", default=8642)
+@arg('--socket', help="Listen on this Unix socket instead of --host and --port.", default=None)
+@arg('-j', '--workers', type=int, help="Number of database sessions in the pool. Requests beyond this wait for a session.", default=4)
+@arg('-z', '--timezone', help="The local timezone", default="US/Eastern")
+@arg('-w', '--working-calendar', help="Choose a working calendar: 8to5, 24/7 or a calendar from --calendar-file", default="8to5")
+@arg('--calendar-file', help="A JSON file with more working calendars. See README.", default=None)
+@arg('--time-budget', type=float, help="Stop a request after this many seconds.", default=30)
+@arg('--arraysize', type=int, help="Number of rows to fetch from the database at a time.", default=500)
+def serve(
+        db_url=None,
+        from_snapshot=None,
+        host=None,
+        port=None,
+        socket=None,
+        workers=None,
+        timezone=None,
+        working_calendar=None,
+        calendar_file=None,
+        time_budget=None,
+        arraysize=None
+    ):
+    """
+    Serves PM Schedule validations and recurrence expansions as JSON until
+    interrupted.
+
+    Example:
+
+        axiom serve --db-url=tridata/tridata@localhost:1521:xe --port 8642
+
+        curl http://localhost:8642/validate/PM-100231?since=2024-01-01
+    """
+    options = locals()
+    from .pmserve import serve
+    return serve(**options)
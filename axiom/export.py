@@ -0,0 +1,353 @@
+"""
+Export the recurrence rules and occurrences of PM Schedules for other
+scheduling tools.
+
+``ics``
+    An iCalendar file with one VEVENT for each event. The rule is written as
+    DTSTART and RRULE with the include dates as RDATE. The dates removed by
+    exclusions and skipped months are listed as EXDATE, up to ``--until``.
+    The dates are local times with the timezone name as TZID, defined by a
+    VTIMEZONE with the UTC offsets of the timezone since 1970. Events
+    without any date are left out.
+
+``jsonl``
+    JSON Lines with one object for each event: the same rule, the
+    occurrences and the dates they move to in the working calendar, with
+    their UTC offsets.
+
+The files are written through a large buffer as each event is read.
+"""
+
+import bisect
+import itertools
+import json
+import logging
+import numpy
+import os
+import pytz
+
+from argh.exceptions import CommandError
+from datetime import datetime
+from dateutil.rrule import rruleset
+
+from .pmeventparser import parse_event, restrict_to_working_calendar_array, to_datetime64, to_datetimes
+from .timezones import get_transition_table
+
+# Bytes buffered before writing to the file
+BUFFER_SIZE = 1024 * 1024
+
+ICS_DATE_FORMAT = "%Y%m%dT%H%M%S"
+
+# The VTIMEZONE starts with the UTC offset at this time
+VTIMEZONE_START = datetime(1970, 1, 1)
+
+def expand_event(rules, working_calendar, until=None):
+    """
+    The occurrences of ``rules`` before ``until`` and the same dates moved
+    into the working calendar, as a list and a ``datetime64[us]`` array.
+    """
+    dates = list(itertools.takewhile(lambda date: until is None or date < until, rules))
+    return dates, restrict_to_working_calendar_array(dates, working_calendar)
+
+def recurrence_definition(rules, dates, until=None):
+    """
+    The iCalendar parts of a rule from ``parse_event``: a dict with the
+    ``dtstart``, the ``rrules`` (RRULE values), the ``rdates`` and the
+    ``exdates``.
+
+    ``dates`` are the occurrences of the rule before ``until`` from
+    ``expand_event``. The exclusions are turned into EXDATEs by comparing
+    them with the dates of the rule without its exclusions, so only the
+    EXDATEs before ``until`` are found.
+    """
+    if not isinstance(rules, rruleset):
+        arules, rdates, exclusions = [rules], [], False
+    else:
+        arules, rdates = rules._rrule, sorted(rules._rdate)
+        exclusions = bool(rules._exrule or rules._exdate)
+
+    rrules = [rrule_value(arule) for arule in arules]
+
+    if arules:
+        dtstart = arules[0]._dtstart
+    elif rdates:
+        # A VEVENT always has its DTSTART as an occurrence
+        dtstart, rdates = rdates[0], rdates[1:]
+    else:
+        dtstart = None
+
+    exdates = set()
+    if exclusions:
+        unexcluded = rruleset()
+        for arule in arules:
+            unexcluded.rrule(arule)
+        for rdate in rdates:
+            unexcluded.rdate(rdate)
+        exdates = set(itertools.takewhile(lambda date: until is None or date < until, unexcluded)) - set(dates)
+
+    # In iCalendar DTSTART is an occurrence even if the RRULE does not
+    # match it. In dateutil it is not.
+    if arules and dtstart not in dates and (until is None or dtstart < until):
+        exdates.add(dtstart)
+
+    return {'dtstart': dtstart, 'rrules': rrules, 'rdates': rdates, 'exdates': sorted(exdates)}
+
+def rrule_value(arule):
+    """
+    The RRULE value of a dateutil rule. UNTIL is a naive local time, like
+    the other dates of the rule. See ``utc_until``.
+    """
+    for line in str(arule).splitlines():
+        if line.startswith("RRULE:"):
+            return line[len("RRULE:"):]
+    return None
+
+def utc_until(value, local_tz):
+    """
+    Replace a naive local UNTIL in an RRULE value with the UTC time.
+    """
+    parts = []
+    for part in value.split(";"):
+        if part.startswith("UNTIL=") and not part.endswith("Z"):
+            until = datetime.strptime(part[len("UNTIL="):], ICS_DATE_FORMAT)
+            until = local_tz.localize(until).astimezone(pytz.utc)
+            part = "UNTIL=" + until.strftime(ICS_DATE_FORMAT) + "Z"
+        parts.append(part)
+    return ";".join(parts)
+
+def ics_offset(offset):
+    """
+    Format a UTC offset as in TZOFFSETFROM and TZOFFSETTO.
+    """
+    seconds = int(offset.total_seconds())
+    hours, rest = divmod(abs(seconds), 3600)
+    text = "{}{:02d}{:02d}".format("-" if seconds < 0 else "+", hours, rest // 60)
+    return text + "{:02d}".format(rest % 60) if rest % 60 else text
+
+def vtimezone(timezone, start=VTIMEZONE_START):
+    """
+    The lines of a VTIMEZONE for a pytz timezone, from the UTC offset at
+    ``start`` on. Each offset is an observance with its onsets as RDATE.
+    """
+    tz = pytz.timezone(timezone)
+    if hasattr(tz, '_utc_transition_times'):
+        transitions = list(zip(tz._utc_transition_times, tz._transition_info))
+    else:
+        # Same offset at all times, e.g. UTC
+        transitions = [(start, (tz.utcoffset(start), tz.dst(start), tz.tzname(start)))]
+
+    # The onsets of each observance, keyed by whether it is daylight time,
+    # its name and the offsets before and after. The first one is the
+    # offset at ``start``.
+    first = max(bisect.bisect_right([time for time, info in transitions], start) - 1, 0)
+    observances = {}
+    for i, (time, (utcoffset, dst, name)) in enumerate(transitions[first:], first):
+        offset_from = transitions[i - 1][1][0] if i > first else utcoffset
+        # DTSTART and RDATE are the local time before the onset
+        onset = max(time, start) + offset_from
+        observances.setdefault((bool(dst), name, offset_from, utcoffset), []).append(onset)
+
+    lines = ["BEGIN:VTIMEZONE", "TZID:" + timezone]
+    for (dst, name, offset_from, offset_to), onsets in observances.items():
+        component = "DAYLIGHT" if dst else "STANDARD"
+        lines.append("BEGIN:" + component)
+        lines.append("DTSTART:" + onsets[0].strftime(ICS_DATE_FORMAT))
+        if len(onsets) > 1:
+            lines.append("RDATE:" + ",".join(onset.strftime(ICS_DATE_FORMAT) for onset in onsets[1:]))
+        lines.append("TZOFFSETFROM:" + ics_offset(offset_from))
+        lines.append("TZOFFSETTO:" + ics_offset(offset_to))
+        lines.append("TZNAME:" + ics_text(name))
+        lines.append("END:" + component)
+    lines.append("END:VTIMEZONE")
+    return lines
+
+def iso_dates(dates, timezone):
+    """
+    Format a ``datetime64`` array of naive local dates as ISO 8601 strings
+    with their UTC offset. The offsets are found for the whole array at once.
+    """
+    local = dates.astype('datetime64[us]').astype(numpy.int64)
+    utc, period = get_transition_table(timezone).localize(local)
+    minutes = ((local - utc) // 60000000).tolist()
+
+    return ["{}{}{:02d}:{:02d}".format(date.isoformat(), "-" if offset < 0 else "+", *divmod(abs(offset), 60))
+            for date, offset in zip(to_datetimes(dates), minutes)]
+
+def ics_text(value):
+    """
+    Escape a TEXT value.
+    """
+    return (str(value).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+def fold(line):
+    """
+    Fold a content line into lines of at most 75 octets.
+    """
+    if len(line.encode("utf-8")) <= 75:
+        return line
+
+    parts = []
+    start = 0
+    size = 0
+    for i, char in enumerate(line):
+        length = len(char.encode("utf-8"))
+        if size + length > 75:
+            parts.append(line[start:i])
+            start = i
+            # The space that starts the next line
+            size = 1
+        size += length
+    parts.append(line[start:])
+    return "\r\n ".join(parts)
+
+class Export:
+    """
+    Base class of the export formats.
+
+    Call ``add_event`` with each event, its rule and description from
+    ``parse_event``, its occurrences from ``expand_event`` and the working
+    calendar dates that are in the window, then ``close``.
+    """
+
+    newline = "\n"
+
+    def __init__(self, outputfile, timezone, until=None):
+        self.timezone = timezone
+        self.until = until
+        self.local_tz = pytz.timezone(timezone)
+        self.file = open(outputfile, "w", encoding="utf-8", newline="", buffering=BUFFER_SIZE)
+
+    def write(self, line):
+        self.file.write(line + self.newline)
+
+    def add_event(self, event, rules, description, dates, window):
+        """
+        Write an event. Returns False if it was left out.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        self.file.close()
+
+class IcsExport(Export):
+
+    newline = "\r\n"
+
+    def __init__(self, outputfile, timezone, until=None):
+        super().__init__(outputfile, timezone, until)
+        self.dtstamp = datetime.utcnow().strftime(ICS_DATE_FORMAT) + "Z"
+        self.write("BEGIN:VCALENDAR")
+        self.write("VERSION:2.0")
+        self.write("PRODID:-//axiom//PM Schedules//EN")
+        self.write("CALSCALE:GREGORIAN")
+        for line in vtimezone(timezone):
+            self.write(fold(line))
+
+    def add_event(self, event, rules, description, dates, window):
+        definition = recurrence_definition(rules, dates, self.until)
+        if definition['dtstart'] is None:
+            # A VEVENT needs a DTSTART
+            return False
+
+        tzid = ";TZID=" + self.timezone
+
+        self.write("BEGIN:VEVENT")
+        self.write("UID:{}-{}@axiom".format(event['PM_ID'], event['EVENT_SPEC_ID']))
+        self.write("DTSTAMP:" + self.dtstamp)
+        self.write(fold("DTSTART{}:{}".format(tzid, definition['dtstart'].strftime(ICS_DATE_FORMAT))))
+        self.write(fold("SUMMARY:" + ics_text("{}: {}".format(event['PM_ID'], event['PM_NAME']))))
+        if description:
+            self.write(fold("DESCRIPTION:" + ics_text(description)))
+        for value in definition['rrules']:
+            self.write(fold("RRULE:" + utc_until(value, self.local_tz)))
+        for name, values in (("RDATE", definition['rdates']), ("EXDATE", definition['exdates'])):
+            if values:
+                self.write(fold("{}{}:{}".format(name, tzid, ",".join(date.strftime(ICS_DATE_FORMAT)
+                                                                      for date in values))))
+        self.write("END:VEVENT")
+        return True
+
+    def close(self):
+        self.write("END:VCALENDAR")
+        super().close()
+
+class JsonLinesExport(Export):
+
+    def add_event(self, event, rules, description, dates, window):
+        definition = recurrence_definition(rules, dates, self.until)
+        expected, working = window
+
+        occurrences = [{'date': date, 'working_date': working_date}
+                       for date, working_date in zip(iso_dates(expected, self.timezone),
+                                                     iso_dates(working, self.timezone))]
+
+        self.write(json.dumps({
+            'pm_id': event['PM_ID'],
+            'pm_name': event['PM_NAME'],
+            'event_spec_id': event['EVENT_SPEC_ID'],
+            'description': description,
+            'timezone': self.timezone,
+            'dtstart': definition['dtstart'],
+            'rrule': definition['rrules'],
+            'rdate': definition['rdates'],
+            'exdate': definition['exdates'],
+            'occurrences': occurrences,
+        }, default=lambda value: value.isoformat()))
+        return True
+
+EXPORTS = {
+    'ics': IcsExport,
+    'jsonl': JsonLinesExport,
+}
+
+def export_format_of(outputfile, export_format=None):
+    """
+    The format given, or the one of the file extension.
+    """
+    export_format = export_format or os.path.splitext(outputfile)[1].lstrip(".").lower()
+    if export_format not in EXPORTS:
+        raise CommandError("Unknown export format '{}'. Use --export-format with one of: {}".format(
+            export_format, ", ".join(EXPORTS)))
+    return export_format
+
+def export_events(events, outputfile, export_format, timezone, working_calendar, since=None, until=None,
+                  default_count=50):
+    """
+    Write each event of ``events`` to ``outputfile`` as it is read. Events
+    that can't be parsed are logged and left out, like the events that the
+    format can't write, e.g. without any date in iCalendar.
+
+    Returns the number of events written and the number left out.
+    """
+    export = EXPORTS[export_format_of(outputfile, export_format)](outputfile, timezone, until)
+
+    written = left_out = 0
+    try:
+        for event in events:
+            try:
+                rules, description = parse_event(event, default_count=default_count, verbosity=0)
+                dates, working = expand_event(rules, working_calendar, until)
+
+                # The occurrences whose working calendar date is in the window
+                keep = numpy.ones(len(dates), bool)
+                if since:
+                    keep &= working >= numpy.datetime64(since, 'us')
+                if until:
+                    keep &= working < numpy.datetime64(until, 'us')
+                window = (to_datetime64(dates)[keep], working[keep])
+
+                if export.add_event(event, rules, description, dates, window):
+                    written += 1
+                else:
+                    logging.warning("The event of PM Schedule '{}' has no dates. It is left out."
+                                    .format(event['PM_ID']))
+                    left_out += 1
+            except Exception:
+                logging.exception("Unable to export the event of PM Schedule '{}'. Ignore and continue."
+                                  .format(event['PM_ID']))
+                left_out += 1
+    finally:
+        export.close()
+
+    return written, left_out
@@ -4,40 +4,188 @@ import cx_Oracle
 import re
 import logging
 
+from contextlib import contextmanager
+from .profiler import span, query_span
+
 VERBOSE=0
 
+# Number of rows fetched from the database in each round trip by
+# ``iter_execute``.
+ARRAYSIZE=500
+
+# The settings are set once by a command, before any worker thread starts.
+
 def set_verbosity(verbosity):
     global VERBOSE
     VERBOSE = verbosity
 
+def set_arraysize(arraysize):
+    global ARRAYSIZE
+    ARRAYSIZE = arraysize
+
 def get_connection(tns_name, uname, upass):
     connection = cx_Oracle.connect(uname, upass, tns_name)
     connection.autocommit = True
     return connection
 
-def rows_to_dict_list(cursor):
+def get_pool(tns_name, uname, upass, size):
+    """
+    Creates a session pool of up to ``size`` connections that can be shared
+    between threads. Use ``pooled_connection`` to borrow a connection. When
+    all of them are in use, borrowing waits for one to be returned.
+    """
+    return cx_Oracle.SessionPool(uname, upass, tns_name,
+                                 min=1, max=size, increment=1,
+                                 threaded=True, getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT)
+
+@contextmanager
+def pooled_connection(pool):
+    """
+    Borrow a connection from a session pool and return it when done.
+    """
+    connection = pool.acquire()
+    connection.autocommit = True
+    try:
+        yield connection
+    finally:
+        pool.release(connection)
+
+def dict_row(columns):
+    """
+    The default row ``factory``: each row is a dict of column name to value.
+    """
+    return lambda row: dict(zip(columns, row))
+
+def rows_to_dict_list(cursor, factory=dict_row):
     columns = [i[0] for i in cursor.description]
-    return [dict(zip(columns, row)) for row in cursor]
+    make_row = factory(columns)
+    with span('fetch') as fetch_span:
+        rows = [make_row(row) for row in cursor]
+        fetch_span.set(rows=len(rows))
+    return rows
 
-def execute(sql_statement, connection, parameters=None):
+def iter_rows(cursor, arraysize, factory=dict_row):
     """
-    Executes a SQL statement and returns all results.
+    Yields the rows of an executed cursor, made by ``factory``, fetching
+    ``arraysize`` rows at a time.
     """
+    columns = [i[0] for i in cursor.description]
+    make_row = factory(columns)
+    while True:
+        with span('fetch') as fetch_span:
+            rows = cursor.fetchmany(arraysize)
+            fetch_span.set(rows=len(rows))
+        if not rows:
+            break
+        for row in rows:
+            yield make_row(row)
+
+def _execute(sql_statement, connection, parameters, cursor):
+    verbose = VERBOSE
 
-    cursor = connection.cursor()
-    if VERBOSE >= 2:
+    if cursor is None:
+        cursor = connection.cursor()
+
+    if verbose >= 2:
         logging.debug("Execute SQL: " + sql_statement)
 
-    if parameters:
-        cursor.execute(sql_statement, parameters)
-        if VERBOSE >= 2:
-            logging.debug("Parameters: " + str(parameters))
-    else:
-        cursor.execute(sql_statement)
+    with query_span(sql_statement):
+        if parameters:
+            cursor.execute(sql_statement, parameters)
+        else:
+            cursor.execute(sql_statement)
 
-    result = rows_to_dict_list(cursor)
+    if parameters and verbose >= 2:
+        logging.debug("Parameters: " + str(parameters))
+
+    return cursor
+
+def execute(sql_statement, connection, parameters=None, cursor=None, factory=dict_row):
+    """
+    Executes a SQL statement and returns all results.
+
+    Pass in a ``cursor`` to reuse it instead of opening a new one. The rows
+    are dicts, or made by ``factory``: a function that takes the column names
+    and returns a function that makes a row from the tuple of its values.
+    """
+
+    cursor = _execute(sql_statement, connection, parameters, cursor)
+
+    result = rows_to_dict_list(cursor, factory)
     return result
 
+def iter_execute(sql_statement, connection, parameters=None, cursor=None, arraysize=None, factory=dict_row):
+    """
+    Executes a SQL statement and yields the results one row at a time.
+
+    Rows are fetched ``arraysize`` (default: ``ARRAYSIZE``) at a time, so
+    only that many rows are held in memory. The statement is run when the
+    first row is requested. Pass in a ``cursor`` to reuse it. It must not be
+    used for anything else until all the rows are read. See ``execute`` for
+    ``factory``.
+    """
+
+    if arraysize is None:
+        arraysize = ARRAYSIZE
+
+    if cursor is None:
+        cursor = connection.cursor()
+
+    cursor.arraysize = arraysize
+    if hasattr(cursor, 'prefetchrows'):
+        # cx_Oracle 8+ can return the first batch with the execute call
+        cursor.prefetchrows = arraysize + 1
+
+    cursor = _execute(sql_statement, connection, parameters, cursor)
+
+    for row in iter_rows(cursor, arraysize, factory):
+        yield row
+
+def bind_list(values, prefix="id"):
+    """
+    Builds an ``IN (...)`` list of bind variables for the given values.
+
+    Returns the bind variable list as a string (``:id0, :id1, ...``) and a
+    dict of parameters to pass to ``execute``.
+    """
+    names = ["{}{}".format(prefix, i) for i in range(len(values))]
+    return ", ".join(":" + name for name in names), dict(zip(names, values))
+
+# The number of bind variables in the IN lists of ``bind_chunks``. A list is
+# padded with NULLs up to the next size, so only a few distinct statements are
+# ever parsed and they stay in the statement cache. Oracle allows at most 1000
+# items in an IN list.
+BIND_SLOTS = (10, 100, 1000)
+
+def bind_chunks(values, prefix="id", slots=BIND_SLOTS):
+    """
+    Split ``values`` into IN lists of at most ``slots[-1]`` bind variables,
+    each padded with None to the next size in ``slots``. NULL matches nothing
+    in an IN list.
+
+    Yields the bind variable list and the parameters of each chunk, like
+    ``bind_list``.
+    """
+    size = slots[-1]
+    for start in range(0, len(values), size):
+        chunk = list(values[start:start + size])
+        slot_count = next(count for count in slots if count >= len(chunk))
+        yield bind_list(chunk + [None] * (slot_count - len(chunk)), prefix)
+
+def execute_in(sql_statement, connection, values, parameters=None, cursor=None, factory=dict_row):
+    """
+    Run ``sql_statement``, whose ``{}`` is replaced with an IN list of bind
+    variables, for all of ``values`` a chunk at a time (see ``bind_chunks``).
+    ``parameters`` are added to the parameters of every chunk.
+
+    Returns the rows of all the chunks.
+    """
+    rows = []
+    for binds, chunk_parameters in bind_chunks(values):
+        chunk_parameters.update(parameters or {})
+        rows.extend(execute(sql_statement.format(binds), connection, chunk_parameters, cursor, factory))
+    return rows
+
 class JdbcConnection:
     def __init__(self, **kwds):
         self.__dict__.update(kwds)
@@ -57,6 +205,9 @@ class JdbcConnection:
     def get_connection(self):
         return get_connection(self.get_tns(), self.username, self.password)
 
+    def get_pool(self, size):
+        return get_pool(self.get_tns(), self.username, self.password, size)
+
 def parse_db_url(url):
     """
     Parses a JDBC Connection URL.
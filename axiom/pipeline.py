@@ -0,0 +1,143 @@
+"""
+Run the validation as a pipeline of stages that work at the same time::
+
+    fetch --[fetched queue]--> compute --[computed queue]--> write
+
+The fetch stage runs the queries in threads. The compute stage hands each
+item to an executor (threads or processes) and the write stage takes the
+results in their original order. The queues are bounded, so a slow stage
+makes the stages before it wait instead of piling up rows in memory.
+
+The depth of each queue is sampled while the pipeline runs. A queue that is
+usually full means the stage after it is the bottleneck. A queue that is
+usually empty means the stage before it is.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import time
+
+# Put in a queue after the last item
+_DONE = object()
+
+# Seconds between samples of the queue depths
+SAMPLE_INTERVAL = 0.05
+
+class QueueDepths:
+    """
+    Samples of the depth of a queue.
+    """
+
+    def __init__(self, name, queue):
+        self.name = name
+        self.queue = queue
+        self.samples = 0
+        self.total = 0
+        self.full = 0
+        self.peak = 0
+
+    def sample(self):
+        depth = self.queue.qsize()
+        self.samples += 1
+        self.total += depth
+        self.peak = max(self.peak, depth)
+        if self.queue.full():
+            self.full += 1
+
+    def __str__(self):
+        samples = max(self.samples, 1)
+        return "{} {:.1f}/{} (peak {}, full {:.0%})".format(
+            self.name, self.total / samples, self.queue.maxsize, self.peak, self.full / samples)
+
+def run_pipeline(batches, fetch, compute, write, fetch_executor, queue_size=8, report_interval=10):
+    """
+    Pass every item of ``batches`` through the stages:
+
+    ``fetch(batch)`` runs in ``fetch_executor`` and returns a list with a
+    value for each item of the batch.
+
+    ``compute(item, value)`` is called in this thread and returns the result,
+    or a ``concurrent.futures.Future`` of it.
+
+    ``write(item, result)`` is called in this thread, in the order of the
+    items. The result is None if fetching or computing it failed.
+
+    The queue depths are logged every ``report_interval`` seconds and at the
+    end. Returns the ``QueueDepths`` of each queue.
+    """
+    return asyncio.run(_run_pipeline(batches, fetch, compute, write, fetch_executor, queue_size, report_interval))
+
+async def _run_pipeline(batches, fetch, compute, write, fetch_executor, queue_size, report_interval):
+    loop = asyncio.get_running_loop()
+
+    # (item, future of its batch, index in the batch)
+    fetched = asyncio.Queue(queue_size)
+    # (item, future of its result)
+    computed = asyncio.Queue(queue_size)
+
+    depths = [QueueDepths("fetched", fetched), QueueDepths("computed", computed)]
+    done = asyncio.Event()
+
+    async def fetch_stage():
+        for batch in batches:
+            future = loop.run_in_executor(fetch_executor, fetch, batch)
+            for i, item in enumerate(batch):
+                await fetched.put((item, future, i))
+        await fetched.put(_DONE)
+
+    async def compute_stage():
+        while True:
+            entry = await fetched.get()
+            if entry is _DONE:
+                break
+
+            item, future, i = entry
+            result = loop.create_future()
+            try:
+                value = compute(item, (await future)[i])
+                if isinstance(value, concurrent.futures.Future):
+                    result = asyncio.wrap_future(value)
+                else:
+                    result.set_result(value)
+            except Exception as e:
+                result.set_exception(e)
+
+            await computed.put((item, result))
+        await computed.put(_DONE)
+
+    async def write_stage():
+        while True:
+            entry = await computed.get()
+            if entry is _DONE:
+                break
+
+            item, future = entry
+            try:
+                result = await future
+            except Exception as e:
+                logging.exception("Unable to validate a PM. Ignore and continue.")
+                result = None
+
+            write(item, result)
+        done.set()
+
+    async def monitor():
+        last_report = time.monotonic()
+        while not done.is_set():
+            for queue in depths:
+                queue.sample()
+
+            if time.monotonic() - last_report >= report_interval:
+                logging.info("Queue depths: " + ", ".join(str(queue) for queue in depths))
+                last_report = time.monotonic()
+
+            try:
+                await asyncio.wait_for(done.wait(), SAMPLE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    await asyncio.gather(fetch_stage(), compute_stage(), write_stage(), monitor())
+
+    logging.info("Queue depths (mean/size): " + ", ".join(str(queue) for queue in depths))
+    return depths
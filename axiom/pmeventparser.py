@@ -4,16 +4,21 @@
 Converts a PM event record to a CRON expression
 """
 
+import itertools
 import logging
+import numpy
 import pytz
 import pprint
 
-from argh import arg
-from datetime import timedelta
+from datetime import datetime, timedelta
 from dateutil.rrule import *
 
-from .ora_helper import execute, parse_db_url
-from .queries import SQL_GET_EVENT, SQL_GET_EVENTS, SQL_GET_INCLUDES, SQL_GET_EXCLUDES
+from .calendars import WorkingCalendar, get_working_calendar
+from .ora_helper import execute, execute_in, iter_execute, parse_db_url, set_arraysize
+from .queries import SQL_GET_EVENT, SQL_GET_RECURRENCE, SQL_GET_RECURRENCES, SQL_GET_INCLUDES, SQL_GET_EXCLUDES
+from .queries import SQL_GET_RECURRENCES_BULK, SQL_GET_INCLUDES_BULK, SQL_GET_EXCLUDES_BULK
+from .queries import EVENT_FIELDS, RECURRENCE_FIELDS
+from .snapshot import open_snapshot
 
 month_map = {
     'January'   : 1,
@@ -63,41 +68,72 @@ weekofmonth_map = {
     'Last'   : -1
 }
 
-@arg('pm_id', nargs='?', help="PM Schedule ID. Leave blank to show all PM Schedules.", default=None)
-@arg('-d', '--db-url', help="Database TNS connection string.", default="tridata/tridata@localhost:1521:xe")
-@arg('-t', '--count', help="The default number of events to generate for schedules with no end date", default="50")
-@arg('-z', '--timezone', help="The local timezone", default="US/Eastern")
-@arg('-w', '--working-calendar', choices=['8to5','24/7'], help="Choose a working calendar", default="8to5")
-@arg('-v', '--verbosity', choices=range(0,3), help="Choose how much output to print to console", default=0)
 def eventparser(
         pm_id,
         db_url=None,
         count=None,
         timezone=None,
         working_calendar=None,
+        calendar_file=None,
+        since=None,
+        until=None,
+        arraysize=None,
+        from_snapshot=None,
+        export=None,
+        export_format=None,
+        chunk_size=None,
         verbosity=None
     ):
     """
-    Reads a PM Schedule recurrence rule from TRIRIGA database.
+    Runs ``axiom-parser``. The arguments are declared in ``commands.eventparser``.
     """
 
-    db = parse_db_url(db_url)
-    logging.debug("Using database connection: " + str(db))
-    connection = db.get_connection()
+    set_arraysize(arraysize)
+
+    working_calendar = get_working_calendar(working_calendar, calendar_file)
+
+    if from_snapshot:
+        connection = open_snapshot(from_snapshot)
+    else:
+        db = parse_db_url(db_url)
+        logging.debug("Using database connection: " + str(db))
+        connection = db.get_connection()
+
+    if export:
+        from .export import export_events
+
+        if pm_id:
+            events = iter_events(connection, pm_id, timezone=timezone)
+        else:
+            events = iter_events_chunked(connection, timezone=timezone, chunk_size=chunk_size)
+
+        written, left_out = export_events(events, export, export_format, timezone, working_calendar, since, until,
+                                          default_count=count)
+        print("Exported {} events to {}. {} were left out.".format(written, export, left_out))
+        return
 
     local_tz = pytz.timezone(timezone)
-    events = get_events(connection, pm_id, timezone=timezone)
 
-    for event in events:
+    # Print each event as soon as it is read instead of loading all of them
+    found = False
+    for event in iter_events(connection, pm_id, timezone=timezone):
+        found = True
         print("{}: {}".format(event["PM_ID"], event["PM_NAME"]))
+        if verbosity >= 2:
+            # The columns that were not fetched with the event
+            pprint.pprint(get_event_details(connection, event))
         rrule, description = parse_event(event, default_count=count)
         print(description)
         print()
         print(rrule_str(rrule))
         print()
 
-        for occurance in rrule:
-            coerced = restrict_to_working_calendar(occurance, working_calendar=working_calendar)
+        occurances = list(rrule)
+        coerced_dates = to_datetimes(restrict_to_working_calendar_array(occurances, working_calendar))
+
+        for occurance, coerced in zip(occurances, coerced_dates):
+            if (since and coerced < since) or (until and coerced >= until):
+                continue
 
             coerced = local_tz.localize(coerced)
             occurance = local_tz.localize(occurance)
@@ -109,45 +145,235 @@ def eventparser(
 
         print()
 
+    if not found:
+        raise Exception("No events for PM Schedule '{}' were found.".format(pm_id))
+
 def get_events(connection, pm_id=None, timezone="US/Eastern"):
 
+    rows = list(iter_events(connection, pm_id, timezone))
+
+    if not rows:
+        raise Exception("No events for PM Schedule '{}' were found.".format(pm_id))
+
+    return rows
+
+def iter_events(connection, pm_id=None, timezone="US/Eastern"):
+    """
+    Same as ``get_events``, but the events are read from the database in
+    batches and yielded one at a time. Does not raise if there are no events.
+    """
+
     # The times from database are always naive, without a timezone.
     # Tell python it's UTC, then convert to local TZ.
     local_tz = pytz.timezone(timezone)
 
     if pm_id:
-        rows = execute(SQL_GET_EVENT, connection, {'pm_id': pm_id})
+        rows = iter_execute(SQL_GET_RECURRENCE, connection, {'pm_id': pm_id}, factory=Event.factory)
     else:
-        rows = execute(SQL_GET_EVENTS, connection)
+        rows = iter_execute(SQL_GET_RECURRENCES, connection, factory=Event.factory)
+
+    # The same statements are run for every event. Reuse the cursors.
+    includes_cursor = connection.cursor()
+    excludes_cursor = connection.cursor()
 
     # Get includes and excludes
     for event in rows:
-        event['EVENTSTARTDATE'] = localize_date(event['EVENTSTARTDATE'], local_tz)
-        event['EVENTENDDATE'] = localize_date(event['EVENTENDDATE'], local_tz)
+        includes = execute(SQL_GET_INCLUDES, connection, {'event_spec_id': event["EVENT_SPEC_ID"]}, cursor=includes_cursor)
+        excludes = execute(SQL_GET_EXCLUDES, connection, {'event_spec_id': event["EVENT_SPEC_ID"]}, cursor=excludes_cursor)
 
-        includes = execute(SQL_GET_INCLUDES, connection, {'event_spec_id': event["EVENT_SPEC_ID"]})
-        excludes = execute(SQL_GET_EXCLUDES, connection, {'event_spec_id': event["EVENT_SPEC_ID"]})
+        prepare_event(event, includes, excludes, local_tz)
 
-        for inc in includes:
-            inc['INC_STARTDT'] = localize_date(inc['INC_STARTDT'], local_tz)
+        yield event
 
-        for excl in excludes:
-            excl['EXCL_STARTDT'] = localize_date(excl['EXCL_STARTDT'], local_tz)
-            excl['EXCL_ENDDT'] = localize_date(excl['EXCL_ENDDT'], local_tz)
+def iter_events_chunked(connection, timezone="US/Eastern", chunk_size=500):
+    """
+    Same as ``iter_events`` for all the PM Schedules, but the include and
+    exclude dates are read for ``chunk_size`` events at a time with the bulk
+    queries instead of two queries for each event. Events that are not
+    attached to a PM Schedule are left out.
+    """
 
-        event["_INCLUDES"] = includes
-        event["_EXCLUDES"] = excludes
+    local_tz = pytz.timezone(timezone)
 
-    if not rows:
-        raise Exception("No events for PM Schedule '{}' were found.".format(pm_id))
+    rows = iter_execute(SQL_GET_RECURRENCES, connection, factory=Event.factory)
+
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        events = [event for event in chunk if event["PM_ID"]]
+        pm_ids = list(set(event["PM_ID"] for event in events))
+        if not pm_ids:
+            continue
+
+        includes = group_by(execute_in(SQL_GET_INCLUDES_BULK, connection, pm_ids), 'SPEC_ID')
+        excludes = group_by(execute_in(SQL_GET_EXCLUDES_BULK, connection, pm_ids), 'SPEC_ID')
+
+        for event in events:
+            try:
+                prepare_event(event,
+                              includes.get(event["EVENT_SPEC_ID"], []),
+                              excludes.get(event["EVENT_SPEC_ID"], []),
+                              local_tz)
+            except Exception:
+                logging.exception("Unable to read the event of PM Schedule '{}'.".format(event["PM_ID"]))
+                continue
+            yield event
+
+def get_events_bulk(connection, pm_ids, timezone="US/Eastern"):
+    """
+    Get the events of all the given PM Schedules using one query each for
+    events, includes and excludes.
 
-    return rows
+    Returns a dict of PM ID to a list of events. The events are identical to
+    the ones returned by ``get_events``. PM Schedules without any events are
+    not in the dict.
+    """
+
+    local_tz = pytz.timezone(timezone)
+
+    rows = execute_in(SQL_GET_RECURRENCES_BULK, connection, pm_ids, factory=Event.factory)
+    includes = group_by(execute_in(SQL_GET_INCLUDES_BULK, connection, pm_ids), 'SPEC_ID')
+    excludes = group_by(execute_in(SQL_GET_EXCLUDES_BULK, connection, pm_ids), 'SPEC_ID')
+
+    events = []
+    for event in rows:
+        try:
+            prepare_event(event,
+                          includes.get(event["EVENT_SPEC_ID"], []),
+                          excludes.get(event["EVENT_SPEC_ID"], []),
+                          local_tz)
+            events.append(event)
+        except Exception:
+            # Don't let one bad event fail all the PM Schedules in this batch.
+            logging.exception("Unable to read the event of PM Schedule '{}'.".format(event["PM_ID"]))
+
+    return group_by(events, 'PM_ID')
+
+def group_by(rows, key):
+    """
+    Groups a list of rows into a dict of lists by the value of ``key``.
+    The order of the rows is preserved.
+    """
+    groups = dict()
+    for row in rows:
+        groups.setdefault(row[key], []).append(row)
+    return groups
+
+def prepare_event(event, includes, excludes, local_tz):
+    """
+    Localize the dates of an event and attach its includes and excludes.
+    """
+    event['EVENTSTARTDATE'] = localize_date(event['EVENTSTARTDATE'], local_tz)
+    event['EVENTENDDATE'] = localize_date(event['EVENTENDDATE'], local_tz)
+
+    for inc in includes:
+        inc['INC_STARTDT'] = localize_date(inc['INC_STARTDT'], local_tz)
+
+    for excl in excludes:
+        excl['EXCL_STARTDT'] = localize_date(excl['EXCL_STARTDT'], local_tz)
+        excl['EXCL_ENDDT'] = localize_date(excl['EXCL_ENDDT'], local_tz)
+
+    event["_INCLUDES"] = includes
+    event["_EXCLUDES"] = excludes
+
+class Event:
+    """
+    An event of a PM Schedule: the columns in ``EVENT_FIELDS`` and, after
+    ``prepare_event``, the ``_INCLUDES`` and ``_EXCLUDES``. The columns are
+    read like a dict, e.g. ``event['EVENTSTARTDATE']``.
+
+    Only the columns the recurrence rule is made from are fetched. Use
+    ``get_event_details`` for the other columns of T_PMEVENT.
+    """
+
+    __slots__ = EVENT_FIELDS + ('_INCLUDES', '_EXCLUDES')
+
+    def __init__(self, values, fields=EVENT_FIELDS):
+        for field, value in zip(fields, values):
+            setattr(self, field, value)
+
+    @classmethod
+    def factory(cls, columns):
+        """
+        The row ``factory`` of ``ora_helper.execute``. Columns that are not in
+        ``EVENT_FIELDS`` are left out.
+        """
+        if tuple(columns) == EVENT_FIELDS:
+            return cls
+
+        indexes = [i for i, column in enumerate(columns) if column in _EVENT_KEYS]
+        fields = tuple(columns[i] for i in indexes)
+        return lambda row: cls([row[i] for i in indexes], fields)
+
+    def __getitem__(self, key):
+        if key not in _EVENT_KEYS:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in _EVENT_KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in _EVENT_KEYS and hasattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def __repr__(self):
+        return "Event({!r})".format(dict((key, self[key]) for key in self.keys()))
+
+_EVENT_KEYS = frozenset(Event.__slots__)
+
+def get_event_details(connection, event):
+    """
+    All the columns of ``event`` in T_PMEVENT, as a dict. The dates are not
+    localized.
+    """
+    for row in execute(SQL_GET_EVENT, connection, {'pm_id': event['PM_ID']}):
+        if row['EVENT_SPEC_ID'] == event['EVENT_SPEC_ID']:
+            return row
+    raise Exception("The event {} of PM Schedule '{}' was not found.".format(event['EVENT_SPEC_ID'],
+                                                                           event['PM_ID']))
+
+def pack_event(event):
+    """
+    Pack an event from ``get_events`` into a compact tuple that holds only the
+    columns ``parse_event`` needs. Use ``unpack_event`` to get it back.
+    """
+    return (tuple(event[field] for field in RECURRENCE_FIELDS),
+            tuple(inc['INC_STARTDT'] for inc in event['_INCLUDES']),
+            tuple((excl['EXCL_STARTDT'], excl['EXCL_ENDDT']) for excl in event['_EXCLUDES']))
+
+def unpack_event(packed):
+    values, includes, excludes = packed
+
+    event = Event(values, RECURRENCE_FIELDS)
+    event['_INCLUDES'] = [{'INC_STARTDT': start} for start in includes]
+    event['_EXCLUDES'] = [{'EXCL_STARTDT': start, 'EXCL_ENDDT': end} for start, end in excludes]
+    return event
 
 def restrict_to_working_calendar(expected_date, working_calendar="8to5"):
     """
-    Restrict date to TRIRIGA Working Calendar.
+    Restrict date to TRIRIGA Working Calendar. ``working_calendar`` is the
+    name of a built-in calendar or a ``WorkingCalendar``.
     """
 
+    if isinstance(working_calendar, WorkingCalendar):
+        return working_calendar.restrict(expected_date)
+
     working_calendar = working_calendar.lower()
 
     if working_calendar == "8to5":
@@ -193,6 +419,84 @@ def restrict_to_standard_calendar(expected_date, start_hour=8, end_hour=17, verb
 
     return expected_date
 
+EPOCH = datetime(1970, 1, 1)
+ONE_US = timedelta(microseconds=1)
+
+US_PER_MINUTE = 60 * 1000000
+US_PER_HOUR = 60 * US_PER_MINUTE
+US_PER_DAY = 24 * US_PER_HOUR
+
+def to_datetime64(dates):
+    """
+    Convert a list of naive datetimes to a ``datetime64[us]`` array.
+    """
+    # Much faster than letting numpy convert each datetime
+    return numpy.fromiter(((date - EPOCH) // ONE_US for date in dates),
+                          numpy.int64, len(dates)).astype('datetime64[us]')
+
+def to_datetimes(dates):
+    """
+    Convert a ``datetime64`` array to a list of naive datetimes.
+    """
+    return dates.astype('datetime64[us]').astype(object).tolist()
+
+def restrict_to_working_calendar_array(dates, working_calendar="8to5"):
+    """
+    Same as ``restrict_to_working_calendar``, but for a whole array of naive
+    dates at once. ``dates`` can be a ``datetime64`` array or a list of
+    datetimes. Returns a ``datetime64[us]`` array.
+    """
+
+    if isinstance(dates, numpy.ndarray):
+        dates = dates.astype('datetime64[us]')
+    else:
+        dates = to_datetime64(dates)
+
+    if isinstance(working_calendar, WorkingCalendar):
+        return working_calendar.restrict_array(dates)
+
+    working_calendar = working_calendar.lower()
+
+    if working_calendar == "8to5":
+        return restrict_to_standard_calendar_array(dates, start_hour=8, end_hour=17)
+    elif working_calendar == "24/7":
+        return dates
+
+def restrict_to_standard_calendar_array(dates, start_hour=8, end_hour=17):
+    """
+    Vectorized ``restrict_to_standard_calendar``. The rules are the same:
+
+    Before the start hour is changed to the start hour on the same day. After
+    the end hour is changed to the start hour on the next day. Saturdays and
+    Sundays are changed to the start hour on the following Monday. The
+    seconds are unaltered.
+    """
+
+    # Work with whole days and the time of day, in microseconds
+    us = dates.astype('datetime64[us]').astype(numpy.int64)
+    days = us // US_PER_DAY
+    time = us - days * US_PER_DAY
+
+    hour = time // US_PER_HOUR
+    minute = time // US_PER_MINUTE % 60
+    start = start_hour * US_PER_HOUR
+
+    # Starts before 8 AM. Change start time to 8 AM
+    early = hour < start_hour
+    # Starts after 5 PM. Change start time to 8 AM next day
+    late = (hour > end_hour) | ((hour == end_hour) & (minute > 0))
+
+    time = numpy.where(early | late, start + time % US_PER_MINUTE, time)
+    days = days + late
+
+    # 1970-01-01 was a Thursday. Monday is 0.
+    weekday = (days + 3) % 7
+    skip = numpy.where(weekday == 5, 2, numpy.where(weekday == 6, 1, 0))
+
+    time = numpy.where(skip > 0, start + time % US_PER_MINUTE, time)
+    days = days + skip
+
+    return (days * US_PER_DAY + time).astype('datetime64[us]')
 
 def localize_date(naiveutcdate, timezone):
     """
@@ -242,6 +546,7 @@ def parse_event(event, default_count=5000, verbosity=1):
         description = "Single occurrence on " + str(dtstart)
         ruleset = rruleset()
         ruleset.rdate(dtstart)
+        ruleset.signature = ('rdates', (dtstart,))
         # Return here because we don't need to check the rest of the values
         # They may be undefined
         return (ruleset, description)
@@ -344,6 +649,7 @@ def parse_event(event, default_count=5000, verbosity=1):
         ruleset = rruleset()
         for inc in event['_INCLUDES']:
             ruleset.rdate(inc['INC_STARTDT'].replace(tzinfo=None))
+        ruleset.signature = ('rdates', tuple(sorted(ruleset._rdate)))
 
         # Return here because we don't need to check the rest of the values
         # They may be undefined
@@ -369,11 +675,14 @@ def parse_event(event, default_count=5000, verbosity=1):
     ruleset.rrule(result)
 
     # Also Schedule On
+    includes = []
     for inc in event['_INCLUDES']:
         logging.debug("Also schedule on: " + str(inc['INC_STARTDT']))
-        ruleset.rdate(inc['INC_STARTDT'].replace(tzinfo=None))
+        includes.append(inc['INC_STARTDT'].replace(tzinfo=None))
+        ruleset.rdate(includes[-1])
 
     # Exclusion ranges
+    exclusions = []
     for excl in event['_EXCLUDES']:
         excl_start = excl['EXCL_STARTDT'].replace(tzinfo=None)
         excl_end = excl['EXCL_ENDDT'].replace(tzinfo=None)
@@ -397,6 +706,7 @@ def parse_event(event, default_count=5000, verbosity=1):
         logging.debug("Exclude from {} to {}".format(excl_start, excl_end))
         exclusion_rule = rrule(DAILY, dtstart=excl_start, until=excl_end)
         ruleset.exrule(exclusion_rule)
+        exclusions.append((excl_start, excl_end))
 
 
     logging.debug(result)
@@ -408,8 +718,61 @@ def parse_event(event, default_count=5000, verbosity=1):
         logging.debug(skip_months_rule)
         ruleset.exrule(skip_months_rule)
 
+    ruleset.signature = ('rrule', freq, dtstart, interval, count, until, bysetpos, bymonth, bymonthday,
+                         weekdays_key(byweekday), tuple(sorted(includes)), tuple(sorted(exclusions)),
+                         tuple(skip_months))
+
     return (ruleset, description)
 
+def weekdays_key(byweekday):
+    """
+    A hashable form of the BYDAY of a rule: a weekday, or a list of them.
+    """
+    if byweekday is None:
+        return None
+    if not isinstance(byweekday, (list, tuple)):
+        byweekday = [byweekday]
+    return tuple(sorted((day.weekday, day.n) for day in byweekday))
+
+
+def recurrence_signature(rules):
+    """
+    Returns a hashable key of a rule from ``parse_event``. Rules with the
+    same key produce the same dates.
+
+    ``parse_event`` keeps the key as the ``signature`` of the rule, made
+    from the fields it parsed: the frequency, interval, start, end, BY*
+    parts, include dates, exclusion ranges and skipped months. Other rules
+    get a key from the parts dateutil keeps for each rule.
+    """
+    signature = getattr(rules, 'signature', None)
+    if signature is not None:
+        return signature
+
+    if isinstance(rules, rruleset):
+        return (tuple(rule_key(arule) for arule in rules._rrule),
+                tuple(sorted(rules._rdate)),
+                tuple(sorted(rule_key(arule) for arule in rules._exrule)),
+                tuple(sorted(rules._exdate)))
+    else:
+        return rule_key(rules)
+
+# The parts of a dateutil rrule that make its dates
+RULE_PARTS = ('_freq', '_dtstart', '_interval', '_wkst', '_count', '_until', '_bysetpos', '_bymonth',
+              '_bymonthday', '_bynmonthday', '_byyearday', '_byeaster', '_byweekno', '_byweekday',
+              '_bynweekday', '_byhour', '_byminute', '_bysecond')
+
+def rule_key(arule):
+    """
+    A hashable key of a dateutil rrule from its parts. Sets are sorted.
+    """
+    key = []
+    for part in RULE_PARTS:
+        value = getattr(arule, part, None)
+        if isinstance(value, (set, frozenset, list, tuple)):
+            value = tuple(sorted(tuple(item) if isinstance(item, (list, tuple)) else item for item in value))
+        key.append(value)
+    return tuple(key)
 
 def rrule_str(rules):
     try:
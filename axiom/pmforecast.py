@@ -0,0 +1,339 @@
+"""
+Forecast the PM tasks that will be created on each day or week, for each
+building.
+
+The recurrence rule of each PM Schedule is expanded over the forecast and
+moved into the working calendar, the same way the validator expects the
+tasks. The dates of a whole chunk of PM Schedules are then counted into
+building and day or week bins at once with ``numpy.bincount``.
+"""
+
+import collections
+import logging
+import numpy
+import xlsxwriter
+
+from argh.exceptions import CommandError
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from .calendars import get_working_calendar
+from .ora_helper import execute_in, parse_db_url, set_verbosity, set_arraysize
+from .pmeventparser import EPOCH, US_PER_DAY, get_events_bulk, pack_event, unpack_event, parse_event
+from .pmeventparser import restrict_to_working_calendar_array, to_datetime64
+from .pmschedulevalidator import WINDOW_MARGIN, get_pms, is_grouped
+from .queries import SQL_GET_TASKS_GROUPED_BULK
+from .snapshot import open_snapshot
+
+# The building of events that have none
+NO_BUILDING = "(No Building)"
+
+BIN_DAYS = {
+    'day': 1,
+    'week': 7,
+}
+
+def forecast(
+        pm_id,
+        id_file=None,
+        db_url=None,
+        from_snapshot=None,
+        outputfile=None,
+        timezone=None,
+        working_calendar=None,
+        calendar_file=None,
+        since=None,
+        until=None,
+        years=None,
+        bin=None,
+        count=None,
+        chunk_size=None,
+        processes=None,
+        arraysize=None,
+        verbosity=None
+    ):
+    """
+    Runs ``axiom forecast``. The arguments are declared in ``commands.forecast``.
+    """
+
+    set_verbosity(verbosity)
+    set_arraysize(arraysize)
+
+    working_calendar = get_working_calendar(working_calendar, calendar_file)
+
+    if from_snapshot:
+        connection = open_snapshot(from_snapshot)
+    else:
+        db = parse_db_url(db_url)
+        logging.debug("Using database connection: " + str(db))
+        connection = db.get_connection()
+
+    if since is None:
+        since = datetime.combine(datetime.now().date(), datetime.min.time())
+    if until is None:
+        until = since + timedelta(days=round(365.25 * years))
+    if until <= since:
+        raise CommandError("The forecast must end after it starts.")
+
+    pms = get_pms(connection, pm_id, id_file)
+
+    if len(pms) <= 0:
+        raise CommandError("No PM Schedules found.")
+
+    bins = Bins(since, until, BIN_DAYS[bin])
+    counts = Counts(bins)
+
+    executor = ProcessPoolExecutor(max_workers=processes) if processes > 1 else None
+    # Chunks being expanded by the processes
+    pending = collections.deque()
+
+    try:
+        for i in range(0, len(pms), chunk_size):
+            chunk = pms[i:i + chunk_size]
+            job, pm_ids, buildings, weights = fetch_chunk(connection, chunk, timezone, since, until,
+                                                          working_calendar, count)
+            counts.missing += len(chunk) - len(pm_ids)
+
+            if executor is None:
+                counts.add(pm_ids, buildings, weights, expand_chunk(job))
+                continue
+
+            pending.append((pm_ids, buildings, weights, executor.submit(expand_chunk, job)))
+            while len(pending) > processes * 2:
+                pm_ids, buildings, weights, future = pending.popleft()
+                counts.add(pm_ids, buildings, weights, future.result())
+
+        while pending:
+            pm_ids, buildings, weights, future = pending.popleft()
+            counts.add(pm_ids, buildings, weights, future.result())
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if outputfile.lower().endswith(".csv"):
+        write_csv(outputfile, counts)
+    else:
+        write_xlsx(outputfile, counts, bin)
+
+    print(counts.describe(len(pms)))
+
+def fetch_chunk(connection, pms, timezone, since, until, working_calendar, count):
+    """
+    Get the events and task counts of a chunk of PM Schedules.
+
+    Returns a job for ``expand_chunk`` and the PM ID, building and number of
+    tasks for each occurrence of each of its events. PM Schedules without
+    an event are left out.
+    """
+    events = get_events_bulk(connection, [pm['TRIIDTX'] for pm in pms], timezone=timezone)
+    multiplicity = get_multiplicity(connection, [pm['TRIIDTX'] for pm in pms if is_grouped(pm)])
+
+    packed = []
+    pm_ids = []
+    buildings = []
+    weights = []
+    for pm in pms:
+        pm_events = events.get(pm['TRIIDTX'])
+        if not pm_events:
+            continue
+
+        # Like the validator, only the first event is used
+        event = pm_events[0]
+        packed.append(pack_event(event))
+        pm_ids.append(pm['TRIIDTX'])
+        buildings.append(event.get('TRIBUILDINGTX') or NO_BUILDING)
+        weights.append(multiplicity.get(pm['TRIIDTX'], 1))
+
+    return (packed, since, until, working_calendar, count), pm_ids, buildings, weights
+
+def get_multiplicity(connection, pm_ids):
+    """
+    The number of tasks each grouped PM Schedule creates for an occurrence,
+    by PM ID. It is the median of the number of tasks of each of its
+    occurrences, one for each asset, whatever their status. PM Schedules
+    without tasks are left out.
+    """
+    occurrences = collections.defaultdict(collections.Counter)
+    if not pm_ids:
+        return {}
+
+    for task in execute_in(SQL_GET_TASKS_GROUPED_BULK, connection, pm_ids):
+        planned = task['TRIPLANNEDSTARTDT']
+        if planned is None or not task['TASK_ID']:
+            continue
+        # A row for each status of the tasks planned on a date
+        occurrences[task['PM_ID']][planned] += task['TASK_ID']
+
+    return dict((pm_id, int(numpy.median(list(tasks.values())) + 0.5)) for pm_id, tasks in occurrences.items())
+
+def expand_chunk(job):
+    """
+    Expand the events of a job from ``fetch_chunk`` from ``since`` to
+    ``until`` and move the dates into the working calendar. The dates are
+    taken from ``WINDOW_MARGIN`` before ``since``, so that dates the working
+    calendar moves into the forecast are counted. This can run in a worker
+    process.
+
+    Returns an array of the working calendar dates from ``since`` to
+    ``until`` in microseconds, an array of the index of the event of each
+    date, and a list of (index, error) of the events that could not be
+    parsed.
+    """
+    packed, since, until, working_calendar, count = job
+
+    dates = []
+    sizes = numpy.zeros(len(packed), numpy.int64)
+    failed = []
+    for i, event in enumerate(packed):
+        try:
+            rules, description = parse_event(unpack_event(event), default_count=count, verbosity=0)
+            size = len(dates)
+            dates.extend(date for date in rules.between(since - WINDOW_MARGIN, until, inc=True) if date < until)
+            sizes[i] = len(dates) - size
+        except Exception as e:
+            failed.append((i, str(e)))
+
+    owner = numpy.repeat(numpy.arange(len(packed)), sizes)
+    dates = restrict_to_working_calendar_array(to_datetime64(dates), working_calendar).astype(numpy.int64)
+
+    keep = (dates >= to_us(since)) & (dates < to_us(until))
+    return dates[keep], owner[keep], failed
+
+def to_us(date):
+    return (date - EPOCH) // timedelta(microseconds=1)
+
+class Bins:
+    """
+    The day or week bins of a forecast. Weeks start on Monday.
+    """
+
+    def __init__(self, since, until, days):
+        self.days = days
+        start = since.date() - timedelta(days=since.weekday() if days == 7 else 0)
+        self.first_day = (start - EPOCH.date()).days
+        last_day = (until - timedelta(microseconds=1) - EPOCH).days
+        self.count = (last_day - self.first_day) // days + 1
+        self.starts = [start + timedelta(days=days * i) for i in range(self.count)]
+
+    def of(self, dates):
+        """
+        The bin of each date of an array in microseconds.
+        """
+        return (dates // US_PER_DAY - self.first_day) // self.days
+
+class Counts:
+    """
+    The number of tasks in each building and bin.
+    """
+
+    def __init__(self, bins):
+        self.bins = bins
+        # Building name to row
+        self.buildings = {}
+        self.table = numpy.zeros((0, bins.count), numpy.int64)
+        self.pm_count = 0
+        self.missing = 0
+        self.failed = 0
+
+    def add(self, pm_ids, buildings, weights, expanded):
+        """
+        Count the dates from ``expand_chunk``.
+        """
+        dates, owner, failed = expanded
+
+        for i, error in failed:
+            logging.warning("Unable to expand the rule of PM Schedule '{}'. {}".format(pm_ids[i], error))
+        self.failed += len(failed)
+        self.pm_count += len(pm_ids) - len(failed)
+
+        rows = numpy.array([self.buildings.setdefault(building, len(self.buildings)) for building in buildings],
+                           numpy.int64)
+        if len(self.buildings) > len(self.table):
+            self.table = numpy.vstack([self.table,
+                                       numpy.zeros((len(self.buildings) - len(self.table), self.bins.count),
+                                                   numpy.int64)])
+
+        if not len(dates):
+            return
+
+        cells = rows[owner] * self.bins.count + self.bins.of(dates)
+        tasks = numpy.bincount(cells, weights=numpy.array(weights, numpy.int64)[owner],
+                               minlength=self.table.size)
+        self.table += numpy.rint(tasks).astype(numpy.int64).reshape(self.table.shape)
+
+    def rows(self):
+        """
+        The buildings and their counts, sorted by building.
+        """
+        return [(building, self.table[row]) for building, row in sorted(self.buildings.items())]
+
+    def describe(self, total):
+        text = "Forecast {} tasks of {} PM Schedules in {} buildings from {} to {}.".format(
+            self.table.sum(), self.pm_count, len(self.buildings), self.bins.starts[0],
+            self.bins.starts[-1] + timedelta(days=self.bins.days - 1))
+
+        if self.table.size:
+            busiest = self.table.sum(axis=0).argmax()
+            text += " Busiest: {} with {} tasks.".format(self.bins.starts[busiest], self.table.sum(axis=0)[busiest])
+
+        skipped = self.missing + self.failed
+        if skipped:
+            text += " {} of {} PM Schedules were left out: {} without an event and {} whose rule could not be parsed.".format(
+                skipped, total, self.missing, self.failed)
+
+        return text
+
+def write_csv(outputfile, counts):
+    """
+    Write a row for each building and bin with tasks.
+    """
+    import csv
+
+    with open(outputfile, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(['building', 'start', 'tasks'])
+        for building, row in counts.rows():
+            for i in numpy.flatnonzero(row):
+                writer.writerow([building, counts.bins.starts[i].isoformat(), row[i]])
+
+def write_xlsx(outputfile, counts, bin):
+    """
+    Write a worksheet with a row for each building and a column for each
+    bin, colored as a heatmap.
+    """
+    workbook = xlsxwriter.Workbook(outputfile)
+    worksheet = workbook.add_worksheet("Forecast")
+
+    header = workbook.add_format({'bold': True, 'text_wrap': True, 'num_format': 'yyyy-mm-dd'})
+    bold = workbook.add_format({'bold': True})
+
+    rows = counts.rows()
+    bins = counts.bins
+
+    worksheet.write(0, 0, "Building / " + bin.title(), header)
+    worksheet.write(0, 1, "Total", header)
+    for i, start in enumerate(bins.starts):
+        worksheet.write_datetime(0, i + 2, datetime.combine(start, datetime.min.time()), header)
+
+    for r, (building, row) in enumerate(rows, start=1):
+        worksheet.write(r, 0, building)
+        worksheet.write(r, 1, int(row.sum()))
+        worksheet.write_row(r, 2, row.tolist())
+
+    total_row = len(rows) + 1
+    worksheet.write(total_row, 0, "All Buildings", bold)
+    worksheet.write(total_row, 1, int(counts.table.sum()), bold)
+    worksheet.write_row(total_row, 2, counts.table.sum(axis=0).tolist(), bold)
+
+    if rows:
+        worksheet.conditional_format(1, 2, len(rows), bins.count + 1, {'type': '3_color_scale',
+                                                                       'min_color': '#FFFFFF',
+                                                                       'mid_color': '#FFEB84',
+                                                                       'max_color': '#F8696B'})
+
+    worksheet.set_column(0, 0, 30)
+    worksheet.set_column(1, 1, 8)
+    worksheet.set_column(2, bins.count + 1, 11)
+    worksheet.freeze_panes(1, 2)
+
+    workbook.close()
@@ -4,22 +4,53 @@
 Produce a report to validate PM Schedules
 """
 
+import bisect
+import collections
+import hashlib
+import heapq
+import itertools
 import logging
+import numpy
 import pytz
+import threading
+import weakref
 import xlsxwriter
 
-from argh import arg
 from argh.exceptions import CommandError
-from datetime import datetime
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
 from tqdm import tqdm
 from xlsxwriter.utility import xl_rowcol_to_cell
 
 
-from .ora_helper import execute, parse_db_url, set_verbosity
-from .pmeventparser import get_events, parse_event, restrict_to_working_calendar, localize_date, rrule_str
-from .queries import SQL_GET_PMSCHEDS, SQL_GET_PMSCHEDS_FILTERED, SQL_GET_TASKS, SQL_GET_TASKS_GROUPED
+from .budget import Budget, BudgetExceeded, current_budget
+from .calendars import get_working_calendar
+from .ora_helper import execute, execute_in, iter_execute, parse_db_url, set_verbosity, set_arraysize, pooled_connection
+from .pmeventparser import get_events, get_events_bulk, group_by, parse_event, localize_date, rrule_str
+from .pmeventparser import restrict_to_working_calendar_array, to_datetimes, recurrence_signature
+from .pmeventparser import pack_event, unpack_event
+from .pipeline import run_pipeline
+from .profiler import span, is_profiling
+from . import profiler
+from .reports import Report, REPORTS
+from .snapshot import open_snapshot, SnapshotPool
+from .state import StateStore
+from .timezones import get_transition_table, US_PER_DAY
+from . import queries
+from .queries import SQL_GET_PMSCHEDS, SQL_GET_PMSCHEDS_FILTERED
 
-xlFormats = dict()
+# Cell formats of each workbook. See ``get_formats``.
+_formats = weakref.WeakKeyDictionary()
+_formats_lock = threading.Lock()
+
+EPOCH_UTC = pytz.utc.localize(datetime(1970, 1, 1))
+
+# Number of distinct recurrence rules whose occurrences are kept
+OCCURRENCE_CACHE_SIZE = 256
+
+# With ``since``, the occurrences of a rule are kept from this long before it.
+# The working calendar moves a date forward, usually by less than a week.
+WINDOW_MARGIN = timedelta(days=31)
 
 def safe_xl_ws_name(value):
     """
@@ -30,88 +61,696 @@ def safe_xl_ws_name(value):
         value = value[0:31]
     return value
 
-@arg('pm_id', nargs='*', help="One or more PM Schedule IDs. Leave blank to show all PM Schedules.", default=None)
-@arg('-d', '--db-url', help="Database connection string. USERNAME/PASSWORD@HOST:PORT:SID or USERNAME/PASSWORD@HOST:PORT/SERVICE_NAME", default="tridata/tridata@localhost:1521:xe")
-@arg('-z', '--timezone', help="The local timezone", default="US/Eastern")
-@arg('-u', '--site-url', help="The URL to TRIRIGA. It will be used to generate links to records.", default="http://localhost:9080")
-@arg('-f', '--outputfile', help="The output file name.", default="axiom.xlsx")
-@arg('-s', '--strip-time', help="Remove time component from dates before comparing.", default=False)
-@arg('-w', '--working-calendar', choices=['8to5','24/7'], help="Choose a working calendar", default="8to5")
-@arg('-v', '--verbosity', choices=range(0,3), help="Choose how much output to print to console", default=0)
 def schedulevalidator(
         pm_id,
+        id_file=None,
         db_url=None,
         timezone=None,
         site_url=None,
         outputfile=None,
+        report_format=None,
         strip_time=None,
         working_calendar=None,
+        calendar_file=None,
+        since=None,
+        until=None,
+        epoch_ms=None,
+        align=None,
+        summary_only=None,
+        time_budget=None,
+        max_occurrences=None,
+        top=None,
+        bulk_load=None,
+        chunk_size=None,
+        workers=None,
+        processes=None,
+        pipeline=None,
+        queue_size=None,
+        arraysize=None,
+        constant_memory=None,
+        state_file=None,
+        from_snapshot=None,
+        profile=None,
+        cprofile=None,
         verbosity=None
     ):
     """
-    Produces a report to verify PM Schedules in TRIRIGA.
+    Runs ``axiom``. The arguments are declared in ``commands.schedulevalidator``.
+    """
 
-    Example:
+    set_verbosity(verbosity)
+    set_arraysize(arraysize)
+
+    if profile or cprofile:
+        profiler.start(profile, cprofile)
+
+    try:
+        if site_url.endswith("/"):
+            site_url = site_url[:-1]
+
+        working_calendar = get_working_calendar(working_calendar, calendar_file)
+
+        pool = None
+        if from_snapshot:
+            db = from_snapshot
+            connection = open_snapshot(from_snapshot)
+            if workers > 1:
+                pool = SnapshotPool(from_snapshot)
+        else:
+            db = parse_db_url(db_url)
+            logging.debug("Using database connection: " + str(db))
+
+            if workers > 1:
+                # One session for each worker and one for this thread
+                pool = db.get_pool(workers + 1)
+                connection = pool.acquire()
+                connection.autocommit = True
+            else:
+                connection = db.get_connection()
+
+        pms = get_pms(connection, pm_id, id_file)
+
+        if len(pms) <= 0:
+            raise CommandError("No PM Schedules found in {}".format(db))
+
+        if outputfile is None:
+            outputfile = "axiom." + report_format
+
+        if report_format == 'xlsx':
+            report = ExcelReport(outputfile, pms, site_url, constant_memory, align, summary_only)
+        else:
+            report = REPORTS[report_format](outputfile)
+
+        state = StateStore(state_file) if state_file else None
+
+        options = dict(timezone=timezone,
+                       strip_time=strip_time,
+                       working_calendar=working_calendar,
+                       since=since,
+                       until=until,
+                       epoch_ms=epoch_ms,
+                       align=align,
+                       summary_only=summary_only,
+                       time_budget=time_budget,
+                       max_occurrences=max_occurrences,
+                       verbosity=verbosity)
+
+        # (invalid, total, PM ID, first mismatch) of each PM for --summary-only
+        summaries = []
+
+        progress = tqdm(total=len(pms))
+
+        # The report is only written from this thread, in the order of ``pms``.
+        def write(pm, result):
+            try:
+                with span('write', pm['TRIIDTX']):
+                    report.add_pm(pm, is_grouped(pm), result)
+                if result:
+                    print_result(result, verbosity)
+                    if summary_only:
+                        summaries.append((result['total'] - result['ok_count'], result['total'],
+                                          result['pm_id'], result['first_mismatch']))
+            except Exception as e:
+                # The rows may be streamed and fail while being written
+                logging.exception("Unable to validate a PM. Ignore and continue.")
+
+            if verbosity > 0:
+                print()
+
+            progress.update()
+
+        depths = None
+        if pipeline:
+            depths = check_pms_pipelined(pms, connection, write, pool, workers, bulk_load, chunk_size, processes, state,
+                                queue_size, **options)
+        else:
+            for pm, result in check_pms(pms, connection, pool, workers, bulk_load, chunk_size, processes, state,
+                                        **options):
+                write(pm, result)
+
+        progress.close()
+
+        if depths:
+            print("Queue depths (mean/size): " + ", ".join(str(queue) for queue in depths))
+
+        report.close()
+
+        if state is not None:
+            state.close()
+
+        if summary_only:
+            print_worst(summaries, top)
+    finally:
+        # Save the trace and stats even if the run fails
+        if profile or cprofile:
+            summary = profiler.stop()
+            if summary:
+                print(summary)
+
+def get_pms(connection, pm_id=None, id_file=None):
+    """
+    Get the given PM Schedules, or all of them if ``pm_id`` is empty and
+    there is no ``id_file``.
+    """
+    if id_file:
+        pm_id = list(pm_id or []) + read_id_file(id_file)
 
-        axiom --db-url=tridata/tridata@localhost:1521:xe --site-url=http://localhost:9080 --timezone=US/Eastern
+    if pm_id:
+        # Get selected PM Schedules. Sorted, so that the chunks come back in
+        # the same order as one query.
+        pm_ids = sorted(set(pm_id))
+        pms = execute_in(SQL_GET_PMSCHEDS_FILTERED, connection, pm_ids)
+        if len(pm_ids) != len(pms):
+            logging.warning("Expected {} PMs, only got {}.".format(len(pm_ids), len(pms)))
+    else:
+        # Get ALL PM Schedules
+        pms = execute(SQL_GET_PMSCHEDS, connection)
+
+    return pms
 
+def read_id_file(id_file):
     """
+    Read PM Schedule IDs from a file, one on each line. Blank lines and lines
+    starting with # are skipped.
+    """
+    with open(id_file, encoding="utf-8") as f:
+        pm_ids = [line.strip() for line in f]
 
-    set_verbosity(verbosity)
+    pm_ids = [pm_id for pm_id in pm_ids if pm_id and not pm_id.startswith("#")]
+    if not pm_ids:
+        raise CommandError("No PM Schedule IDs found in {}".format(id_file))
 
-    if site_url.endswith("/"):
-        site_url = site_url[:-1]
+    return pm_ids
 
-    db = parse_db_url(db_url)
-    logging.debug("Using database connection: " + str(db))
-    connection = db.get_connection()
+def check_pms(pms, connection, pool=None, workers=1, bulk_load=False, chunk_size=500, processes=1, state=None, **options):
+    """
+    Validate a list of PM Schedules.
 
-    if pm_id:
-        # Get selected PM Schedules
-        pms_sql = SQL_GET_PMSCHEDS_FILTERED.format(', '.join(["'{}'".format(i) for i in pm_id]))
-        pms = execute(pms_sql, connection)
-        if len(pm_id) != len(pms):
-            logging.warning("Expected {} PMs, only got {}.".format(len(pm_id), len(pms)))
+    If ``workers`` is more than 1, up to that many PMs are validated at the
+    same time. Each worker thread gets its own connection from ``pool``.
+
+    If ``processes`` is more than 1, the rows are still fetched by this
+    process (or the worker threads), but parsing the recurrence rules and
+    comparing the dates is done by a pool of that many processes.
+
+    If a ``state`` store is given, the results are saved to it. PMs whose
+    events and tasks have not changed since the last run are not validated
+    again. Their saved results are used instead. With ``workers``, each
+    worker thread also fetches the PM and looks up its saved result.
+
+    Yields a tuple of each PM and its ``check_pm`` result in the same order as
+    ``pms``. The result is None if the PM could not be validated.
+    """
+
+    def fetch(pm, connection):
+        return fetch_pm(pm, connection, options['timezone'], options.get('since'), options.get('until'),
+                        options.get('epoch_ms'))
+
+    def check(pm, connection, events, tasks):
+        if process_executor:
+            if events is None:
+                events, tasks = fetch(pm, connection)
+
+            job = pack_job(pm, events, tasks, options)
+            return unpack_result(process_executor.submit(check_packed, job).result())
+
+        return check_pm(pm['TRIIDTX'], pm['TRINAMETX'], connection,
+                        grouped=is_grouped(pm), events=events, tasks=tasks,
+                        **options)
+
+    def check_saved(pm, connection, events, tasks):
+        # Fetch and fingerprint in the worker too, so that the saved results
+        # are looked up in parallel.
+        nonlocal reused
+        if events is None:
+            events, tasks = fetch(pm, connection)
+
+        fingerprint = get_fingerprint(pm, events, tasks, options)
+        saved = state.get(pm['TRIIDTX'], fingerprint)
+        if saved is not None:
+            # Nothing changed since the last run
+            with reused_lock:
+                reused += 1
+            return saved
+
+        result = check(pm, connection, events, tasks)
+        if result['timeout'] is None:
+            state.put(pm['TRIIDTX'], fingerprint, pack_result(result))
+        return result
+
+    def check_pooled(pm, events, tasks):
+        run = check if state is None else check_saved
+
+        if events is not None:
+            # Prefetched. No need for a database session.
+            return run(pm, None, events, tasks)
+
+        with pooled_connection(pool) as connection:
+            return run(pm, connection, events, tasks)
+
+    def submit_packed(pm, events, tasks):
+        # Fetch here and hand over the CPU bound part to a process.
+        if events is None:
+            events, tasks = fetch(pm, connection)
+
+        job = pack_job(pm, events, tasks, options)
+        return process_executor.submit(check_packed, job)
+
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    process_executor = ProcessPoolExecutor(max_workers=processes) if processes > 1 else None
+
+    # Futures of the PMs being validated, oldest first. Only a few PMs are
+    # allowed to be ahead of the one being written so that the results don't
+    # pile up in memory.
+    pending = collections.deque()
+    window = max(workers, processes) * 2
+
+    def collect(pm, future, fingerprint):
+        pm, result = wait_for_result(pm, future)
+        if result is not None and fingerprint is not None and result['timeout'] is None:
+            state.put(pm['TRIIDTX'], fingerprint, pack_result(result))
+        return pm, result
+
+    events = None
+    tasks = None
+    reused = 0
+    reused_lock = threading.Lock()
+
+    try:
+        for i, pm in enumerate(pms):
+            if bulk_load and i % chunk_size == 0:
+                events, tasks = prefetch(connection, pms[i:i + chunk_size], options['timezone'],
+                                         options.get('since'), options.get('until'), options.get('epoch_ms'))
+
+            pm_events = events.get(pm['TRIIDTX'], []) if bulk_load else None
+            pm_tasks = tasks.get(pm['TRIIDTX'], []) if bulk_load else None
+
+            fingerprint = None
+            saved = None
+            failed = False
+
+            if state is not None and executor is None:
+                try:
+                    if pm_events is None:
+                        pm_events, pm_tasks = fetch(pm, connection)
+
+                    fingerprint = get_fingerprint(pm, pm_events, pm_tasks, options)
+                    saved = state.get(pm['TRIIDTX'], fingerprint)
+                except Exception as e:
+                    logging.exception("Unable to validate a PM. Ignore and continue.")
+                    failed = True
+
+            if failed:
+                pending.append((pm, None, None))
+            elif saved is not None:
+                # Nothing changed since the last run
+                reused += 1
+                future = Future()
+                future.set_result(saved)
+                pending.append((pm, future, None))
+            elif executor:
+                pending.append((pm, executor.submit(check_pooled, pm, pm_events, pm_tasks), fingerprint))
+            elif process_executor:
+                try:
+                    pending.append((pm, submit_packed(pm, pm_events, pm_tasks), fingerprint))
+                except Exception as e:
+                    logging.exception("Unable to validate a PM. Ignore and continue.")
+                    pending.append((pm, None, None))
+            else:
+                # Keep the order
+                while pending:
+                    yield collect(*pending.popleft())
+
+                try:
+                    # Nothing else uses the connection until the caller is
+                    # done with the result. Stream the tasks, unless the
+                    # result has to be saved.
+                    result = check_pm(pm['TRIIDTX'], pm['TRINAMETX'], connection,
+                                      grouped=is_grouped(pm), events=pm_events, tasks=pm_tasks,
+                                      stream=state is None, **options)
+                    if fingerprint is not None and result['timeout'] is None:
+                        state.put(pm['TRIIDTX'], fingerprint, pack_result(result))
+                except Exception as e:
+                    logging.exception("Unable to validate a PM. Ignore and continue.")
+                    result = None
+
+                yield pm, result
+
+            while len(pending) > window:
+                yield collect(*pending.popleft())
+
+        while pending:
+            yield collect(*pending.popleft())
+
+        if state is not None:
+            logging.info("Reused the saved results of {} of {} PM Schedules.".format(reused, len(pms)))
+
+        if _occurrences.hits or _occurrences.misses:
+            logging.info("Recurrence rules expanded: {}, reused: {}.".format(_occurrences.misses, _occurrences.hits))
+    finally:
+        if executor:
+            executor.shutdown(wait=False)
+        if process_executor:
+            process_executor.shutdown(wait=False)
+
+def check_pms_pipelined(pms, connection, write, pool=None, workers=1, bulk_load=False, chunk_size=500, processes=1,
+                        state=None, queue_size=8, **options):
+    """
+    Same as ``check_pms``, but fetching, validating and writing the results
+    run at the same time as stages of a pipeline. See ``pipeline.py``.
+
+    Up to ``workers`` threads fetch the events and tasks, each with its own
+    connection from ``pool`` if there is more than one. The PMs are validated
+    by a thread, or by ``processes`` processes. ``write(pm, result)`` is
+    called in this thread in the order of ``pms``.
+
+    Returns the ``QueueDepths`` of the pipeline.
+    """
+    timezone = options['timezone']
+    since = options.get('since')
+    until = options.get('until')
+    epoch_ms = options.get('epoch_ms')
+
+    def fetch_batch(batch, connection):
+        if bulk_load:
+            events, tasks = prefetch(connection, batch, timezone, since, until, epoch_ms)
+            return [(events.get(pm['TRIIDTX'], []), tasks.get(pm['TRIIDTX'], [])) for pm in batch]
+
+        return [fetch_pm(pm, connection, timezone, since, until, epoch_ms) for pm in batch]
+
+    def fetch(batch):
+        if pool is None:
+            # Only one fetch thread uses the connection
+            return fetch_batch(batch, connection)
+
+        with pooled_connection(pool) as pooled:
+            return fetch_batch(batch, pooled)
+
+    # Fingerprints of the PMs being validated, to save their results
+    fingerprints = {}
+    reused = 0
+
+    def compute(pm, fetched):
+        nonlocal reused
+        events, tasks = fetched
+
+        if state is not None:
+            fingerprint = get_fingerprint(pm, events, tasks, options)
+            saved = state.get(pm['TRIIDTX'], fingerprint)
+            if saved is not None:
+                # Nothing changed since the last run
+                reused += 1
+                return saved
+            fingerprints[pm['TRIIDTX']] = fingerprint
+
+        if process_executor:
+            return process_executor.submit(check_packed, pack_job(pm, events, tasks, options))
+
+        return compute_executor.submit(check_pm, pm['TRIIDTX'], pm['TRINAMETX'], None,
+                                       grouped=is_grouped(pm), events=events, tasks=tasks, **options)
+
+    def write_result(pm, result):
+        fingerprint = fingerprints.pop(pm['TRIIDTX'], None)
+        if isinstance(result, tuple):
+            # Packed result from a worker process or the state store
+            packed = result
+            result = unpack_result(packed)
+        elif result is not None:
+            packed = pack_result(result)
+
+        if result is not None and fingerprint is not None and result['timeout'] is None:
+            state.put(pm['TRIIDTX'], fingerprint, packed)
+
+        write(pm, result)
+
+    size = chunk_size if bulk_load else 1
+    batches = [pms[i:i + size] for i in range(0, len(pms), size)]
+
+    fetch_executor = ThreadPoolExecutor(max_workers=workers if pool is not None else 1)
+    if processes > 1:
+        process_executor = ProcessPoolExecutor(max_workers=processes)
+        compute_executor = None
     else:
-        # Get ALL PM Schedules
-        pms = execute(SQL_GET_PMSCHEDS, connection)
+        process_executor = None
+        compute_executor = ThreadPoolExecutor(max_workers=1)
+
+    try:
+        depths = run_pipeline(batches, fetch, compute, write_result, fetch_executor, queue_size)
+
+        if state is not None:
+            logging.info("Reused the saved results of {} of {} PM Schedules.".format(reused, len(pms)))
+
+        return depths
+    finally:
+        fetch_executor.shutdown(wait=False)
+        if process_executor:
+            process_executor.shutdown(wait=False)
+        if compute_executor:
+            compute_executor.shutdown(wait=False)
+
+def wait_for_result(pm, future):
+    if future is None:
+        return pm, None
+
+    try:
+        result = future.result()
+        if isinstance(result, tuple):
+            # Packed result from a worker process
+            result = unpack_result(result)
+        return pm, result
+    except Exception as e:
+        logging.exception("Unable to validate a PM. Ignore and continue.")
+        return pm, None
+
+def fetch_pm(pm, connection, timezone, since=None, until=None, epoch_ms=False):
+    """
+    Get the events and tasks of a PM Schedule.
+    """
+    events = get_events(connection, pm_id=pm['TRIIDTX'], timezone=timezone)
+    tasks = get_tasks(connection, pm['TRIIDTX'], is_grouped(pm), window=get_window(timezone, since, until),
+                      epoch_ms=epoch_ms)
+    return events, tasks
 
+def get_tasks_query(grouped=False, bulk=False, window=False, epoch_ms=False):
+    """
+    Returns the tasks query with the given options. See ``queries.py``.
+    """
+    return getattr(queries, "SQL_GET_TASKS" +
+                            ("_GROUPED" if grouped else "") +
+                            ("_BULK" if bulk else "") +
+                            ("_WINDOW" if window else "") +
+                            ("_MS" if epoch_ms else ""))
 
-    if len(pms) <= 0:
-        raise CommandError("No PM Schedules found in {}".format(db))
+def get_tasks(connection, pm_id, grouped=False, stream=False, window=None, epoch_ms=False):
+    """
+    Get the tasks of a PM Schedule. If a ``window`` from ``get_window`` is
+    given, only the tasks planned to start in it. If ``epoch_ms`` is True,
+    TRIPLANNEDSTARTDT is in milliseconds since 1970-01-01 UTC instead of a
+    date.
+    """
+    sql = get_tasks_query(grouped, window=bool(window), epoch_ms=epoch_ms)
+    parameters = dict(window or {}, pm_id=pm_id)
 
-    workbook = xlsxwriter.Workbook(outputfile)
-    index_worksheet = workbook.add_worksheet(name="Index")
+    return (iter_execute if stream else execute)(sql, connection, parameters)
 
-    xlFormats['bad'] = workbook.add_format({'bg_color': '#FFC7CE', 'font_color': '#9C0006'})
-    xlFormats['good'] = workbook.add_format({'bg_color': '#C6EFCE', 'font_color': '#006100'})
-    xlFormats['header'] = workbook.add_format({'bold': True, 'text_wrap': True})
-    xlFormats['rrule'] = workbook.add_format({'text_wrap': True, 'valign': 'top'})
+# The planned start dates are milliseconds since 1970-01-01 UTC. A window with
+# only one end is closed with these.
+MIN_WINDOW_MS = -62135596800000 # 0001-01-01
+MAX_WINDOW_MS = 253402214400000 # 9999-12-31
 
-    # Validate each one
-    for pm in tqdm(pms):
-        try:
-            group = (pm['TRITASKGROUPINGRULELI'] == 'Create Task For Each Asset/Location')
-
-            validate_pm(pm['TRIIDTX'],
-                        pm['TRINAMETX'],
-                        workbook,
-                        connection,
-                        timezone,
-                        strip_time,
-                        working_calendar,
-                        group,
-                        verbosity)
-        except Exception as e:
-            logging.exception("Unable to validate a PM. Ignore and continue.")
+def get_window(timezone, since=None, until=None):
+    """
+    Returns the bind parameters of the tasks window queries for the naive
+    local dates ``since`` and ``until``, or None if neither is given.
+    """
+    if since is None and until is None:
+        return None
+
+    local_tz = pytz.timezone(timezone)
+
+    def to_ms(date, default):
+        if date is None:
+            return default
+        return int((local_tz.localize(date) - EPOCH_UTC).total_seconds() * 1000)
+
+    return {'since_ms': to_ms(since, MIN_WINDOW_MS), 'until_ms': to_ms(until, MAX_WINDOW_MS)}
+
+# The columns of a task row that ``check_pm`` uses.
+TASK_FIELDS = ('TASK_ID', 'TASK_STATUS', 'TRIPLANNEDSTARTDT')
+
+def pack_job(pm, events, tasks, options):
+    """
+    Pack the inputs of ``check_pm`` into a compact tuple to send to a worker
+    process. Only the columns the validation uses are kept.
+    """
+    return (pm['TRIIDTX'],
+            pm['TRINAMETX'],
+            is_grouped(pm),
+            [pack_event(event) for event in events],
+            [tuple(task[field] for field in TASK_FIELDS) for task in tasks],
+            options)
+
+def check_packed(job):
+    """
+    Runs ``check_pm`` on a job from ``pack_job``. This is the entry point of
+    the worker processes.
+    """
+    pm_id, pm_name, grouped, events, tasks, options = job
+
+    result = check_pm(pm_id, pm_name, None,
+                      grouped=grouped,
+                      events=[unpack_event(event) for event in events],
+                      tasks=[dict(zip(TASK_FIELDS, task)) for task in tasks],
+                      **options)
+
+    return pack_result(result)
+
+# Change this when the validation logic changes so that results saved by an
+# older version are not reused.
+FINGERPRINT_VERSION = 4
 
-        if verbosity > 0:
-            print()
+def get_fingerprint(pm, events, tasks, options):
+    """
+    Returns a hash of everything the result of ``check_pm`` depends on: the
+    PM, its events, includes, excludes and tasks, and the options.
+    """
+    options = dict((key, value) for key, value in options.items() if key != 'verbosity')
+    job = pack_job(pm, events, tasks, sorted(options.items()))
+    return hashlib.sha1(repr((FINGERPRINT_VERSION, job)).encode("utf-8")).hexdigest()
 
-    populate_index_worksheet(index_worksheet, pms, site_url)
-    workbook.close()
+# The keys of a ``check_pm`` result, except for the rows.
+RESULT_FIELDS = ('pm_id', 'pm_name', 'grouped', 'description', 'rrule', 'ok_count', 'total', 'matches',
+                 'first_mismatch', 'timeout')
 
-def populate_index_worksheet(worksheet, pms, site_url):
+def pack_result(result):
+    """
+    Pack a ``check_pm`` result into a tuple. The rows are turned into
+    columns: task ids, statuses, actual dates, expected dates, ok flags and
+    match kinds.
+    """
+    columns = tuple(list(column) for column in zip(*result['rows'])) or ([], [], [], [], [], [])
+    return tuple(result[field] for field in RESULT_FIELDS) + (columns,)
+
+def unpack_result(packed):
+    result = dict(zip(RESULT_FIELDS, packed))
+    result['rows'] = list(zip(*packed[-1]))
+    return result
+
+class ExcelReport(Report):
+    """
+    Writes the results to an Excel workbook with a worksheet for each PM
+    Schedule and an Index worksheet that links to them.
+    """
+
+    def __init__(self, outputfile, pms, site_url, constant_memory=False, align=False, summary_only=False):
+        self.pms = pms
+        self.site_url = site_url
+        self.align = align
+
+        # With ``summary_only`` only the Index is written, from the results
+        # kept here by PM ID.
+        self.summaries = {} if summary_only else None
+
+        # Seconds used by the PMs that went over their budget, by PM ID
+        self.timeouts = {}
+
+        # In constant memory mode each worksheet is written to a temporary file
+        # row by row. The Index is added first so that it is the first sheet, but
+        # its rows are only written at the end, in order, into its own file.
+        self.workbook = xlsxwriter.Workbook(outputfile, {'constant_memory': constant_memory})
+        self.index_worksheet = self.workbook.add_worksheet(name="Index")
+        if constant_memory:
+            check_constant_memory(self.index_worksheet)
+
+    def add_pm(self, pm, grouped, result):
+        if self.summaries is not None:
+            if result:
+                self.summaries[pm['TRIIDTX']] = result
+        elif result:
+            write_pm_worksheet(self.workbook, result)
+
+        # With streamed rows, only known once the worksheet is written
+        if result and result['timeout'] is not None:
+            self.timeouts[pm['TRIIDTX']] = result['timeout']
+
+    def close(self):
+        populate_index_worksheet(self.index_worksheet, self.pms, self.site_url, get_formats(self.workbook), self.align,
+                                 self.summaries, self.timeouts)
+        self.workbook.close()
+
+def get_formats(workbook):
+    """
+    Returns the cell formats used in the report. They are created once for
+    each workbook.
+    """
+    with _formats_lock:
+        if workbook not in _formats:
+            _formats[workbook] = {
+                'bad': workbook.add_format({'bg_color': '#FFC7CE', 'font_color': '#9C0006'}),
+                'good': workbook.add_format({'bg_color': '#C6EFCE', 'font_color': '#006100'}),
+                'header': workbook.add_format({'bold': True, 'text_wrap': True}),
+                'rrule': workbook.add_format({'text_wrap': True, 'valign': 'top'}),
+            }
+        return _formats[workbook]
+
+def is_grouped(pm):
+    return pm['TRITASKGROUPINGRULELI'] == 'Create Task For Each Asset/Location'
+
+def prefetch(connection, pms, timezone, since=None, until=None, epoch_ms=False):
+    """
+    Get the events and tasks of the given PM Schedules using a few set-based
+    queries.
+
+    Returns a tuple of two dicts, events and tasks, keyed by PM ID. The values
+    are identical to what ``validate_pm`` would query for a single PM.
+    """
+    events = get_events_bulk(connection, [pm['TRIIDTX'] for pm in pms], timezone=timezone)
+    tasks = get_tasks_bulk(connection,
+                           [pm['TRIIDTX'] for pm in pms if not is_grouped(pm)],
+                           [pm['TRIIDTX'] for pm in pms if is_grouped(pm)],
+                           get_window(timezone, since, until),
+                           epoch_ms)
+    return events, tasks
+
+def get_tasks_bulk(connection, pm_ids, grouped_pm_ids, window=None, epoch_ms=False):
+    """
+    Get the tasks of many PM Schedules. Tasks of PMs in ``grouped_pm_ids`` are
+    grouped by planned start date. See ``get_tasks`` for ``window`` and
+    ``epoch_ms``.
+
+    Returns a dict of PM ID to a list of tasks.
+    """
+    tasks = dict()
+
+    for grouped, ids in ((False, pm_ids), (True, grouped_pm_ids)):
+        if not ids:
+            continue
+
+        sql = get_tasks_query(grouped, bulk=True, window=bool(window), epoch_ms=epoch_ms)
+        rows = execute_in(sql, connection, ids, window)
+        tasks.update(group_by(rows, 'PM_ID'))
+
+        # Match the shape of the rows returned by the per-PM queries
+        for row in rows:
+            del row['PM_ID']
+
+    return tasks
+
+def populate_index_worksheet(worksheet, pms, site_url, xlFormats, align=False, summaries=None, timeouts=None):
+    """
+    Write the Index worksheet. The counts are formulas over the table of each
+    PM's worksheet.
+
+    With ``summaries``, a dict of PM ID to ``check_pm`` result from
+    ``--summary-only``, there are no PM worksheets. The counts are values
+    instead and the first invalid task of each PM is added.
+
+    ``timeouts`` is a dict of PM ID to the seconds used by the PMs that went
+    over their budget. If there are any, a Status column marks them TIMEOUT.
+    Their counts only cover the tasks compared before they were stopped.
+    """
+
+    summary_only = summaries is not None
 
     # Widen the columns to make the text clearer.
     worksheet.set_column('A:A', 9)
@@ -122,6 +761,43 @@ def populate_index_worksheet(worksheet, pms, site_url):
     worksheet.set_column('F:F', 13)
     worksheet.set_column('G:G', 13)
 
+    columns = [
+        {'header': 'PM ID'},
+        {'header': 'PM Schedule'},
+        {'header': 'Recurrence'},
+        {'header': 'Task Grouping?'},
+        {'header': 'Valid'},
+        {'header': 'Invalid'},
+        {'header': 'Total'},
+    ]
+
+    if not summary_only:
+        columns.append({'header': 'Details'})
+
+    columns.append({'header': 'View'})
+
+    if align:
+        # Count each kind of mismatch. See ``align_tasks``.
+        worksheet.set_column(len(columns), len(columns) + 2, 12)
+        columns.extend({'header': MATCH_LABELS[kind].title()} for kind in MATCH_KINDS[1:])
+
+    if summary_only:
+        worksheet.set_column(len(columns), len(columns), 12)
+        worksheet.set_column(len(columns) + 1, len(columns) + 2, 24)
+        columns.extend([
+            {'header': 'First Invalid Task'},
+            {'header': 'Planned Start Date'},
+            {'header': 'Expected Date'},
+        ])
+
+    if timeouts:
+        status_column = len(columns)
+        worksheet.set_column(status_column, status_column, 22)
+        columns.append({'header': 'Status'})
+
+    add_table(worksheet, 0, 0, len(pms), len(columns) - 1, { 'style': 'Table Style Light 11',
+                                                              'columns': columns})
+
     for i, pm in enumerate(pms, start=1):
         url = site_url + "/pc/notify/link?recordId=" + str(pm["SPEC_ID"])
 
@@ -130,19 +806,57 @@ def populate_index_worksheet(worksheet, pms, site_url):
         worksheet.write(i, 0, pm["TRIIDTX"])
         worksheet.write(i, 1, pm["TRINAMETX"])
         worksheet.write(i, 2, pm["TRIPMTYPECLASSCL"])
-        worksheet.write(i, 3, "Yes" if pm["TRITASKGROUPINGRULELI"] == "Create Task For Each Asset/Location" else "No")
-        worksheet.write(i, 4, '=COUNTIF({}[Valid?], "OK")'.format(table_name))
-        worksheet.write(i, 5, '=COUNTIF({}[Valid?], "ERROR")'.format(table_name))
-        formula = "={}+{}".format(xl_rowcol_to_cell(i, 4), xl_rowcol_to_cell(i, 5))
-        worksheet.write(i, 6, formula)
-        worksheet.write_url(i, 7,
-                            url="internal:{}!A1".format(pm["TRIIDTX"]),
-                            string="Details",
-                            tip="View details about " + pm["TRIIDTX"])
-        worksheet.write_url(i, 8,
+        worksheet.write(i, 3, "Yes" if is_grouped(pm) else "No")
+
+        if summary_only:
+            result = summaries.get(pm["TRIIDTX"])
+            if result is not None:
+                worksheet.write(i, 4, result['ok_count'])
+                worksheet.write(i, 5, result['total'] - result['ok_count'])
+                worksheet.write(i, 6, result['total'])
+            column = 7
+        else:
+            worksheet.write(i, 4, '=COUNTIF({}[Valid?], "OK")'.format(table_name))
+            if align:
+                worksheet.write(i, 5, '=COUNTIF({}[Valid?], "<>OK")'.format(table_name))
+            else:
+                worksheet.write(i, 5, '=COUNTIF({}[Valid?], "ERROR")'.format(table_name))
+            formula = "={}+{}".format(xl_rowcol_to_cell(i, 4), xl_rowcol_to_cell(i, 5))
+            worksheet.write(i, 6, formula)
+            worksheet.write_url(i, 7,
+                                url="internal:{}!A1".format(pm["TRIIDTX"]),
+                                string="Details",
+                                tip="View details about " + pm["TRIIDTX"])
+            column = 8
+
+        worksheet.write_url(i, column,
                             url=url,
                             string="View",
                             tip="View record " + pm["TRIIDTX"] + " in TRIRIGA")
+        column += 1
+
+        if align:
+            for kind in MATCH_KINDS[1:]:
+                if not summary_only:
+                    worksheet.write(i, column, '=COUNTIF({}[Valid?], "{}")'.format(table_name, MATCH_LABELS[kind]))
+                elif result is not None and result['matches']:
+                    worksheet.write(i, column, result['matches'][kind])
+                column += 1
+
+        if summary_only and result is not None and result['first_mismatch']:
+            task_id, status, actual_date, expected_date, ok, match = result['first_mismatch']
+            worksheet.write(i, column, task_id)
+            worksheet.write(i, column + 1, str(actual_date))
+            worksheet.write(i, column + 2, str(expected_date))
+
+        if timeouts and pm["TRIIDTX"] in timeouts:
+            worksheet.write(i, status_column, "TIMEOUT after {:.1f}s".format(timeouts[pm["TRIIDTX"]]),
+                            xlFormats['bad'])
+            continue
+
+        if summary_only and result is None:
+            # Not validated. Leave it unformatted.
+            continue
 
         cellA = xl_rowcol_to_cell(i, 4, row_abs=True, col_abs=True)
         cellB = xl_rowcol_to_cell(i, 6, row_abs=True, col_abs=True)
@@ -150,85 +864,238 @@ def populate_index_worksheet(worksheet, pms, site_url):
                                                   'criteria': "={}={}".format(cellA, cellB),
                                                   'format': xlFormats['good']})
 
-    worksheet.add_table(0, 0, i, 8, { 'style': 'Table Style Light 11',
-                                      'columns': [
-                                          {'header': 'PM ID'},
-                                          {'header': 'PM Schedule'},
-                                          {'header': 'Recurrence'},
-                                          {'header': 'Task Grouping?'},
-                                          {'header': 'Valid'},
-                                          {'header': 'Invalid'},
-                                          {'header': 'Total'},
-                                          {'header': 'Details'},
-                                          {'header': 'View'},
-                                     ]})
-
     worksheet.activate()
 
-def validate_pm(pm_id, pm_name, workbook, connection, timezone, strip_time=False, working_calendar="8to5", grouped=False, verbosity=1):
+def validate_pm(pm_id, pm_name, workbook, connection, timezone, strip_time=False, working_calendar="8to5", grouped=False, verbosity=1, events=None, tasks=None):
+    """
+    Validate a PM Schedule and write the results to a new worksheet.
 
-    event = get_events(connection, pm_id=pm_id, timezone=timezone)
+    ``events`` and ``tasks`` may be given if they were prefetched (see
+    ``prefetch``). Otherwise they are queried from the database.
+    """
 
-    if len(event) <= 0:
-        raise Exception("No recurrence pattern found for PM: {} {}.".format(pm_id, pm_name))
-    elif len(event) > 1:
-        logging.warning("More than one recurrence patterns found for PM: {} {}. Using the first one.".format(pm_id, pm_name))
+    result = check_pm(pm_id, pm_name, connection, timezone, strip_time,
+                      working_calendar, grouped, verbosity, events, tasks,
+                      stream=True)
 
-    event = event[0]
+    write_pm_worksheet(workbook, result)
+    print_result(result, verbosity)
 
-    rrule, description = parse_event(event, verbosity=verbosity)
+def check_pm(pm_id, pm_name, connection, timezone, strip_time=False, working_calendar="8to5", grouped=False, verbosity=1, events=None, tasks=None, stream=False, since=None, until=None, align=False, epoch_ms=False, summary_only=False, time_budget=None, max_occurrences=None):
+    """
+    Validate a PM Schedule.
 
-    if verbosity >= 1:
-        print(pm_id + ": " + pm_name)
+    This does not touch the workbook, so it is safe to call from many threads
+    as long as each one uses its own connection.
 
-    if verbosity >= 2:
-        print(description)
-        print(str(rrule))
+    Returns a dict with the PM details and a list of rows. Each row is a tuple
+    of (task id, status, actual date, expected date, ok, match). ``match`` is
+    None unless ``align`` is True. See ``align_tasks``.
+
+    If ``stream`` is True, the tasks are read from the database in batches and
+    the rows are a generator that compares each task as it arrives. The
+    ``ok_count`` and ``total`` are only final after all the rows are read.
+    Read the rows before running another query on ``connection``.
 
-    tasks = execute(SQL_GET_TASKS_GROUPED if grouped else SQL_GET_TASKS,
-                    connection,
-                    {'pm_id': pm_id })
+    If ``since`` or ``until`` are given, only the tasks planned to start
+    between them are compared, starting from the first occurrence in that
+    window.
 
-    if len(tasks) == 1 and tasks[0]['TRIPLANNEDSTARTDT'] is None:
+    If ``epoch_ms`` is True, the tasks are queried with TRIPLANNEDSTARTDT in
+    milliseconds since 1970-01-01 UTC (see ``get_tasks``) and the dates are
+    converted and compared a batch at a time. The rows are the same.
+
+    If ``summary_only`` is True, the rows are only counted. ``rows`` is empty
+    and ``first_mismatch`` is the first row that is not ok, or None.
+
+    If expanding the rule and comparing the tasks take more than
+    ``time_budget`` seconds, or the rule has to be expanded to more than
+    ``max_occurrences`` dates, the rows stop there and ``timeout`` is the
+    seconds it used. Fetching the tasks and writing the rows are not counted.
+    Otherwise ``timeout`` is None.
+    """
+
+    budget = None
+    if time_budget or max_occurrences:
+        budget = Budget(time_budget, max_occurrences)
+
+    with span('check_pm', pm_id):
+        if events is None:
+            events = get_events(connection, pm_id=pm_id, timezone=timezone)
+
+        event = events
+
+        if len(event) <= 0:
+            raise Exception("No recurrence pattern found for PM: {} {}.".format(pm_id, pm_name))
+        elif len(event) > 1:
+            logging.warning("More than one recurrence patterns found for PM: {} {}. Using the first one.".format(pm_id, pm_name))
+
+        event = event[0]
+
+        with span('parse'):
+            rrule, description = parse_event(event, verbosity=verbosity)
+
+        result = {
+            'pm_id': pm_id,
+            'pm_name': pm_name,
+            'grouped': grouped,
+            'description': description,
+            # Iterating a rruleset sorts its dates in place. Get the text before that.
+            'rrule': rrule_str(rrule),
+            'rows': None,
+            'ok_count': 0,
+            'total': 0,
+            'matches': None,
+            'first_mismatch': None,
+            'timeout': None,
+        }
+
+        if tasks is None:
+            tasks = get_tasks(connection, pm_id, grouped, stream, get_window(timezone, since, until), epoch_ms)
+
+        tasks = skip_empty_task(tasks, pm_id, verbosity)
+
+        if budget is not None:
+            # Fetching the tasks is not charged to the PM
+            tasks = budget.exclude(tasks)
+
+        if align:
+            rows = align_tasks(result, rrule, tasks, timezone, strip_time, working_calendar, since, grouped, epoch_ms)
+        else:
+            rows = compare_tasks(result, rrule, tasks, timezone, strip_time, working_calendar, since, epoch_ms)
+
+        if budget is not None:
+            rows = within_budget(rows, budget, result)
+
+        if summary_only:
+            for row in rows:
+                if not row[4] and result['first_mismatch'] is None:
+                    result['first_mismatch'] = row
+            result['rows'] = []
+        else:
+            result['rows'] = rows if stream else list(rows)
+
+        return result
+
+def within_budget(rows, budget, result):
+    """
+    Yields the rows with ``budget`` entered. If it runs out, the rows stop
+    there and ``timeout`` of ``result`` is set to the seconds used.
+    """
+    rows = iter(rows)
+    while True:
+        with budget:
+            try:
+                budget.check()
+                row = next(rows)
+            except StopIteration:
+                return
+            except BudgetExceeded as e:
+                result['timeout'] = budget.elapsed()
+                logging.warning("PM Schedule '{}' was stopped after {:.1f} seconds. {}"
+                                .format(result['pm_id'], result['timeout'], e))
+                return
+
+        yield row
+
+def skip_empty_task(tasks, pm_id, verbosity):
+    """
+    A PM Schedule without tasks still gets a single row with no planned start
+    date from the tasks queries. Remove it.
+    """
+    tasks = iter(tasks)
+
+    head = [task for task in (next(tasks, None), next(tasks, None)) if task is not None]
+
+    if len(head) == 1 and head[0]['TRIPLANNEDSTARTDT'] is None:
         if verbosity >= 1:
             logging.warning("PM schedule '{}' does not have any tasks.".format(pm_id))
-        tasks = [] # Allow a dummy sheet to be created
+        return iter([]) # Allow a dummy sheet to be created
+
+    return itertools.chain(head, tasks)
+
+# Number of tasks compared at a time by ``compare_tasks``
+COMPARE_BATCH_SIZE = 500
+
+def compare_tasks(result, rrule, tasks, timezone, strip_time=False, working_calendar="8to5", since=None, epoch_ms=False):
+    """
+    Compare each task against the next occurrence of ``rrule``, starting from
+    the first one that is on or after ``since`` on the working calendar.
 
-    total = 0
-    ok_count = 0
+    If ``epoch_ms`` is True, TRIPLANNEDSTARTDT of the tasks is in milliseconds
+    since 1970-01-01 UTC. See ``compare_batch_ms``.
+
+    Yields a row for each task and updates the counts in ``result``.
+    """
 
     local_tz = pytz.timezone(timezone)
 
-    worksheet = workbook.add_worksheet(name=safe_xl_ws_name(pm_id))
+    # PM Schedules with the same rule share the expanded occurrences
+    occurrences, offset = find_occurrences(rrule, working_calendar, since)
+    tasks = iter(tasks)
 
-    # Widen columns
-    worksheet.set_column('A:A', 12)
-    worksheet.set_column('B:B', 10)
-    worksheet.set_column('C:C', 24)
-    worksheet.set_column('D:D', 24)
-    worksheet.set_column('F:F', 12)
+    while True:
+        batch = list(itertools.islice(tasks, COMPARE_BATCH_SIZE))
+        if not batch:
+            break
 
-    worksheet.write(0, 0, pm_id, xlFormats['header'])
-    worksheet.merge_range(0, 1, 0, 3, pm_name, xlFormats['header'])
-    worksheet.merge_range(1, 0, 1, 3, description, xlFormats['rrule'])
-    worksheet.merge_range(2, 0, 2, 3, rrule_str(rrule), xlFormats['rrule'])
+        if epoch_ms:
+            coerced = occurrences.get_array(offset, offset + len(batch))
+            missing = len(batch) - len(coerced)
+            if missing:
+                # More tasks than occurrences
+                filler = restrict_to_working_calendar_array([datetime.fromtimestamp(0)] * missing, working_calendar)
+                coerced = numpy.concatenate([coerced, filler.astype(numpy.int64)])
 
-    worksheet.write_url(0, 6,
-                        url="internal:Index!A1",
-                        string="Index",
-                        tip="Return to Index page")
+            compared = compare_batch_ms(batch, coerced, get_transition_table(timezone), strip_time)
+        else:
+            expected_dates, coerced_dates = occurrences.get(offset, offset + len(batch))
 
-    worksheet.set_row(2, 30)
+            missing = len(batch) - len(expected_dates)
+            if missing:
+                # More tasks than occurrences
+                filler = [datetime.fromtimestamp(0)] * missing
+                expected_dates = expected_dates + filler
+                coerced_dates = coerced_dates + to_datetimes(restrict_to_working_calendar_array(filler, working_calendar))
 
-    i = 5 # Sometimes the iteration may not run
+            compared = compare_batch(batch, expected_dates, coerced_dates, local_tz, strip_time)
+
+        if is_profiling():
+            compared = compare_now(compared, len(batch))
+
+        offset += len(batch)
+
+        for item, actual_date, expected_date, ok in compared:
+            if ok:
+                result['ok_count'] += 1
+            result['total'] += 1
+
+            yield (item["TASK_ID"], item["TASK_STATUS"], actual_date, expected_date, ok, None)
+
+def compare_now(compared, rows):
+    """
+    Compare a whole batch at once in a ``compare`` span, to time it. Otherwise
+    the tasks are compared as the rows are read. If it fails, the rows before
+    the failure are still yielded.
+    """
+    done = []
+    try:
+        with span('compare', rows=rows):
+            done.extend(compared)
+    except Exception as e:
+        yield from done
+        raise
 
-    rrule_itr = iter(rrule)
-    for i, item in enumerate(tasks, start=5):
-        expected_date = next(rrule_itr, datetime.fromtimestamp(0))
+    yield from done
 
+def compare_batch(batch, expected_dates, coerced_dates, local_tz, strip_time=False):
+    """
+    Compare a batch of tasks with their occurrences, one at a time. Yields
+    the task, the actual and expected dates and whether they match.
+    """
+    for item, expected_date, coerced_date in zip(batch, expected_dates, coerced_dates):
         actual_date = localize_date(item['TRIPLANNEDSTARTDT'], local_tz)
 
-        coerced_date = restrict_to_working_calendar(expected_date, working_calendar)
         # The order of execution is important.
         # ``restrict_to_working_calendar`` method may change the date to fall
         # IN or OUT of DST period. This will change the TZ offset.
@@ -246,44 +1113,568 @@ def validate_pm(pm_id, pm_name, workbook, connection, timezone, strip_time=False
             if actual_date:
                 actual_date = actual_date.date()
 
-        ok = expected_date == actual_date
+        yield item, actual_date, expected_date, expected_date == actual_date
+
+def compare_batch_ms(batch, coerced, table, strip_time=False):
+    """
+    Same as ``compare_batch`` for tasks whose TRIPLANNEDSTARTDT is in
+    milliseconds since 1970-01-01 UTC. ``coerced`` is an array of the local
+    occurrences in microseconds and ``table`` the ``TransitionTable`` of the
+    timezone.
+
+    The whole batch is converted at once and compared as integers: UTC
+    instants or, with ``strip_time``, local days. Only the dates in the rows
+    are made into datetimes.
+    """
+    with span('timezone', rows=len(batch)):
+        actual, has_date = planned_start_us(batch)
+        actual_local, actual_period = table.to_local(actual)
+        expected, expected_period = table.localize(coerced)
+
+    if strip_time:
+        ok = actual_local // US_PER_DAY == coerced // US_PER_DAY
+    else:
+        ok = actual == expected
+    ok &= has_date
+
+    actual_dates = table.to_datetimes(actual_local, actual_period)
+    expected_dates = table.to_datetimes(coerced, expected_period)
+
+    for item, actual_date, expected_date, dated, match in zip(batch, actual_dates, expected_dates,
+                                                               has_date.tolist(), ok.tolist()):
+        if not dated:
+            actual_date = None
+        if strip_time:
+            expected_date = expected_date.date()
+            if actual_date:
+                actual_date = actual_date.date()
+
+        yield item, actual_date, expected_date, match
+
+def planned_start_us(tasks):
+    """
+    Returns the TRIPLANNEDSTARTDT of tasks queried with ``epoch_ms`` as an
+    array of UTC microseconds, and an array of which tasks have one.
+    """
+    planned = [task['TRIPLANNEDSTARTDT'] for task in tasks]
+    has_date = numpy.array([value is not None for value in planned], bool)
+    ms = numpy.array([0 if value is None else value for value in planned], numpy.float64)
+    return numpy.rint(ms).astype(numpy.int64) * 1000, has_date
+
+# The kinds of rows of ``align_tasks`` and how they are shown in the workbook
+MATCH_KINDS = ('matched', 'duplicate', 'missing', 'unexpected')
+MATCH_LABELS = {
+    'matched': 'OK',
+    'duplicate': 'DUPLICATE',
+    'missing': 'MISSING',
+    'unexpected': 'UNEXPECTED',
+}
+
+def align_tasks(result, rrule, tasks, timezone, strip_time=False, working_calendar="8to5", since=None, grouped=False, epoch_ms=False):
+    """
+    Match the tasks to the occurrences of ``rrule`` by date, in one pass over
+    both. Both must be in date order. Each row is one of:
+
+    matched:    the task is on the date of an occurrence
+    duplicate:  the occurrence on that date already has a task
+    missing:    there is no task for an occurrence. Only occurrences up to
+                the last task are checked.
+    unexpected: there is no occurrence on the date of the task
+
+    Grouped tasks are matched by date: all the rows of a date, one for each
+    status with the number of tasks as task id, go to one occurrence. The
+    missing row of a date holds the number of missing occurrences.
+
+    Yields rows like ``compare_tasks`` and counts each kind in
+    ``result['matches']``. See ``compare_tasks`` for ``epoch_ms``.
+    """
+
+    matches = result['matches'] = dict.fromkeys(MATCH_KINDS, 0)
+
+    def row(task_id, status, actual_date, expected_date, match):
+        matches[match] += 1
+        if match == 'matched':
+            result['ok_count'] += 1
+        result['total'] += 1
+        return (task_id, status, actual_date, expected_date, match == 'matched', match)
+
+    def missing(expected_date, count):
+        if grouped:
+            yield row(count, None, None, expected_date, 'missing')
+        else:
+            for n in range(count):
+                yield row(None, None, None, expected_date, 'missing')
+
+    # Tuples of (task, key, date) and (key, date). The dates are compared by
+    # their keys.
+    if epoch_ms:
+        table = get_transition_table(timezone)
+        actual = iter_actual_ms(tasks, table, strip_time)
+        expected = iter_expected_ms(rrule, table, strip_time, working_calendar, since)
+    else:
+        local_tz = pytz.timezone(timezone)
+        actual = ((item, date, date) for item, date in iter_actual(tasks, local_tz, strip_time))
+        expected = ((date, date) for date in iter_expected(rrule, local_tz, strip_time, working_calendar, since))
+
+    next_expected = next(expected, None)
+
+    for key, group in itertools.groupby(actual, key=lambda task: task[1]):
+        if key is None:
+            for item, _, _ in group:
+                yield row(item["TASK_ID"], item["TASK_STATUS"], None, None, 'unexpected')
+            continue
+
+        # Occurrences before this date that have no tasks
+        while next_expected is not None and next_expected[0] < key:
+            (expected_key, date), count = next_expected, 0
+            while next_expected is not None and next_expected[0] == expected_key:
+                count += 1
+                next_expected = next(expected, None)
+            yield from missing(date, count)
+
+        count = 0
+        while next_expected is not None and next_expected[0] == key:
+            count += 1
+            next_expected = next(expected, None)
+
+        remaining = count
+        for item, _, actual_date in group:
+            if count == 0:
+                match = 'unexpected'
+            elif grouped:
+                # One task for each asset, all for the same occurrence
+                match = 'matched'
+                remaining = count - 1
+            elif remaining:
+                match = 'matched'
+                remaining -= 1
+            else:
+                match = 'duplicate'
+
+            yield row(item["TASK_ID"], item["TASK_STATUS"], actual_date,
+                      actual_date if count else None, match)
+
+        if remaining:
+            yield from missing(actual_date, remaining)
+
+def iter_actual(tasks, local_tz, strip_time=False):
+    """
+    Yields each task and its localized planned start date.
+    """
+    for item in tasks:
+        actual_date = localize_date(item['TRIPLANNEDSTARTDT'], local_tz) if item['TRIPLANNEDSTARTDT'] else None
+        if strip_time and actual_date:
+            actual_date = actual_date.date()
+        yield item, actual_date
+
+def iter_actual_ms(tasks, table, strip_time=False):
+    """
+    Same as ``iter_actual`` for tasks queried with ``epoch_ms``, a batch at a
+    time. Yields each task, the key of its date (UTC microseconds or, with
+    ``strip_time``, the local day) and the date.
+    """
+    tasks = iter(tasks)
+    while True:
+        batch = list(itertools.islice(tasks, COMPARE_BATCH_SIZE))
+        if not batch:
+            break
+
+        actual, has_date = planned_start_us(batch)
+        local, period = table.to_local(actual)
+        keys = (local // US_PER_DAY if strip_time else actual).tolist()
+
+        for item, key, date, dated in zip(batch, keys, table.to_datetimes(local, period), has_date.tolist()):
+            if not dated:
+                yield item, None, None
+            else:
+                yield item, key, date.date() if strip_time else date
+
+def iter_expected(rrule, local_tz, strip_time=False, working_calendar="8to5", since=None):
+    """
+    Yields the localized occurrences of ``rrule`` restricted to the working
+    calendar, from the first one on or after ``since``.
+    """
+    occurrences, offset = find_occurrences(rrule, working_calendar, since)
+
+    while True:
+        expected_dates, coerced_dates = occurrences.get(offset, offset + COMPARE_BATCH_SIZE)
+        if not coerced_dates:
+            break
+        offset += len(coerced_dates)
+
+        for coerced_date in coerced_dates:
+            coerced_date = local_tz.localize(coerced_date)
+            yield coerced_date.date() if strip_time else coerced_date
+
+def iter_expected_ms(rrule, table, strip_time=False, working_calendar="8to5", since=None):
+    """
+    Same as ``iter_expected``, a batch at a time. Yields the key of each
+    occurrence, like ``iter_actual_ms``, and its date.
+    """
+    occurrences, offset = find_occurrences(rrule, working_calendar, since)
+
+    while True:
+        coerced = occurrences.get_array(offset, offset + COMPARE_BATCH_SIZE)
+        if not len(coerced):
+            break
+        offset += len(coerced)
+
+        expected, period = table.localize(coerced)
+        dates = table.to_datetimes(coerced, period)
+
+        if strip_time:
+            yield from zip((coerced // US_PER_DAY).tolist(), [date.date() for date in dates])
+        else:
+            yield from zip(expected.tolist(), dates)
+
+def find_occurrences(rrule, working_calendar, since=None):
+    """
+    Returns the shared ``Occurrences`` of ``rrule`` and the position of the
+    first one on or after ``since`` on the working calendar.
+
+    With ``since``, the occurrences start at ``since`` less
+    ``WINDOW_MARGIN``, so the earlier dates are not kept or moved into the
+    working calendar. If the working calendar moved a date from before that
+    past ``since``, all the occurrences are used instead.
+    """
+    if not since:
+        return _occurrences.get(rrule, working_calendar), 0
+
+    occurrences = _occurrences.get(rrule, working_calendar, since)
+    offset = occurrences.find(since)
+    if offset == 0 and occurrences.skipped is not None:
+        moved = to_datetimes(restrict_to_working_calendar_array([occurrences.skipped], working_calendar))[0]
+        if moved >= since:
+            occurrences = _occurrences.get(rrule, working_calendar)
+            offset = occurrences.find(since)
+    return occurrences, offset
+
+class OccurrenceCache:
+    """
+    A bounded LRU cache of the occurrences of recurrence rules, keyed by
+    ``recurrence_signature``, the working calendar and the start of the
+    window. Counts the hits and misses.
+    """
+
+    def __init__(self, maxsize=OCCURRENCE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, rrule, working_calendar, since=None):
+        """
+        Returns the ``Occurrences`` of ``rrule``, from shortly before
+        ``since`` if it is given. A new one is made from ``rrule`` if there is
+        no rule with the same signature and window in the cache.
+        """
+        key = (recurrence_signature(rrule), repr(working_calendar), since)
+
+        with self.lock:
+            occurrences = self.entries.get(key)
+            if occurrences is None or occurrences.broken:
+                self.misses += 1
+                occurrences = self.entries[key] = Occurrences(rrule, working_calendar, since)
+                if len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+
+        return occurrences
+
+class Occurrences:
+    """
+    The dates of a rule and the same dates restricted to the working
+    calendar, also as an array of microseconds. The rule is only expanded as
+    far as it has been asked for.
+
+    With ``since``, the dates before ``since`` less ``WINDOW_MARGIN`` are
+    skipped as the rule is iterated, like ``xafter`` in later versions of
+    dateutil. ``skipped`` is the last of them, or None.
+    """
+
+    def __init__(self, rrule, working_calendar, since=None):
+        self.rule = rrule
+        self.start = since - WINDOW_MARGIN if since else None
+        self.skipped = None
+        self.rrule = self.iterate()
+        self.working_calendar = working_calendar
+        self.expected = []
+        self.coerced = []
+        self.coerced_us = numpy.empty(0, numpy.int64)
+        self.exhausted = False
+        # Expanding the rule was stopped by a budget. The cache replaces it
+        # and ``expand`` starts the rule again.
+        self.broken = False
+        self.lock = threading.Lock()
+
+    def get(self, start, stop):
+        """
+        Returns the expected and coerced dates from ``start`` to ``stop``.
+        There are fewer if the rule ends before ``stop``.
+        """
+        with self.lock:
+            self.expand(stop)
+            return self.expected[start:stop], self.coerced[start:stop]
+
+    def get_array(self, start, stop):
+        """
+        Same as ``get``, but only the coerced dates, in microseconds.
+        """
+        with self.lock:
+            self.expand(stop)
+            return self.coerced_us[start:stop]
+
+    def find(self, date):
+        """
+        Returns the position of the first occurrence that is on or after
+        ``date`` once restricted to the working calendar.
+        """
+        with self.lock:
+            # The coerced dates are in order. Expand in growing steps until
+            # one is past ``date``, then bisect.
+            while not self.exhausted and (not self.coerced or self.coerced[-1] < date):
+                self.expand(max(len(self.expected) * 2, COMPARE_BATCH_SIZE))
+            return bisect.bisect_left(self.coerced, date)
+
+    def expand(self, stop):
+        needed = stop - len(self.expected)
+        if needed > 0 and not self.exhausted:
+            if self.broken:
+                # Stopped by the budget of a PM that shares the rule. Start
+                # the rule again after the dates that are already expanded.
+                self.rrule = itertools.islice(self.iterate(), len(self.expected), None)
+                self.broken = False
+
+            budget = current_budget()
+            with span('expand', rows=needed):
+                if budget is None:
+                    dates = list(itertools.islice(self.rrule, needed))
+                else:
+                    dates = self.expand_within(budget, stop, needed)
+            self.exhausted = len(dates) < needed
+            if dates:
+                with span('calendar', rows=len(dates)):
+                    coerced = restrict_to_working_calendar_array(dates, self.working_calendar)
+                self.expected.extend(dates)
+                self.coerced.extend(to_datetimes(coerced))
+                self.coerced_us = numpy.concatenate([self.coerced_us, coerced.astype(numpy.int64)])
+
+    def iterate(self):
+        """
+        Iterate over the rule from the start of the window.
+        """
+        dates = iter(self.rule)
+        if self.start is None:
+            return dates
+
+        def skip(date):
+            if date < self.start:
+                self.skipped = date
+                return True
+            return False
+
+        return itertools.dropwhile(skip, dates)
+
+    def expand_within(self, budget, stop, needed):
+        with budget.expanding(stop):
+            try:
+                return list(itertools.islice(self.rrule, needed))
+            except BudgetExceeded:
+                self.broken = True
+                raise
+
+_occurrences = OccurrenceCache()
+
+def write_pm_worksheet(workbook, result):
+    """
+    Write the result of ``check_pm`` to a new worksheet.
+    """
+
+    xlFormats = get_formats(workbook)
+
+    pm_id = result['pm_id']
+
+    worksheet = workbook.add_worksheet(name=safe_xl_ws_name(pm_id))
+
+    # Widen columns
+    worksheet.set_column('A:A', 12)
+    worksheet.set_column('B:B', 10)
+    worksheet.set_column('C:C', 24)
+    worksheet.set_column('D:D', 24)
+    worksheet.set_column('F:F', 12)
+
+    # In constant memory mode a row can't be changed once a later row is
+    # written. Write the cells in row order.
+    worksheet.write(0, 0, pm_id, xlFormats['header'])
+    worksheet.merge_range(0, 1, 0, 3, result['pm_name'], xlFormats['header'])
+    worksheet.write_url(0, 6,
+                        url="internal:Index!A1",
+                        string="Index",
+                        tip="Return to Index page")
+    worksheet.merge_range(1, 0, 1, 3, result['description'], xlFormats['rrule'])
+    worksheet.merge_range(2, 0, 2, 3, result['rrule'], xlFormats['rrule'])
+
+    worksheet.set_row(2, 30)
+
+    rows = result['rows']
+    error = None
+
+    if is_constant_memory(worksheet):
+        # The table has to be added before the rows below its header are
+        # written, so the number of rows must be known. Only the rows of this
+        # worksheet are held in memory.
+        rows = []
+        try:
+            rows.extend(result['rows'])
+        except Exception as e:
+            # Write the rows we got, without a table, and then fail
+            error = e
+        else:
+            add_pm_table(worksheet, result, 4 + max(len(rows), 1))
 
-        if ok:
-            ok_count = ok_count + 1
-        total = total + 1
+    i = 5 # Sometimes the iteration may not run
 
-        formula = '=IF({}={},"OK","ERROR")'.format(xl_rowcol_to_cell(i, 2),
-                                                   xl_rowcol_to_cell(i, 3))
+    for i, (task_id, status, actual_date, expected_date, ok, match) in enumerate(rows, start=5):
+        if match is None:
+            formula = '=IF({}={},"OK","ERROR")'.format(xl_rowcol_to_cell(i, 2),
+                                                       xl_rowcol_to_cell(i, 3))
+        else:
+            # Aligned by date. The dates of a duplicate are equal.
+            formula = MATCH_LABELS[match]
 
         formula2 = '=IF(LEFT({},11)=LEFT({},11),"OK","ERROR")'.format(xl_rowcol_to_cell(i, 2),
                                                                       xl_rowcol_to_cell(i, 3))
 
-        worksheet.write(i, 0, item["TASK_ID"])
-        worksheet.write(i, 1, item["TASK_STATUS"])
+        worksheet.write(i, 0, task_id)
+        worksheet.write(i, 1, status)
         worksheet.write(i, 2, str(actual_date))
         worksheet.write(i, 3, str(expected_date))
         worksheet.write(i, 4, formula)
         worksheet.write(i, 5, formula2)
 
-    worksheet.conditional_format(5, 4, i, 5, {'type': 'text',
-                                              'criteria': "containing",
-                                              'value': "ERROR",
-                                              'format': xlFormats['bad']})
-
-    worksheet.add_table(4, 0, i, 5, { 'style': 'Table Style Light 13',
-                                      'name': 'Table' + pm_id,
-                                      'columns': [
-                                          {'header': 'Task Count' if grouped else "Task ID"},
-                                          {'header': 'Status'},
-                                          {'header': 'Planned Start Date'},
-                                          {'header': 'Expected Date'},
-                                          {'header': 'Valid?'},
-                                          {'header': 'Date Valid?'},
-                                     ]})
+    if error is not None:
+        raise error
+
+    if result.get('matches') is None:
+        worksheet.conditional_format(5, 4, i, 5, {'type': 'text',
+                                                  'criteria': "containing",
+                                                  'value': "ERROR",
+                                                  'format': xlFormats['bad']})
+    else:
+        worksheet.conditional_format(5, 4, i, 5, {'type': 'text',
+                                                  'criteria': "not containing",
+                                                  'value': "OK",
+                                                  'format': xlFormats['bad']})
+
+    if is_constant_memory(worksheet):
+        # Done with this worksheet. Don't keep its temporary file open until
+        # the workbook is closed.
+        worksheet._opt_close()
+    else:
+        add_pm_table(worksheet, result, i)
+
+def add_pm_table(worksheet, result, last_row):
+    add_table(worksheet, 4, 0, last_row, 5, { 'style': 'Table Style Light 13',
+                                              'name': 'Table' + result['pm_id'],
+                                              'columns': [
+                                                  {'header': 'Task Count' if result['grouped'] else "Task ID"},
+                                                  {'header': 'Status'},
+                                                  {'header': 'Planned Start Date'},
+                                                  {'header': 'Expected Date'},
+                                                  {'header': 'Valid?'},
+                                                  {'header': 'Date Valid?'},
+                                             ]})
+
+def _constant_memory_attr(worksheet):
+    # xlsxwriter 0.7.7, the version in requirements.txt, calls it
+    # ``optimization``. Later versions call it ``constant_memory``.
+    return 'constant_memory' if hasattr(worksheet, 'constant_memory') else 'optimization'
+
+def check_constant_memory(worksheet):
+    """
+    Tables in constant memory mode turn the private flag of the worksheet off
+    while a table is added, and each worksheet closes its temporary file with
+    ``_opt_close`` once it is written. Fail if this version of xlsxwriter
+    does not have them, instead of writing a broken workbook.
+    """
+    if not hasattr(worksheet, _constant_memory_attr(worksheet)) or not hasattr(worksheet, '_opt_close'):
+        raise CommandError("--constant-memory does not work with xlsxwriter {}. Install the version in "
+                           "requirements.txt.".format(xlsxwriter.__version__))
+
+def is_constant_memory(worksheet):
+    return bool(getattr(worksheet, _constant_memory_attr(worksheet)))
+
+def add_table(worksheet, first_row, first_col, last_row, last_col, options):
+    """
+    Add a table to a worksheet.
+
+    xlsxwriter does not allow tables in constant memory mode because it
+    writes the header row as shared strings. In that mode, call this after
+    the rows above the table and before the rows below its header are written.
+    The header is then written as inline strings.
+    """
+
+    if not is_constant_memory(worksheet):
+        worksheet.add_table(first_row, first_col, last_row, last_col, options)
+        return
+
+    attr = _constant_memory_attr(worksheet)
+
+    headers = [column['header'] for column in options['columns']]
+
+    def write_headers():
+        for col, header in enumerate(headers, start=first_col):
+            worksheet.write_string(first_row, col, header)
+
+    # Moves the rows above the table to disk
+    write_headers()
+
+    setattr(worksheet, attr, False)
+    try:
+        worksheet.add_table(first_row, first_col, last_row, last_col, options)
+    finally:
+        setattr(worksheet, attr, True)
+
+    write_headers()
+
+def print_result(result, verbosity):
+    if verbosity >= 1:
+        print(result['pm_id'] + ": " + result['pm_name'])
+
+    if verbosity >= 2:
+        print(result['description'])
+        print(result['rrule'])
+
+    if verbosity >= 1 and result['timeout'] is not None:
+        print("TIMEOUT after {:.1f} seconds".format(result['timeout']))
 
     if verbosity >= 1:
+        ok_count = result['ok_count']
+        total = result['total']
         print("{} OK. {} Error. Total {}".format(ok_count, total - ok_count, total))
 
+        if result.get('matches'):
+            print(", ".join("{} {}".format(result['matches'][kind], kind) for kind in MATCH_KINDS))
+
+def print_worst(summaries, top=10):
+    """
+    Print the ``top`` PM Schedules with the most invalid tasks. ``summaries``
+    are tuples of (invalid, total, PM ID, first mismatch).
+    """
+    worst = [summary for summary in heapq.nlargest(top, summaries) if summary[0] > 0]
+    if not worst:
+        print("All tasks are valid.")
+        return
+
+    print("PM Schedules with the most invalid tasks:")
+    for invalid, total, pm_id, first_mismatch in worst:
+        task_id, status, actual_date, expected_date, ok, match = first_mismatch
+        print("{}: {} of {} invalid. First: {} planned {}, expected {}".format(
+            pm_id, invalid, total, task_id, actual_date, expected_date))
+
 if __name__ == "__main__":
     main()
 
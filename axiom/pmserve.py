@@ -0,0 +1,286 @@
+"""
+Answer requests to validate or expand a single PM Schedule over HTTP.
+
+The server keeps what a run of ``axiom`` has to set up each time: the
+database session pool, the occurrences of the recurrence rules it has
+expanded (see ``OccurrenceCache``) and the timezone transition tables. Each
+request runs in its own thread with a connection borrowed from the pool.
+
+    GET /validate/<PM ID>   the summary and the rows of ``check_pm``
+    GET /expand/<PM ID>     the occurrences of the recurrence rule
+    GET /health             the uptime, the requests served and the cache
+
+The responses are JSON. Errors are a JSON object with an ``error``.
+"""
+
+import http.server
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+
+from argh.exceptions import CommandError
+from datetime import datetime
+
+from .budget import Budget, BudgetExceeded
+from .calendars import get_working_calendar
+from .commands import parse_date
+from .export import iso_dates
+from .ora_helper import parse_db_url, set_arraysize, pooled_connection
+from .pmeventparser import get_events, parse_event, rrule_str, to_datetime64
+from .pmschedulevalidator import check_pm, find_occurrences, get_pms, is_grouped, _occurrences
+from .reports import task_row, summary_row
+from .snapshot import SnapshotPool
+from .timezones import get_transition_table
+
+def serve(
+        db_url=None,
+        from_snapshot=None,
+        host=None,
+        port=None,
+        socket=None,
+        workers=None,
+        timezone=None,
+        working_calendar=None,
+        calendar_file=None,
+        time_budget=None,
+        arraysize=None
+    ):
+    """
+    Runs ``axiom serve``. The arguments are declared in ``commands.serve``.
+    """
+
+    set_arraysize(arraysize)
+
+    if from_snapshot:
+        pool = SnapshotPool(from_snapshot)
+    else:
+        db = parse_db_url(db_url)
+        logging.debug("Using database connection: " + str(db))
+        pool = db.get_pool(workers)
+
+    service = Service(pool, timezone, get_working_calendar(working_calendar, calendar_file), time_budget)
+
+    # Load the timezone data before the first request
+    get_transition_table(timezone)
+
+    server = make_server(service, host, port, socket)
+    print("Serving on {}".format(socket or "http://{}:{}".format(*server.server_address[:2])))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket and os.path.exists(socket):
+            os.remove(socket)
+
+class RequestError(Exception):
+    """
+    A request that can't be answered. ``status`` is the HTTP status.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class Service:
+    """
+    Answers the requests. It is shared by the threads of the server.
+    """
+
+    def __init__(self, pool, timezone, working_calendar, time_budget=None):
+        self.pool = pool
+        self.timezone = timezone
+        self.working_calendar = working_calendar
+        self.time_budget = time_budget
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def handle(self, path):
+        """
+        Returns the HTTP status and the JSON response of a GET of ``path``.
+        """
+        url = urllib.parse.urlsplit(path)
+        parts = [urllib.parse.unquote(part) for part in url.path.split("/") if part]
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        try:
+            if parts == ['health']:
+                response = self.health()
+            elif len(parts) == 2 and parts[0] == 'validate':
+                response = self.validate(parts[1], **query_options(query, VALIDATE_OPTIONS))
+            elif len(parts) == 2 and parts[0] == 'expand':
+                response = self.expand(parts[1], **query_options(query, EXPAND_OPTIONS))
+            else:
+                raise RequestError(404, "Unknown request '{}'. Use /validate/<PM ID>, /expand/<PM ID> or /health."
+                                   .format(url.path))
+            status = 200
+        except RequestError as e:
+            status, response = e.status, {'error': str(e)}
+        except BudgetExceeded as e:
+            status, response = 503, {'error': str(e)}
+        except Exception as e:
+            logging.exception("Unable to answer '{}'.".format(path))
+            status, response = 500, {'error': str(e)}
+
+        with self.lock:
+            self.requests += 1
+            if status != 200:
+                self.errors += 1
+
+        return status, response
+
+    def get_pm(self, connection, pm_id):
+        pms = get_pms(connection, [pm_id])
+        if not pms:
+            raise RequestError(404, "PM Schedule '{}' was not found.".format(pm_id))
+        return pms[0]
+
+    def validate(self, pm_id, since=None, until=None, align=False, summary_only=False):
+        with pooled_connection(self.pool) as connection:
+            pm = self.get_pm(connection, pm_id)
+            result = check_pm(pm['TRIIDTX'], pm['TRINAMETX'], connection, self.timezone,
+                              working_calendar=self.working_calendar,
+                              grouped=is_grouped(pm),
+                              verbosity=0,
+                              since=since,
+                              until=until,
+                              align=align,
+                              summary_only=summary_only,
+                              time_budget=self.time_budget)
+
+        response = summary_row(pm, is_grouped(pm), result)
+        response['rows'] = [task_row(pm['TRIIDTX'], row) for row in result['rows']]
+        if result['first_mismatch'] is not None:
+            response['first_mismatch'] = task_row(pm['TRIIDTX'], result['first_mismatch'])
+        return response
+
+    def expand(self, pm_id, count=100, since=None, until=None):
+        with pooled_connection(self.pool) as connection:
+            pm = self.get_pm(connection, pm_id)
+            events = get_events(connection, pm_id=pm['TRIIDTX'], timezone=self.timezone)
+
+        rules, description = parse_event(events[0], verbosity=0)
+        rrule = rrule_str(rules)
+
+        # The occurrences are shared with the validations through the cache
+        with Budget(self.time_budget):
+            occurrences, start = find_occurrences(rules, self.working_calendar, since)
+            expected, coerced = occurrences.get(start, start + count)
+
+        if until:
+            expected = [date for date, working_date in zip(expected, coerced) if working_date < until]
+            coerced = coerced[:len(expected)]
+
+        return {
+            'pm_id': pm['TRIIDTX'],
+            'pm_name': pm['TRINAMETX'],
+            'description': description,
+            'rrule': rrule,
+            'timezone': self.timezone,
+            'occurrences': [{'date': date, 'working_date': working_date}
+                            for date, working_date in zip(iso_dates(to_datetime64(expected), self.timezone),
+                                                          iso_dates(to_datetime64(coerced), self.timezone))],
+        }
+
+    def health(self):
+        with self.lock:
+            requests, errors = self.requests, self.errors
+        return {
+            'uptime': round(time.time() - self.started, 1),
+            'requests': requests,
+            'errors': errors,
+            'cache': {
+                'rules': len(_occurrences.entries),
+                'hits': _occurrences.hits,
+                'misses': _occurrences.misses,
+            },
+        }
+
+def parse_bool(value):
+    return value.lower() in ('1', 'true', 'yes')
+
+# The query parameters of each request and how to read them
+VALIDATE_OPTIONS = {
+    'since': parse_date,
+    'until': parse_date,
+    'align': parse_bool,
+    'summary_only': parse_bool,
+}
+
+EXPAND_OPTIONS = {
+    'count': int,
+    'since': parse_date,
+    'until': parse_date,
+}
+
+def query_options(query, options):
+    """
+    Convert the query parameters of a request with ``options``.
+    """
+    values = {}
+    for name, value in query.items():
+        name = name.replace("-", "_")
+        if name not in options:
+            raise RequestError(400, "Unknown parameter '{}'. Use: {}".format(name, ", ".join(sorted(options))))
+        try:
+            values[name] = options[name](value)
+        except Exception:
+            raise RequestError(400, "Invalid {}: '{}'".format(name, value))
+    return values
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+
+    # Set on the subclass made by ``make_server``
+    service = None
+
+    def do_GET(self):
+        status, response = self.service.handle(self.path)
+        body = json.dumps(response, default=json_default).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # A Unix socket has no client address
+        return self.client_address[0] if self.client_address else "-"
+
+    def log_message(self, format, *args):
+        logging.info("%s %s", self.address_string(), format % args)
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+
+def make_server(service, host="127.0.0.1", port=8642, socket_path=None):
+    """
+    A threaded HTTP server that answers with ``service``, on a Unix socket
+    if ``socket_path`` is given.
+    """
+    handler = type('ServiceRequestHandler', (RequestHandler,), {'service': service})
+
+    if socket_path:
+        if not hasattr(socket, 'AF_UNIX'):
+            raise CommandError("Unix sockets are not supported on this system. Use --port.")
+        return UnixHTTPServer(socket_path, handler)
+
+    return http.server.ThreadingHTTPServer((host, port), handler)
@@ -0,0 +1,70 @@
+"""
+Save the TRIRIGA data that Axiom needs to a local snapshot file
+"""
+
+import logging
+
+from argh.exceptions import CommandError
+from datetime import datetime
+from tqdm import tqdm
+
+from .ora_helper import execute_in, parse_db_url, set_verbosity, set_arraysize
+from .pmschedulevalidator import get_pms, is_grouped
+from .queries import SQL_GET_EVENTS_BULK, SQL_GET_INCLUDES_BULK, SQL_GET_EXCLUDES_BULK
+from .queries import SQL_GET_TASKS_BULK, SQL_GET_TASKS_GROUPED_BULK
+from .snapshot import create_snapshot, write_rows
+
+def snapshot(
+        pm_id,
+        id_file=None,
+        db_url=None,
+        outputfile=None,
+        chunk_size=None,
+        arraysize=None,
+        verbosity=None
+    ):
+    """
+    Runs ``axiom snapshot``. The arguments are declared in ``commands.snapshot``.
+    """
+
+    set_verbosity(verbosity)
+    set_arraysize(arraysize)
+
+    db = parse_db_url(db_url)
+    logging.debug("Using database connection: " + str(db))
+    connection = db.get_connection()
+
+    pms = get_pms(connection, pm_id, id_file)
+
+    if len(pms) <= 0:
+        raise CommandError("No PM Schedules found in {}".format(db))
+
+    out = create_snapshot(outputfile)
+
+    write_rows(out, 'pmscheds', 'TRIIDTX', pms)
+
+    for i in tqdm(range(0, len(pms), chunk_size)):
+        chunk = pms[i:i + chunk_size]
+
+        pm_ids = [pm['TRIIDTX'] for pm in chunk]
+        write_rows(out, 'events', 'PM_ID', execute_in(SQL_GET_EVENTS_BULK, connection, pm_ids))
+        write_rows(out, 'includes', 'SPEC_ID', execute_in(SQL_GET_INCLUDES_BULK, connection, pm_ids))
+        write_rows(out, 'excludes', 'SPEC_ID', execute_in(SQL_GET_EXCLUDES_BULK, connection, pm_ids))
+
+        # Only the tasks query used for each PM Schedule is saved
+        for table, sql, grouped in [('tasks', SQL_GET_TASKS_BULK, False),
+                                    ('tasks_grouped', SQL_GET_TASKS_GROUPED_BULK, True)]:
+            ids = [pm['TRIIDTX'] for pm in chunk if is_grouped(pm) == grouped]
+            if ids:
+                write_rows(out, table, 'PM_ID', execute_in(sql, connection, ids))
+
+        out.commit()
+
+    out.executemany("INSERT INTO meta VALUES (?, ?)",
+                    [('created', datetime.now().isoformat()),
+                     ('source', "{}:{}:{}".format(db.host, db.port, db.sid or db.service_name)),
+                     ('pm_count', str(len(pms)))])
+    out.commit()
+    out.close()
+
+    print("Saved {} PM Schedules to {}".format(len(pms), outputfile))
@@ -0,0 +1,229 @@
+"""
+Timed spans for ``--profile``.
+
+``span(stage, name)`` is a context manager that records how long its block
+took and in which thread. When a profile is stopped the spans are written as
+a Chrome trace, which can be opened in chrome://tracing or
+https://ui.perfetto.dev, and summed up for each stage in a text file.
+
+When no profile is being recorded ``span`` returns a shared object that does
+nothing, so the spans can stay in the code.
+
+The stages are:
+
+    query       running a statement of ``queries.py``, named after it
+    fetch       reading rows of a query
+    check_pm    validating a PM Schedule, named after it
+    parse       ``parse_event``
+    expand      expanding a recurrence rule
+    calendar    restricting occurrences to the working calendar
+    timezone    converting a batch of dates with ``--epoch-ms``
+    compare     comparing a batch of tasks with their occurrences
+    write       writing the worksheet of a PM Schedule, named after it
+
+Spans nest. The summary gives both the total time of each stage and its self
+time, which leaves out the spans inside it.
+"""
+
+import collections
+import cProfile
+import json
+import os
+import threading
+import time
+
+from .queries import match_query
+
+# The profile being recorded, if any
+_profile = None
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **args):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+def is_profiling():
+    return _profile is not None
+
+def span(stage, name=None, **args):
+    """
+    Returns a context manager that records a span of ``stage`` with an
+    optional ``name`` and ``args`` to show in the trace.
+    """
+    profile = _profile
+    if profile is None:
+        return _NULL_SPAN
+    return Span(profile, stage, name or stage, args)
+
+def query_span(sql):
+    """
+    A ``query`` span named after the statement of ``queries.py`` that ``sql``
+    is. The statement is only looked up while profiling.
+    """
+    profile = _profile
+    if profile is None:
+        return _NULL_SPAN
+    return Span(profile, 'query', match_query(sql)[0] or "SQL", {})
+
+class Span:
+    __slots__ = ('profile', 'stage', 'name', 'args', 'start')
+
+    def __init__(self, profile, stage, name, args):
+        self.profile = profile
+        self.stage = stage
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.add(self, time.perf_counter())
+        return False
+
+    def set(self, **args):
+        """
+        Add arguments to show in the trace, e.g. the number of rows.
+        """
+        self.args.update(args)
+
+def start(filename, cprofile_file=None):
+    """
+    Start recording spans to ``filename``. If ``cprofile_file`` is given,
+    this thread is also profiled with ``cProfile`` and the stats are saved to
+    that file. Either can be None.
+    """
+    global _profile
+    _profile = Profile(filename, cprofile_file)
+    return _profile
+
+def stop():
+    """
+    Stop recording and write the trace and the summary. Returns the text of
+    the summary, or None if there is no trace file.
+    """
+    global _profile
+    profile = _profile
+    _profile = None
+    return profile.close()
+
+class Profile:
+    """
+    The spans recorded since ``start``.
+    """
+
+    def __init__(self, filename, cprofile_file=None):
+        self.filename = filename
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        # (stage, name, thread id, start, end, args). Appending to a list is
+        # safe from many threads.
+        self.spans = []
+        self.thread_names = {}
+
+        self.cprofile_file = cprofile_file
+        self.cprofile = None
+        if cprofile_file:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def add(self, span, end):
+        thread = threading.current_thread()
+        if thread.ident not in self.thread_names:
+            self.thread_names[thread.ident] = thread.name
+        self.spans.append((span.stage, span.name, thread.ident, span.start, end, span.args))
+
+    def close(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_file)
+
+        if not self.filename:
+            return None
+
+        elapsed = time.perf_counter() - self.origin
+
+        with open(self.filename, "w", encoding="utf-8") as f:
+            json.dump(self.trace(), f)
+
+        summary = self.summary(elapsed)
+        with open(summary_file_name(self.filename), "w", encoding="utf-8") as f:
+            f.write(summary)
+
+        return summary
+
+    def trace(self):
+        """
+        The spans in the Chrome trace event format.
+        """
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}}
+                  for tid, name in self.thread_names.items()]
+
+        for stage, name, tid, start, end, args in self.spans:
+            events.append({
+                'name': name,
+                'cat': stage,
+                'ph': 'X',
+                'ts': (start - self.origin) * 1000000,
+                'dur': (end - start) * 1000000,
+                'pid': self.pid,
+                'tid': tid,
+                'args': args,
+            })
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def self_times(self):
+        """
+        The time of each span less the time of the spans directly inside it
+        in the same thread.
+        """
+        times = [end - start for stage, name, tid, start, end, args in self.spans]
+
+        by_thread = collections.defaultdict(list)
+        for i, (stage, name, tid, start, end, args) in enumerate(self.spans):
+            by_thread[tid].append(i)
+
+        for indexes in by_thread.values():
+            # Outer spans first
+            indexes.sort(key=lambda i: (self.spans[i][3], -self.spans[i][4]))
+            stack = []
+            for i in indexes:
+                start, end = self.spans[i][3:5]
+                while stack and self.spans[stack[-1]][4] <= start:
+                    stack.pop()
+                if stack:
+                    times[stack[-1]] -= end - start
+                stack.append(i)
+
+        return times
+
+    def summary(self, elapsed):
+        """
+        A table of the count, total and self time of each stage.
+        """
+        stages = collections.OrderedDict()
+        for (stage, name, tid, start, end, args), self_time in zip(self.spans, self.self_times()):
+            count, total, self_total, longest = stages.get(stage, (0, 0.0, 0.0, 0.0))
+            stages[stage] = (count + 1, total + end - start, self_total + self_time, max(longest, end - start))
+
+        lines = ["Elapsed: {:.3f}s in {} spans".format(elapsed, len(self.spans)),
+                 "",
+                 "{:<10} {:>8} {:>10} {:>10} {:>7} {:>10}".format("Stage", "Count", "Total (s)", "Self (s)", "Self %",
+                                                                  "Max (ms)")]
+        for stage, (count, total, self_total, longest) in sorted(stages.items(), key=lambda item: -item[1][2]):
+            lines.append("{:<10} {:>8} {:>10.3f} {:>10.3f} {:>7.1%} {:>10.1f}".format(
+                stage, count, total, self_total, self_total / elapsed if elapsed else 0, longest * 1000))
+
+        return "\n".join(lines) + "\n"
+
+def summary_file_name(filename):
+    return os.path.splitext(filename)[0] + "-summary.txt"
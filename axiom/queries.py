@@ -1,3 +1,5 @@
+import re
+
 SQL_GET_PMSCHEDS = """
 SELECT
     SCHED.TRIIDTX,
@@ -24,6 +26,8 @@ ORDER BY
     SCHED.TRIIDTX
 """
 
+# ``{}`` is replaced with a list of bind variables holding the PM IDs. See
+# ``ora_helper.bind_chunks``.
 SQL_GET_PMSCHEDS_FILTERED = """
 SELECT
     SCHED.TRIIDTX,
@@ -218,6 +222,112 @@ WHERE
     SCHED.TRIIDTX = :pm_id
 """
 
+# The columns of an event that ``parse_event`` uses.
+RECURRENCE_FIELDS = (
+    'EVENTSTARTDATE',
+    'EVENTENDDATE',
+    'EVENTDURATION',
+    'RECURRENCEPATTERNTYPE',
+    'TRIRECURRENCEENDOPTI',
+    'TRIRECURRENCEDAILYOP',
+    'DAILYRECURRENCEDAYS',
+    'WEEKLYRECURRENCEWEEKS',
+    'WEEKLYSUNDAY',
+    'WEEKLYMONDAY',
+    'WEEKLYTUESDAY',
+    'WEEKLYWEDNESDAY',
+    'WEEKLYTHURSDAY',
+    'WEEKLYFRIDAY',
+    'WEEKLYSATURDAY',
+    'TRIRECURRENCEMONTHLY',
+    'MONTHLYDAYOFMONTH',
+    'MONTHLYRECURRENCEMON',
+    'MONTHLYDAYOFWEEK',
+    'MONTHLYWEEKOFMONTH',
+    'TRIJANUARYBL',
+    'TRIFEBRUARYBL',
+    'TRIMARCHBL',
+    'TRIAPRILBL',
+    'TRIMAYBL',
+    'TRIJUNEBL',
+    'TRIJULYBL',
+    'TRIAUGUSTBL',
+    'TRISEPTEMBERBL',
+    'TRIOCTOBERBL',
+    'TRINOVEMBERBL',
+    'TRIDECEMBERBL',
+    'TRIRECURRENCEYEARLYO',
+    'YEARLYDAYOFMONTH',
+    'YEARLYMONTH',
+    'YEARLYDAYOFWEEK',
+    'YEARLYWEEKOFMONTH',
+)
+
+# The columns of SQL_GET_RECURRENCES, in order.
+EVENT_FIELDS = ('PM_ID', 'PM_NAME', 'EVENT_SPEC_ID', 'TRIBUILDINGTX') + RECURRENCE_FIELDS
+
+# Same as SQL_GET_EVENTS, but only the columns in EVENT_FIELDS. The text
+# columns, like NOTES and EVENTINSTRUCTION, are left out.
+SQL_GET_RECURRENCES = """
+SELECT
+    SCHED.TRIIDTX AS PM_ID,
+    SCHED.TRINAMETX AS PM_NAME,
+    EVENT.SPEC_ID EVENT_SPEC_ID,
+    EVENT.TRIBUILDINGTX TRIBUILDINGTX,
+    TO_DATE('1970-01-01', 'YYYY-MM-DD') + EVENT.EVENTSTARTDATE / 86400000 as EVENTSTARTDATE,
+    TO_DATE('1970-01-01', 'YYYY-MM-DD') + EVENT.EVENTENDDATE / 86400000 as EVENTENDDATE,
+    EVENT.EVENTDURATION EVENTDURATION,
+    EVENT.RECURRENCEPATTERNTYPE RECURRENCEPATTERNTYPE,
+    EVENT.TRIRECURRENCEENDOPTI TRIRECURRENCEENDOPTI,
+    EVENT.TRIRECURRENCEDAILYOP TRIRECURRENCEDAILYOP,
+    EVENT.DAILYRECURRENCEDAYS DAILYRECURRENCEDAYS,
+    EVENT.WEEKLYRECURRENCEWEEKS WEEKLYRECURRENCEWEEKS,
+    EVENT.WEEKLYSUNDAY WEEKLYSUNDAY,
+    EVENT.WEEKLYMONDAY WEEKLYMONDAY,
+    EVENT.WEEKLYTUESDAY WEEKLYTUESDAY,
+    EVENT.WEEKLYWEDNESDAY WEEKLYWEDNESDAY,
+    EVENT.WEEKLYTHURSDAY WEEKLYTHURSDAY,
+    EVENT.WEEKLYFRIDAY WEEKLYFRIDAY,
+    EVENT.WEEKLYSATURDAY WEEKLYSATURDAY,
+    EVENT.TRIRECURRENCEMONTHLY TRIRECURRENCEMONTHLY,
+    EVENT.MONTHLYDAYOFMONTH MONTHLYDAYOFMONTH,
+    EVENT.MONTHLYRECURRENCEMON MONTHLYRECURRENCEMON,
+    EVENT.MONTHLYDAYOFWEEK MONTHLYDAYOFWEEK,
+    EVENT.MONTHLYWEEKOFMONTH MONTHLYWEEKOFMONTH,
+    EVENT.TRIJANUARYBL TRIJANUARYBL,
+    EVENT.TRIFEBRUARYBL TRIFEBRUARYBL,
+    EVENT.TRIMARCHBL TRIMARCHBL,
+    EVENT.TRIAPRILBL TRIAPRILBL,
+    EVENT.TRIMAYBL TRIMAYBL,
+    EVENT.TRIJUNEBL TRIJUNEBL,
+    EVENT.TRIJULYBL TRIJULYBL,
+    EVENT.TRIAUGUSTBL TRIAUGUSTBL,
+    EVENT.TRISEPTEMBERBL TRISEPTEMBERBL,
+    EVENT.TRIOCTOBERBL TRIOCTOBERBL,
+    EVENT.TRINOVEMBERBL TRINOVEMBERBL,
+    EVENT.TRIDECEMBERBL TRIDECEMBERBL,
+    EVENT.TRIRECURRENCEYEARLYO TRIRECURRENCEYEARLYO,
+    EVENT.YEARLYDAYOFMONTH YEARLYDAYOFMONTH,
+    EVENT.YEARLYMONTH YEARLYMONTH,
+    EVENT.YEARLYDAYOFWEEK YEARLYDAYOFWEEK,
+    EVENT.YEARLYWEEKOFMONTH YEARLYWEEKOFMONTH
+FROM
+    T_PMEVENT EVENT
+LEFT OUTER JOIN IBS_SPEC_ASSIGNMENTS ASSN1
+ON
+    EVENT.SPEC_ID = ASSN1.SPEC_ID
+AND
+    ASSN1.ASS_TYPE = 'Event For'
+LEFT OUTER JOIN T_TRIPMSCHEDULE SCHED
+ON
+    SCHED.SPEC_ID = ASSN1.ASS_SPEC_ID
+"""
+
+SQL_GET_RECURRENCE = SQL_GET_RECURRENCES + """
+WHERE
+    SCHED.TRIIDTX = :pm_id
+"""
+
 SQL_GET_INCLUDES = """
 SELECT
     EVENT.SPEC_ID,
@@ -254,3 +364,237 @@ ON
 WHERE
     EVENT.SPEC_ID = :event_spec_id
 """
+
+# Set-based variants of the per-PM queries above. They are used to prefetch
+# the data for many PM Schedules at once. ``{}`` is replaced with a list of
+# bind variables (see ``ora_helper.bind_chunks``) holding the PM IDs.
+
+SQL_GET_EVENTS_BULK = SQL_GET_EVENTS + """
+WHERE
+    SCHED.TRIIDTX IN ({})
+"""
+
+SQL_GET_RECURRENCES_BULK = SQL_GET_RECURRENCES + """
+WHERE
+    SCHED.TRIIDTX IN ({})
+"""
+
+SQL_GET_INCLUDES_BULK = """
+SELECT
+    EVENT.SPEC_ID,
+    TO_DATE('1970-01-01', 'YYYY-MM-DD') + INCLUDES.TRISTARTDT / 86400000 as INC_STARTDT
+FROM
+    T_TRIDATERANGE INCLUDES
+LEFT OUTER JOIN IBS_SPEC_ASSIGNMENTS ASSN1
+ON
+    INCLUDES.SPEC_ID = ASSN1.SPEC_ID
+AND
+    ASSN1.ASS_TYPE = 'Included In'
+LEFT OUTER JOIN T_PMEVENT EVENT
+ON
+    EVENT.SPEC_ID = ASSN1.ASS_SPEC_ID
+WHERE
+    EVENT.SPEC_ID IN (
+        SELECT
+            ASSN2.SPEC_ID
+        FROM
+            IBS_SPEC_ASSIGNMENTS ASSN2
+        JOIN T_TRIPMSCHEDULE SCHED
+        ON
+            SCHED.SPEC_ID = ASSN2.ASS_SPEC_ID
+        WHERE
+            ASSN2.ASS_TYPE = 'Event For'
+        AND
+            SCHED.TRIIDTX IN ({})
+    )
+"""
+
+SQL_GET_EXCLUDES_BULK = """
+SELECT
+    EVENT.SPEC_ID,
+    TO_DATE('1970-01-01', 'YYYY-MM-DD') + EXCLUDES.TRISTARTDT / 86400000 as EXCL_STARTDT,
+    TO_DATE('1970-01-01', 'YYYY-MM-DD') + EXCLUDES.TRIENDDT / 86400000 as EXCL_ENDDT
+FROM
+    T_TRIDATERANGE EXCLUDES
+LEFT OUTER JOIN IBS_SPEC_ASSIGNMENTS ASSN1
+ON
+    EXCLUDES.SPEC_ID = ASSN1.SPEC_ID
+AND
+    ASSN1.ASS_TYPE = 'Excluded From'
+LEFT OUTER JOIN T_PMEVENT EVENT
+ON
+    EVENT.SPEC_ID = ASSN1.ASS_SPEC_ID
+WHERE
+    EVENT.SPEC_ID IN (
+        SELECT
+            ASSN2.SPEC_ID
+        FROM
+            IBS_SPEC_ASSIGNMENTS ASSN2
+        JOIN T_TRIPMSCHEDULE SCHED
+        ON
+            SCHED.SPEC_ID = ASSN2.ASS_SPEC_ID
+        WHERE
+            ASSN2.ASS_TYPE = 'Event For'
+        AND
+            SCHED.TRIIDTX IN ({})
+    )
+"""
+
+SQL_GET_TASKS_BULK = """
+SELECT
+    SCHED.TRIIDTX AS PM_ID,
+    SCHED.TRINAMETX,
+    SCHED.TRIREQUESTCLASSTX,
+    SCHED.TRIPMSCHEDULETYPELI,
+    SCHED.TRIPMTYPECLASSCL,
+    TO_DATE('1970-01-01', 'YYYY-MM-DD') + TASK.TRIPLANNEDSTARTDT / 86400000 as TRIPLANNEDSTARTDT,
+    TASK.TRINAMETX AS TASK_NAME,
+    TASK.TRIIDTX AS TASK_ID,
+    TASK.TRISTATUSCL AS TASK_STATUS
+FROM
+    T_TRIPMSCHEDULE SCHED
+LEFT OUTER JOIN IBS_SPEC_ASSIGNMENTS ASSN
+ON
+    SCHED.SPEC_ID = ASSN.SPEC_ID
+AND
+    ASSN.ASS_TYPE = 'Schedule For'
+AND
+    ASSN.ASS_SPEC_TEMPLATE_ID = 10008284
+LEFT OUTER JOIN T_TRIWORKTASK TASK
+ON
+    TASK.SPEC_ID = ASSN.ASS_SPEC_ID
+WHERE SCHED.TRIIDTX IN ({})
+ORDER BY
+    SCHED.TRIIDTX,
+    TASK.TRIPLANNEDSTARTDT
+"""
+
+SQL_GET_TASKS_GROUPED_BULK = """
+SELECT
+    PM_ID,
+    TRINAMETX,
+    TRIREQUESTCLASSTX,
+    TRIPMSCHEDULETYPELI,
+    TRIPMTYPECLASSCL,
+    TRIPLANNEDSTARTDT,
+    TASK_NAME,
+    COUNT(TASK_ID) AS TASK_ID,
+    TASK_STATUS
+FROM
+    (
+        SELECT
+            SCHED.TRIIDTX    AS PM_ID,
+            SCHED.TRINAMETX,
+            SCHED.TRIREQUESTCLASSTX,
+            SCHED.TRIPMSCHEDULETYPELI,
+            SCHED.TRIPMTYPECLASSCL,
+            TO_DATE('1970-01-01', 'YYYY-MM-DD') + TASK.TRIPLANNEDSTARTDT /
+            86400000         AS TRIPLANNEDSTARTDT,
+            TASK.TRINAMETX   AS TASK_NAME,
+            TASK.TRIIDTX     AS TASK_ID,
+            TASK.TRISTATUSCL AS TASK_STATUS
+        FROM
+            T_TRIPMSCHEDULE SCHED
+        LEFT OUTER JOIN IBS_SPEC_ASSIGNMENTS ASSN
+        ON
+            SCHED.SPEC_ID = ASSN.SPEC_ID
+        AND
+            ASSN.ASS_TYPE = 'Schedule For'
+        AND
+            ASSN.ASS_SPEC_TEMPLATE_ID = 10008284
+        LEFT OUTER JOIN T_TRIWORKTASK TASK
+        ON
+            TASK.SPEC_ID = ASSN.ASS_SPEC_ID
+        WHERE
+            SCHED.TRIIDTX IN ({})
+    )
+GROUP BY
+    PM_ID,
+    TRINAMETX,
+    TRIREQUESTCLASSTX,
+    TRIPMSCHEDULETYPELI,
+    TRIPMTYPECLASSCL,
+    TRIPLANNEDSTARTDT,
+    TASK_NAME,
+    TASK_STATUS
+ORDER BY
+    PM_ID,
+    TRIPLANNEDSTARTDT
+"""
+
+# Variants of the tasks queries that only return the tasks planned to start
+# in a window. ``:since_ms`` and ``:until_ms`` are milliseconds since
+# 1970-01-01 UTC, like the column.
+
+def add_task_window(sql, where, indent=""):
+    """
+    Add the window to ``sql``, after the ``where`` condition line.
+    """
+    window = (indent + "AND\n" +
+              indent + "    TASK.TRIPLANNEDSTARTDT >= :since_ms\n" +
+              indent + "AND\n" +
+              indent + "    TASK.TRIPLANNEDSTARTDT < :until_ms\n")
+    if where not in sql:
+        raise Exception("'{}' is not in the query.".format(where.strip()))
+    return sql.replace(where, where + window, 1)
+
+SQL_GET_TASKS_WINDOW = add_task_window(SQL_GET_TASKS,
+    "WHERE SCHED.TRIIDTX = :pm_id\n")
+
+SQL_GET_TASKS_GROUPED_WINDOW = add_task_window(SQL_GET_TASKS_GROUPED,
+    "            SCHED.TRIIDTX = :pm_id\n", indent="        ")
+
+SQL_GET_TASKS_BULK_WINDOW = add_task_window(SQL_GET_TASKS_BULK,
+    "WHERE SCHED.TRIIDTX IN ({})\n")
+
+SQL_GET_TASKS_GROUPED_BULK_WINDOW = add_task_window(SQL_GET_TASKS_GROUPED_BULK,
+    "            SCHED.TRIIDTX IN ({})\n", indent="        ")
+
+def planned_start_ms(sql):
+    """
+    Make ``sql`` return TRIPLANNEDSTARTDT as it is stored, in milliseconds
+    since 1970-01-01 UTC, instead of converting it to a date.
+    """
+    sql, count = re.subn(r"TO_DATE\('1970-01-01', 'YYYY-MM-DD'\) \+ TASK\.TRIPLANNEDSTARTDT /\s+86400000",
+                         "TASK.TRIPLANNEDSTARTDT", sql)
+    if count != 1:
+        raise Exception("TRIPLANNEDSTARTDT is not converted to a date in the query.")
+    return sql
+
+SQL_GET_TASKS_MS = planned_start_ms(SQL_GET_TASKS)
+SQL_GET_TASKS_GROUPED_MS = planned_start_ms(SQL_GET_TASKS_GROUPED)
+SQL_GET_TASKS_BULK_MS = planned_start_ms(SQL_GET_TASKS_BULK)
+SQL_GET_TASKS_GROUPED_BULK_MS = planned_start_ms(SQL_GET_TASKS_GROUPED_BULK)
+SQL_GET_TASKS_WINDOW_MS = planned_start_ms(SQL_GET_TASKS_WINDOW)
+SQL_GET_TASKS_GROUPED_WINDOW_MS = planned_start_ms(SQL_GET_TASKS_GROUPED_WINDOW)
+SQL_GET_TASKS_BULK_WINDOW_MS = planned_start_ms(SQL_GET_TASKS_BULK_WINDOW)
+SQL_GET_TASKS_GROUPED_BULK_WINDOW_MS = planned_start_ms(SQL_GET_TASKS_GROUPED_BULK_WINDOW)
+
+def match_query(sql):
+    """
+    Find which of the queries above ``sql`` is.
+
+    Returns a tuple of the name of the query (e.g. ``SQL_GET_TASKS``) and, for
+    the queries with a ``{}`` placeholder, the text that replaced it. Returns
+    ``(None, None)`` if ``sql`` is not one of these queries.
+    """
+    best = (None, None)
+    best_length = -1
+
+    for name, template in globals().items():
+        if not name.startswith("SQL_") or not isinstance(template, str):
+            continue
+
+        if "{}" not in template:
+            if sql == template:
+                return name, None
+            continue
+
+        prefix, suffix = template.split("{}", 1)
+        if (len(sql) >= len(prefix) + len(suffix)
+                and sql.startswith(prefix) and sql.endswith(suffix)
+                and len(prefix) + len(suffix) > best_length):
+            best = (name, sql[len(prefix):len(sql) - len(suffix)])
+            best_length = len(prefix) + len(suffix)
+
+    return best
@@ -0,0 +1,229 @@
+"""
+Streaming report formats for the PM Schedule validation results.
+
+Each report writes two files: one row for each task and one summary row for
+each PM Schedule. The summaries go to a file named like the output file with
+``-summary`` added, e.g. ``axiom.csv`` and ``axiom-summary.csv``.
+"""
+
+import csv
+import json
+import os
+
+from argh.exceptions import CommandError
+
+# The columns of a task row
+ROW_FIELDS = ('pm_id', 'task_id', 'status', 'planned_start_date', 'expected_date', 'valid', 'match')
+
+# The columns of a PM Schedule summary row
+SUMMARY_FIELDS = ('pm_id', 'pm_name', 'recurrence', 'grouped', 'valid', 'invalid', 'total',
+                  'duplicate', 'missing', 'unexpected', 'timeout', 'description', 'rrule')
+
+def summary_file_name(outputfile):
+    root, ext = os.path.splitext(outputfile)
+    return root + "-summary" + ext
+
+def format_date(value):
+    return None if value is None else str(value)
+
+def task_row(pm_id, row):
+    """
+    Convert a row of a ``check_pm`` result to a dict with ``ROW_FIELDS``.
+    """
+    task_id, status, actual_date, expected_date, ok, match = row
+    return {
+        'pm_id': pm_id,
+        'task_id': task_id,
+        'status': status,
+        'planned_start_date': format_date(actual_date),
+        'expected_date': format_date(expected_date),
+        'valid': ok,
+        'match': match,
+    }
+
+def summary_row(pm, grouped, result):
+    """
+    Summarize a ``check_pm`` result as a dict with ``SUMMARY_FIELDS``. The
+    counts are None if the PM Schedule could not be validated. The duplicate,
+    missing and unexpected counts are only set with ``--align``. ``timeout``
+    is the seconds used by a PM Schedule that was stopped by its budget, whose
+    counts only cover the tasks compared until then.
+    """
+    summary = {
+        'pm_id': pm['TRIIDTX'],
+        'pm_name': pm['TRINAMETX'],
+        'recurrence': pm['TRIPMTYPECLASSCL'],
+        'grouped': grouped,
+        'valid': None,
+        'invalid': None,
+        'total': None,
+        'duplicate': None,
+        'missing': None,
+        'unexpected': None,
+        'timeout': None,
+        'description': None,
+        'rrule': None,
+    }
+
+    if result:
+        summary.update({
+            'valid': result['ok_count'],
+            'invalid': result['total'] - result['ok_count'],
+            'total': result['total'],
+            'timeout': result['timeout'],
+            'description': result['description'],
+            'rrule': result['rrule'],
+        })
+        if result.get('matches'):
+            for kind in ('duplicate', 'missing', 'unexpected'):
+                summary[kind] = result['matches'][kind]
+
+    return summary
+
+class Report:
+    """
+    Base class of the report formats.
+
+    Call ``add_pm`` with each PM Schedule and its ``check_pm`` result, then
+    ``close``. The rows of a result are written as they are read.
+    """
+
+    def add_pm(self, pm, grouped, result):
+        if result is None:
+            self.write_summary(summary_row(pm, grouped, None))
+            return
+
+        try:
+            for row in result['rows']:
+                self.write_row(task_row(result['pm_id'], row))
+        except Exception:
+            self.write_summary(summary_row(pm, grouped, None))
+            raise
+
+        self.write_summary(summary_row(pm, grouped, result))
+
+    def write_row(self, row):
+        raise NotImplementedError()
+
+    def write_summary(self, summary):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+class CsvReport(Report):
+
+    def __init__(self, outputfile):
+        self.files = []
+        self.rows = self.open(outputfile, ROW_FIELDS)
+        self.summaries = self.open(summary_file_name(outputfile), SUMMARY_FIELDS)
+
+    def open(self, filename, fields):
+        f = open(filename, "w", newline="", encoding="utf-8")
+        self.files.append(f)
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        return writer
+
+    def write_row(self, row):
+        self.rows.writerow(row)
+
+    def write_summary(self, summary):
+        self.summaries.writerow(summary)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+class JsonLinesReport(Report):
+
+    def __init__(self, outputfile):
+        self.rows = open(outputfile, "w", encoding="utf-8")
+        self.summaries = open(summary_file_name(outputfile), "w", encoding="utf-8")
+
+    def write_row(self, row):
+        self.rows.write(json.dumps(row, default=str) + "\n")
+
+    def write_summary(self, summary):
+        self.summaries.write(json.dumps(summary, default=str) + "\n")
+
+    def close(self):
+        self.rows.close()
+        self.summaries.close()
+
+class ParquetReport(Report):
+    """
+    Writes Parquet files. Rows are buffered and written as a row group every
+    ``batch_size`` rows. Requires pyarrow.
+    """
+
+    def __init__(self, outputfile, batch_size=10000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise CommandError("Parquet reports need pyarrow. Install it with: pip install pyarrow")
+
+        self.pa = pyarrow
+        self.batch_size = batch_size
+
+        row_schema = pyarrow.schema([
+            ('pm_id', pyarrow.string()),
+            ('task_id', pyarrow.string()),
+            ('status', pyarrow.string()),
+            ('planned_start_date', pyarrow.string()),
+            ('expected_date', pyarrow.string()),
+            ('valid', pyarrow.bool_()),
+            ('match', pyarrow.string()),
+        ])
+
+        summary_schema = pyarrow.schema([
+            ('pm_id', pyarrow.string()),
+            ('pm_name', pyarrow.string()),
+            ('recurrence', pyarrow.string()),
+            ('grouped', pyarrow.bool_()),
+            ('valid', pyarrow.int64()),
+            ('invalid', pyarrow.int64()),
+            ('total', pyarrow.int64()),
+            ('duplicate', pyarrow.int64()),
+            ('missing', pyarrow.int64()),
+            ('unexpected', pyarrow.int64()),
+            ('timeout', pyarrow.float64()),
+            ('description', pyarrow.string()),
+            ('rrule', pyarrow.string()),
+        ])
+
+        self.rows = (pyarrow.parquet.ParquetWriter(outputfile, row_schema), row_schema, [])
+        self.summaries = (pyarrow.parquet.ParquetWriter(summary_file_name(outputfile), summary_schema), summary_schema, [])
+
+    def write_row(self, row):
+        # The task count of grouped PMs is a number
+        if row['task_id'] is not None:
+            row['task_id'] = str(row['task_id'])
+        self.append(self.rows, row)
+
+    def write_summary(self, summary):
+        self.append(self.summaries, summary)
+
+    def append(self, output, row):
+        writer, schema, buffer = output
+        buffer.append(row)
+        if len(buffer) >= self.batch_size:
+            self.flush(output)
+
+    def flush(self, output):
+        writer, schema, buffer = output
+        if buffer:
+            writer.write_table(self.pa.Table.from_pylist(buffer, schema=schema))
+            del buffer[:]
+
+    def close(self):
+        for output in (self.rows, self.summaries):
+            self.flush(output)
+            output[0].close()
+
+REPORTS = {
+    'csv': CsvReport,
+    'jsonl': JsonLinesReport,
+    'parquet': ParquetReport,
+}
@@ -0,0 +1,271 @@
+"""
+Read and write snapshot files.
+
+A snapshot is an SQLite file with the rows that the queries in ``queries.py``
+return for a set of PM Schedules. ``SnapshotConnection`` answers those
+queries from the file, so it can be used in place of a database connection.
+"""
+
+import itertools
+import os
+import pickle
+import re
+import sqlite3
+
+from datetime import datetime, timedelta
+from .queries import match_query, EVENT_FIELDS
+
+# Where the rows of each query are stored and how to find the keys of the rows
+# it asks for. The tasks are stored in the shape of the bulk queries, with a
+# PM_ID column, which is dropped for the per-PM queries.
+#
+#   query name: (table, keys, drop PM_ID)
+QUERIES = {
+    'SQL_GET_PMSCHEDS':           ('pmscheds', None, False),
+    'SQL_GET_PMSCHEDS_FILTERED':  ('pmscheds', 'binds', False),
+    'SQL_GET_EVENTS':             ('events', None, False),
+    'SQL_GET_EVENT':              ('events', 'pm_id', False),
+    'SQL_GET_EVENTS_BULK':        ('events', 'binds', False),
+    'SQL_GET_RECURRENCES':        ('events', None, False),
+    'SQL_GET_RECURRENCE':         ('events', 'pm_id', False),
+    'SQL_GET_RECURRENCES_BULK':   ('events', 'binds', False),
+    'SQL_GET_INCLUDES':           ('includes', 'event_spec_id', False),
+    'SQL_GET_INCLUDES_BULK':      ('includes', 'event_binds', False),
+    'SQL_GET_EXCLUDES':           ('excludes', 'event_spec_id', False),
+    'SQL_GET_EXCLUDES_BULK':      ('excludes', 'event_binds', False),
+    'SQL_GET_TASKS':              ('tasks', 'pm_id', True),
+    'SQL_GET_TASKS_BULK':         ('tasks', 'binds', False),
+    'SQL_GET_TASKS_GROUPED':      ('tasks_grouped', 'pm_id', True),
+    'SQL_GET_TASKS_GROUPED_BULK': ('tasks_grouped', 'binds', False),
+}
+
+# The columns of the queries that only return some of the columns of their
+# table. Columns that are not in the snapshot are None.
+PROJECTIONS = {
+    'SQL_GET_RECURRENCES': EVENT_FIELDS,
+    'SQL_GET_RECURRENCE': EVENT_FIELDS,
+    'SQL_GET_RECURRENCES_BULK': EVENT_FIELDS,
+}
+
+# Variants of the tasks queries. _WINDOW queries only return the tasks planned
+# between ``:since_ms`` and ``:until_ms``. _MS queries return TRIPLANNEDSTARTDT
+# in milliseconds since 1970.
+WINDOW_SUFFIX = '_WINDOW'
+MS_SUFFIX = '_MS'
+
+EPOCH = datetime(1970, 1, 1)
+
+# The tables that must have rows for every PM Schedule asked for.
+REQUIRED_TABLES = ('tasks', 'tasks_grouped')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS columns (tbl TEXT PRIMARY KEY, names TEXT);
+CREATE TABLE IF NOT EXISTS rows (tbl TEXT, key, seq INTEGER, data BLOB);
+CREATE INDEX IF NOT EXISTS rows_key ON rows (tbl, key, seq);
+CREATE TABLE IF NOT EXISTS event_specs (pm_id TEXT, spec_id);
+CREATE INDEX IF NOT EXISTS event_specs_pm_id ON event_specs (pm_id);
+"""
+
+def to_epoch_ms(value):
+    if value is None:
+        return None
+    return (value - EPOCH) // timedelta(milliseconds=1)
+
+def create_snapshot(filename):
+    """
+    Create a new, empty snapshot file. Returns an SQLite connection to it.
+    """
+    db = sqlite3.connect(filename)
+    for table in ('meta', 'columns', 'rows', 'event_specs'):
+        db.execute("DROP TABLE IF EXISTS " + table)
+    db.executescript(SCHEMA)
+    return db
+
+def write_rows(db, table, key_column, rows):
+    """
+    Add the rows of a query to a snapshot. The rows are looked up by the
+    value of ``key_column``.
+    """
+    if not rows:
+        return
+
+    columns = list(rows[0].keys())
+    names = ",".join(columns)
+
+    existing = db.execute("SELECT names FROM columns WHERE tbl = ?", (table,)).fetchone()
+    if existing is None:
+        db.execute("INSERT INTO columns VALUES (?, ?)", (table, names))
+    elif existing[0] != names:
+        raise Exception("The columns of '{}' changed while taking the snapshot.".format(table))
+
+    seq = db.execute("SELECT COUNT(*) FROM rows WHERE tbl = ?", (table,)).fetchone()[0]
+
+    db.executemany("INSERT INTO rows VALUES (?, ?, ?, ?)",
+                   ((table, row[key_column], seq + i, pickle.dumps(tuple(row[c] for c in columns), 2))
+                    for i, row in enumerate(rows)))
+
+    if table == 'events':
+        db.executemany("INSERT INTO event_specs VALUES (?, ?)",
+                       ((row['PM_ID'], row['EVENT_SPEC_ID']) for row in rows))
+
+def open_snapshot(filename):
+    return SnapshotConnection(filename)
+
+class SnapshotPool:
+    """
+    Stands in for ``cx_Oracle.SessionPool``. Each connection is a new
+    connection to the snapshot file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def acquire(self):
+        return SnapshotConnection(self.filename)
+
+    def release(self, connection):
+        connection.close()
+
+class SnapshotConnection:
+    """
+    Stands in for a ``cx_Oracle`` connection. Only the queries in
+    ``queries.py`` can be run.
+    """
+
+    def __init__(self, filename):
+        if not os.path.isfile(filename):
+            raise Exception("Snapshot file '{}' does not exist.".format(filename))
+
+        self.filename = filename
+        self.autocommit = True
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+
+        try:
+            self.columns = dict(self.db.execute("SELECT tbl, names FROM columns"))
+        except sqlite3.DatabaseError:
+            self.columns = None
+
+        if not self.columns:
+            raise Exception("'{}' is not a snapshot or it is empty.".format(filename))
+
+    def cursor(self):
+        return SnapshotCursor(self)
+
+    def close(self):
+        self.db.close()
+
+    def query(self, sql, parameters):
+        """
+        Returns the column names and an iterator of rows of ``sql``.
+        """
+        name, fill = match_query(sql)
+
+        epoch_ms = name is not None and name.endswith(MS_SUFFIX)
+        if epoch_ms:
+            name = name[:-len(MS_SUFFIX)]
+        window = name is not None and name.endswith(WINDOW_SUFFIX)
+        if window:
+            name = name[:-len(WINDOW_SUFFIX)]
+
+        if name not in QUERIES:
+            raise Exception("This query can't be answered from a snapshot:\n" + sql)
+
+        table, keys_from, drop_pm_id = QUERIES[name]
+        columns = self.columns.get(table, "").split(",")
+
+        keys = self.get_keys(keys_from, fill, parameters)
+
+        order = "key, seq" if table in ('tasks', 'tasks_grouped') else "seq"
+
+        if keys is None:
+            cursor = self.db.execute("SELECT data FROM rows WHERE tbl = ? ORDER BY " + order, (table,))
+        else:
+            if table in REQUIRED_TABLES:
+                self.check_keys(table, keys)
+            cursor = self.db.execute("SELECT data FROM rows WHERE tbl = ? AND key IN ({}) ORDER BY {}"
+                                         .format(", ".join("?" * len(keys)), order),
+                                     [table] + keys)
+
+        rows = (pickle.loads(row[0]) for row in cursor)
+
+        if window or epoch_ms:
+            planned = columns.index('TRIPLANNEDSTARTDT')
+
+        if window:
+            since = EPOCH + timedelta(milliseconds=parameters['since_ms'])
+            until = EPOCH + timedelta(milliseconds=parameters['until_ms'])
+            rows = (row for row in rows if row[planned] is not None and since <= row[planned] < until)
+
+        if epoch_ms:
+            rows = (row[:planned] + (to_epoch_ms(row[planned]),) + row[planned + 1:] for row in rows)
+
+        if drop_pm_id:
+            index = columns.index('PM_ID')
+            del columns[index]
+            rows = (row[:index] + row[index + 1:] for row in rows)
+
+        if name in PROJECTIONS:
+            rows = project(rows, columns, PROJECTIONS[name])
+            columns = list(PROJECTIONS[name])
+
+        return columns, rows
+
+    def get_keys(self, keys_from, fill, parameters):
+        if keys_from is None:
+            return None
+        elif keys_from == 'binds':
+            return self.get_bound_values(fill, parameters)
+        elif keys_from == 'event_binds':
+            pm_ids = self.get_bound_values(fill, parameters)
+            return [row[0] for row in self.db.execute(
+                "SELECT spec_id FROM event_specs WHERE pm_id IN ({})".format(", ".join("?" * len(pm_ids))),
+                pm_ids)]
+        else:
+            return [parameters[keys_from]]
+
+    def get_bound_values(self, fill, parameters):
+        # The IN lists are padded with NULLs. See ``ora_helper.bind_chunks``.
+        values = (parameters[name] for name in re.findall(r":(\w+)", fill))
+        return [value for value in values if value is not None]
+
+    def check_keys(self, table, keys):
+        for key in keys:
+            if self.db.execute("SELECT 1 FROM rows WHERE tbl = ? AND key = ? LIMIT 1", (table, key)).fetchone() is None:
+                raise Exception("PM Schedule '{}' is not in the snapshot {}.".format(key, self.filename))
+
+def project(rows, columns, fields):
+    """
+    Yields only the values of ``fields`` of each row with ``columns``.
+    """
+    indexes = [columns.index(field) if field in columns else None for field in fields]
+    for row in rows:
+        yield tuple(None if i is None else row[i] for i in indexes)
+
+class SnapshotCursor:
+    """
+    Stands in for a ``cx_Oracle`` cursor.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.arraysize = 100
+        self.description = None
+        self.rows = iter(())
+
+    def execute(self, sql, parameters=None):
+        columns, self.rows = self.connection.query(sql, parameters or {})
+        self.description = [(column,) for column in columns]
+        return self
+
+    def fetchmany(self, size=None):
+        return list(itertools.islice(self.rows, size or self.arraysize))
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def __iter__(self):
+        return self.rows
+
+    def close(self):
+        pass
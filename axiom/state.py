@@ -0,0 +1,47 @@
+"""
+A local store of validation results, so that PM Schedules that have not
+changed can be skipped in the next run.
+"""
+
+import pickle
+import sqlite3
+import threading
+
+class StateStore:
+    """
+    Saves a result for each PM Schedule along with a fingerprint of the data
+    it was computed from. The result is only returned if the fingerprint
+    still matches.
+
+    It can be used from many threads.
+    """
+
+    def __init__(self, filename, commit_every=100):
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (pm_id TEXT PRIMARY KEY, fingerprint TEXT, result BLOB)")
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+
+    def get(self, pm_id, fingerprint):
+        with self.lock:
+            row = self.db.execute("SELECT fingerprint, result FROM results WHERE pm_id = ?", (pm_id,)).fetchone()
+        if row is None or row[0] != fingerprint:
+            return None
+        return pickle.loads(row[1])
+
+    def put(self, pm_id, fingerprint, result):
+        data = pickle.dumps(result, 2)
+
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (pm_id, fingerprint, data))
+
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
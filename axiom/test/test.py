@@ -1,9 +1,45 @@
 # -*- coding: utf-8 -*-
 
 from .. import pmeventparser
+from ..calendars import WorkingCalendar
+from .. import snapshot
+from .. import pmschedulevalidator
+from ..pmschedulevalidator import OccurrenceCache, get_window, align_tasks, check_pms, get_pms
+from ..ora_helper import execute, bind_list, bind_chunks
+from ..pipeline import run_pipeline
+from ..state import StateStore
+from ..budget import Budget, BudgetExceeded
+from .. import export
+from ..export import recurrence_definition, fold
+from .. import pmforecast
+from ..pmforecast import Bins, Counts, to_us
+from ..pmserve import Service
+from .. import profiler
+from .. import reports
+from ..queries import SQL_GET_TASKS, SQL_GET_TASKS_BULK, SQL_GET_TASKS_BULK_WINDOW, SQL_GET_TASKS_MS
+from ..queries import SQL_GET_RECURRENCE, EVENT_FIELDS
+from ..timezones import get_transition_table
+import csv
+import io
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock as mock
+import zipfile
 import datetime
+import numpy
 import pytz
+import xlsxwriter
+
+from argh.exceptions import CommandError
+from xml.etree import ElementTree
 
 class Test8to5Calendar(unittest.TestCase):
     """
@@ -67,5 +103,1160 @@ class Test8to5Calendar(unittest.TestCase):
 
         self.assertTrue(expected_date == output_date)
 
+class Test8to5CalendarArray(unittest.TestCase):
+    """
+    Tests the vectorized 8 to 5 calendar rules
+    """
+    def test_same_as_single_date(self):
+        # Every 7 minutes and 13 seconds for two weeks, weekends included
+        start = datetime.datetime(2015, 12, 25, 0, 0, 0)
+        input_dates = [start + datetime.timedelta(seconds=433 * i) for i in range(2800)]
+
+        expected_dates = [pmeventparser.restrict_to_standard_calendar(d) for d in input_dates]
+        output_dates = pmeventparser.to_datetimes(
+            pmeventparser.restrict_to_working_calendar_array(input_dates, "8to5"))
+
+        self.assertEqual(expected_dates, output_dates)
+
+    def test_saturday_after_5pm(self):
+        input_dates = [datetime.datetime(2016, 1, 1, 17, 30, 15)] # Friday
+        # Monday. 8:00:15 AM
+        expected_date = datetime.datetime(2016, 1, 4, 8, 0, 15)
+        output_dates = pmeventparser.to_datetimes(
+            pmeventparser.restrict_to_working_calendar_array(input_dates, "8to5"))
+        self.assertEqual([expected_date], output_dates)
+
+class TestWorkingCalendar(unittest.TestCase):
+    """
+    Tests calendars read from a calendar file
+    """
+    WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday']
+
+    def test_same_as_8to5(self):
+        calendar = WorkingCalendar('8to5', {day: ['08:00-17:00'] for day in self.WEEKDAYS})
+
+        # Every 7 minutes and 13 seconds for two weeks, weekends included
+        start = datetime.datetime(2015, 12, 25, 0, 0, 0)
+        input_dates = [start + datetime.timedelta(seconds=433 * i) for i in range(2800)]
+
+        expected_dates = [pmeventparser.restrict_to_standard_calendar(d) for d in input_dates]
+        output_dates = pmeventparser.to_datetimes(
+            pmeventparser.restrict_to_working_calendar_array(input_dates, calendar))
+
+        self.assertEqual(expected_dates, output_dates)
+
+    def test_breaks_and_holidays(self):
+        calendar = WorkingCalendar('Plant', {day: ['07:00-15:30'] for day in self.WEEKDAYS},
+                                   breaks=['11:30-12:00'], holidays=['2015-12-31', '2016-01-01'])
+
+        def restrict(*args):
+            return pmeventparser.restrict_to_working_calendar(datetime.datetime(*args), calendar)
+
+        # Lunch. 12:00 PM
+        self.assertEqual(datetime.datetime(2015, 12, 29, 12, 0, 10), restrict(2015, 12, 29, 11, 45, 10))
+        # The start of lunch is still working time
+        self.assertEqual(datetime.datetime(2015, 12, 29, 11, 30, 59), restrict(2015, 12, 29, 11, 30, 59))
+        # Wednesday evening, before two holidays and a weekend. Monday 7:00 AM
+        self.assertEqual(datetime.datetime(2016, 1, 4, 7, 0, 0), restrict(2015, 12, 30, 16, 0, 0))
+
+class TestTransitionTable(unittest.TestCase):
+    """
+    Tests converting arrays of dates with the timezone transition table
+    """
+    EPOCH = datetime.datetime(1970, 1, 1)
+
+    def dates(self):
+        # Every 7 minutes and 13 seconds around the DST changes of 2016
+        dates = []
+        for change in (datetime.datetime(2016, 3, 13), datetime.datetime(2016, 11, 6)):
+            dates.extend(change + datetime.timedelta(seconds=433 * i) for i in range(600))
+        return dates
+
+    def to_us(self, dates):
+        return numpy.array([(d - self.EPOCH) // datetime.timedelta(microseconds=1) for d in dates], numpy.int64)
+
+    def test_localize_same_as_pytz(self):
+        local_tz = pytz.timezone("US/Eastern")
+        table = get_transition_table("US/Eastern")
+
+        dates = self.dates()
+        utc, period = table.localize(self.to_us(dates))
+
+        expected_dates = [local_tz.localize(d) for d in dates]
+        self.assertEqual([str(d) for d in expected_dates], [str(d) for d in table.to_datetimes(self.to_us(dates), period)])
+        self.assertEqual(self.to_us([d.astimezone(pytz.utc).replace(tzinfo=None) for d in expected_dates]).tolist(),
+                         utc.tolist())
+
+    def test_to_local_same_as_localize_date(self):
+        local_tz = pytz.timezone("US/Eastern")
+        table = get_transition_table("US/Eastern")
+
+        dates = self.dates()
+        local, period = table.to_local(self.to_us(dates))
+
+        expected_dates = [pmeventparser.localize_date(d, local_tz) for d in dates]
+        self.assertEqual([str(d) for d in expected_dates], [str(d) for d in table.to_datetimes(local, period)])
+
+class TestBindChunks(unittest.TestCase):
+    """
+    Tests splitting long IN lists into chunks with a fixed number of binds
+    """
+    def test_chunks(self):
+        chunks = list(bind_chunks(["PM{}".format(i) for i in range(1234)]))
+
+        self.assertEqual([1000, 1000], [len(parameters) for binds, parameters in chunks])
+        values = [value for binds, parameters in chunks for value in parameters.values() if value is not None]
+        self.assertEqual(1234, len(set(values)))
+
+class TestOccurrenceCache(unittest.TestCase):
+    """
+    Tests that rules with the same signature are expanded once
+    """
+    def make_rule(self, count=10):
+        from dateutil.rrule import rrule, rruleset, MONTHLY, MO
+        ruleset = rruleset()
+        ruleset.rrule(rrule(MONTHLY, datetime.datetime(2016, 1, 4, 9), count=count, byweekday=MO(1)))
+        ruleset.rdate(datetime.datetime(2016, 6, 18, 9))
+        return ruleset
+
+    def test_same_rule(self):
+        cache = OccurrenceCache()
+        first = cache.get(self.make_rule(), "8to5").get(0, 5)
+        second = cache.get(self.make_rule(), "8to5").get(0, 20)
+
+        self.assertEqual((1, 1), (cache.misses, cache.hits))
+        self.assertEqual(list(self.make_rule()), second[0])
+        self.assertEqual(first[0], second[0][:5])
+        # Saturday. Monday 8:00 AM
+        self.assertEqual(datetime.datetime(2016, 6, 20, 8), second[1][6])
+
+    def test_different_rule(self):
+        cache = OccurrenceCache()
+        cache.get(self.make_rule(), "8to5")
+        cache.get(self.make_rule(count=11), "8to5")
+        cache.get(self.make_rule(), "24/7")
+        self.assertEqual((3, 0), (cache.misses, cache.hits))
+
+    def test_parsed_signature(self):
+        def event(**fields):
+            values = {'EVENTSTARTDATE': datetime.datetime(2016, 1, 4, 9), 'RECURRENCEPATTERNTYPE': 'WEEKLY',
+                      'WEEKLYRECURRENCEWEEKS': 2, 'TRIRECURRENCEENDOPTI': 'End After', 'EVENTDURATION': 20,
+                      '_INCLUDES': [], '_EXCLUDES': []}
+            values.update(('WEEKLY' + day, 'TRUE' if day in ('MONDAY', 'THURSDAY') else 'FALSE')
+                          for day in ('SUNDAY', 'MONDAY', 'TUESDAY', 'WEDNESDAY', 'THURSDAY', 'FRIDAY', 'SATURDAY'))
+            values.update(fields)
+            return pmeventparser.parse_event(values, verbosity=0)[0]
+
+        signature = pmeventparser.recurrence_signature
+        self.assertEqual(signature(event()), signature(event()))
+        self.assertEqual(hash(signature(event())), hash(signature(event())))
+        self.assertNotEqual(signature(event()), signature(event(WEEKLYRECURRENCEWEEKS=3)))
+        self.assertNotEqual(signature(event()), signature(event(WEEKLYFRIDAY='TRUE')))
+        self.assertNotEqual(signature(event()), signature(event(
+            _INCLUDES=[{'INC_STARTDT': datetime.datetime(2016, 1, 9, 9)}])))
+
+        cache = OccurrenceCache()
+        cache.get(event(), "8to5")
+        cache.get(event(), "8to5")
+        self.assertEqual((1, 1), (cache.misses, cache.hits))
+
+    def test_window(self):
+        since = datetime.datetime(2018, 1, 1)
+        occurrences, offset = pmschedulevalidator.find_occurrences(self.make_rule(count=40), "8to5", since)
+        expected, coerced = occurrences.get(offset, offset + 100)
+
+        full = OccurrenceCache().get(self.make_rule(count=40), "8to5").get(0, 100)
+        start = [date >= since for date in full[1]].index(True)
+        self.assertEqual((full[0][start:], full[1][start:]), (expected, coerced))
+        # The dates of the earlier years are not kept
+        self.assertGreaterEqual(occurrences.expected[0], since - pmschedulevalidator.WINDOW_MARGIN)
+
+    def test_window_moved_date(self):
+        from dateutil.rrule import rrule, DAILY
+        # No working day in January and February, so the dates of January
+        # move to March 1
+        holidays = [str(datetime.date(2016, 1, 1) + datetime.timedelta(days=day)) for day in range(60)]
+        calendar = WorkingCalendar('Closed', {day: ['08:00-17:00'] for day in TestWorkingCalendar.WEEKDAYS},
+                                   holidays=holidays)
+        rule = rrule(DAILY, datetime.datetime(2016, 1, 1, 9), count=90)
+        since = datetime.datetime(2016, 3, 1, 8)
+
+        occurrences, offset = pmschedulevalidator.find_occurrences(rule, calendar, since)
+        self.assertEqual(datetime.datetime(2016, 1, 1, 9), occurrences.get(offset, offset + 1)[0][0])
+
+class TestAlignTasks(unittest.TestCase):
+    """
+    Tests matching tasks to occurrences by date
+    """
+    def align(self, planned_dates, grouped=False, epoch_ms=False, count=10):
+        from dateutil.rrule import rrule, rruleset, DAILY
+        ruleset = rruleset()
+        ruleset.rrule(rrule(DAILY, datetime.datetime(2016, 1, 4, 9), count=count, byweekday=range(5)))
+
+        tasks = [{'TASK_ID': task[0], 'TASK_STATUS': task[2] if len(task) > 2 else 'Active',
+                  'TRIPLANNEDSTARTDT': task[1]}
+                 for task in planned_dates]
+        result = {'ok_count': 0, 'total': 0}
+        rows = list(align_tasks(result, ruleset, tasks, "UTC", grouped=grouped, epoch_ms=epoch_ms))
+        return result, [row[-1] for row in rows]
+
+    def test_duplicate_and_skipped(self):
+        dates = [datetime.datetime(2016, 1, day, 9) for day in (4, 5, 7, 8, 8, 11, 12, 13)]
+        dates.insert(5, datetime.datetime(2016, 1, 9, 10)) # Saturday
+        result, matches = self.align(enumerate(dates))
+
+        self.assertEqual(matches, ['matched', 'matched', 'missing', 'matched', 'matched',
+                                   'duplicate', 'unexpected', 'matched', 'matched', 'matched'])
+        self.assertEqual(result['matches'], {'matched': 7, 'duplicate': 1, 'missing': 1, 'unexpected': 1})
+        self.assertEqual((7, 10), (result['ok_count'], result['total']))
+
+    def test_epoch_ms(self):
+        epoch = datetime.datetime(1970, 1, 1)
+        dates = [datetime.datetime(2016, 1, day, 9) for day in (4, 5, 7, 8, 8, 9)]
+        planned = [(d - epoch) // datetime.timedelta(milliseconds=1) for d in dates]
+
+        self.assertEqual(self.align(enumerate(planned), epoch_ms=True), self.align(enumerate(dates)))
+
+    def test_grouped(self):
+        result, matches = self.align([(1, datetime.datetime(2016, 1, 4, 9)),
+                                      (2, datetime.datetime(2016, 1, 5, 9))], grouped=True)
+        self.assertEqual(matches, ['matched', 'matched'])
+
+    def test_grouped_assets(self):
+        # Four assets. On the second day three tasks are active and one is
+        # closed. The fourth day has no tasks and the Saturday is not planned.
+        result, matches = self.align([(4, datetime.datetime(2016, 1, 4, 9)),
+                                      (3, datetime.datetime(2016, 1, 5, 9), 'Active'),
+                                      (1, datetime.datetime(2016, 1, 5, 9), 'Closed'),
+                                      (4, datetime.datetime(2016, 1, 6, 9)),
+                                      (4, datetime.datetime(2016, 1, 8, 9)),
+                                      (4, datetime.datetime(2016, 1, 9, 9))], grouped=True, count=5)
+
+        self.assertEqual(matches, ['matched', 'matched', 'matched', 'matched', 'missing', 'matched', 'unexpected'])
+        self.assertEqual(result['matches'], {'matched': 5, 'duplicate': 0, 'missing': 1, 'unexpected': 1})
+
+class TestSnapshot(unittest.TestCase):
+    """
+    Tests answering queries from a snapshot file
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "test.snapshot")
+
+        db = snapshot.create_snapshot(self.filename)
+        snapshot.write_rows(db, 'tasks', 'PM_ID', [
+            {'PM_ID': 'PM2', 'TASK_ID': 'T3', 'TRIPLANNEDSTARTDT': datetime.datetime(2016, 1, 3)},
+            {'PM_ID': 'PM1', 'TASK_ID': 'T1', 'TRIPLANNEDSTARTDT': datetime.datetime(2016, 1, 1)},
+            {'PM_ID': 'PM1', 'TASK_ID': 'T2', 'TRIPLANNEDSTARTDT': None},
+        ])
+        db.commit()
+        db.close()
+
+        self.connection = snapshot.open_snapshot(self.filename)
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_per_pm_query(self):
+        rows = execute(SQL_GET_TASKS, self.connection, {'pm_id': 'PM1'})
+        self.assertEqual(rows, [
+            {'TASK_ID': 'T1', 'TRIPLANNEDSTARTDT': datetime.datetime(2016, 1, 1)},
+            {'TASK_ID': 'T2', 'TRIPLANNEDSTARTDT': None},
+        ])
+
+    def test_bulk_query(self):
+        binds, parameters = bind_list(['PM2', 'PM1'])
+        rows = execute(SQL_GET_TASKS_BULK.format(binds), self.connection, parameters)
+        self.assertEqual([row['TASK_ID'] for row in rows], ['T1', 'T2', 'T3'])
+
+    def test_padded_bulk_query(self):
+        (binds, parameters), = bind_chunks(['PM2', 'PM1'])
+        self.assertEqual(10, len(parameters))
+        rows = execute(SQL_GET_TASKS_BULK.format(binds), self.connection, parameters)
+        self.assertEqual([row['TASK_ID'] for row in rows], ['T1', 'T2', 'T3'])
+
+    def test_window_query(self):
+        binds, parameters = bind_list(['PM2', 'PM1'])
+        parameters.update(get_window("UTC", since=datetime.datetime(2016, 1, 1, 0, 1)))
+        rows = execute(SQL_GET_TASKS_BULK_WINDOW.format(binds), self.connection, parameters)
+        self.assertEqual([row['TASK_ID'] for row in rows], ['T3'])
+
+    def test_epoch_ms_query(self):
+        rows = execute(SQL_GET_TASKS_MS, self.connection, {'pm_id': 'PM1'})
+        self.assertEqual([row['TRIPLANNEDSTARTDT'] for row in rows], [1451606400000, None])
+
+    def test_missing_pm(self):
+        with self.assertRaises(Exception):
+            execute(SQL_GET_TASKS, self.connection, {'pm_id': 'PM3'})
+
+GROUPED = 'Create Task For Each Asset/Location'
+
+def write_pm_snapshot(filename, count=8):
+    """
+    Write a snapshot with ``count`` daily PM Schedules. In turn they are
+    plain, grouped, without tasks and with include and exclude dates. Every
+    third task is a day late. Returns the PMs.
+    """
+    pms, events, includes, excludes, tasks, grouped_tasks = [], [], [], [], [], []
+
+    for i in range(count):
+        pm_id = "PM{:04d}".format(i)
+        spec_id = 1000 + i
+        kind = i % 4
+        # 8:00 AM US/Eastern, on a few different days
+        start = datetime.datetime(2016, 1, 4, 13) + datetime.timedelta(days=i % 3)
+
+        pms.append({'TRIIDTX': pm_id, 'SPEC_ID': spec_id, 'TRINAMETX': "Daily {}".format(i),
+                    'TRIPMTYPECLASSCL': 'DAILY', 'TRITASKGROUPINGRULELI': GROUPED if kind == 1 else None})
+        events.append({'PM_ID': pm_id, 'PM_NAME': "Daily {}".format(i), 'EVENT_SPEC_ID': spec_id,
+                       'EVENTSTARTDATE': start, 'EVENTENDDATE': start + datetime.timedelta(days=365),
+                       'RECURRENCEPATTERNTYPE': 'DAILY', 'TRIRECURRENCEDAILYOP': 'Every [x] day(s)',
+                       'DAILYRECURRENCEDAYS': 1, 'TRIRECURRENCEENDOPTI': 'End After', 'EVENTDURATION': 12})
+
+        if kind == 3:
+            includes.append({'SPEC_ID': spec_id, 'INC_STARTDT': start + datetime.timedelta(days=30, hours=2)})
+            excludes.append({'SPEC_ID': spec_id, 'EXCL_STARTDT': start + datetime.timedelta(days=3),
+                             'EXCL_ENDDT': start + datetime.timedelta(days=5)})
+
+        dates = [start + datetime.timedelta(days=day + (day % 3 == 2)) for day in range(10)]
+        if kind == 1:
+            grouped_tasks.extend({'PM_ID': pm_id, 'TASK_ID': 1 + day % 2, 'TASK_STATUS': 'Active',
+                                  'TRIPLANNEDSTARTDT': date} for day, date in enumerate(dates))
+        elif kind == 2:
+            # What the tasks query returns for a PM without tasks
+            tasks.append({'PM_ID': pm_id, 'TASK_ID': None, 'TASK_STATUS': None, 'TRIPLANNEDSTARTDT': None})
+        else:
+            tasks.extend({'PM_ID': pm_id, 'TASK_ID': "{}-{}".format(pm_id, day), 'TASK_STATUS': 'Active',
+                          'TRIPLANNEDSTARTDT': date} for day, date in enumerate(dates))
+
+    db = snapshot.create_snapshot(filename)
+    snapshot.write_rows(db, 'pmscheds', 'TRIIDTX', pms)
+    snapshot.write_rows(db, 'events', 'PM_ID', events)
+    snapshot.write_rows(db, 'includes', 'SPEC_ID', includes)
+    snapshot.write_rows(db, 'excludes', 'SPEC_ID', excludes)
+    snapshot.write_rows(db, 'tasks', 'PM_ID', tasks)
+    snapshot.write_rows(db, 'tasks_grouped', 'PM_ID', grouped_tasks)
+    db.commit()
+    db.close()
+
+    return pms
+
+def check_options(**options):
+    """
+    The options of ``check_pms`` as set by the command line defaults.
+    """
+    defaults = dict(timezone="US/Eastern", strip_time=False, working_calendar="8to5", since=None, until=None,
+                    epoch_ms=False, align=False, summary_only=False, time_budget=None, max_occurrences=None,
+                    verbosity=0)
+    defaults.update(options)
+    return defaults
+
+def read_results(results):
+    """
+    The PM ID and the result of each PM from ``check_pms``, with the rows
+    read into a list.
+    """
+    return [(pm['TRIIDTX'], result and dict(result, rows=list(result['rows']))) for pm, result in results]
+
+class TestBulkLoad(unittest.TestCase):
+    """
+    Tests that prefetching gives the same results as querying each PM
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check(self, count, chunk_size, **options):
+        filename = os.path.join(self.tmpdir, "test.snapshot")
+        pms = write_pm_snapshot(filename, count)
+
+        connection = snapshot.open_snapshot(filename)
+        try:
+            pms = get_pms(connection, [pm['TRIIDTX'] for pm in pms])
+            self.assertEqual(count, len(pms))
+
+            per_pm = read_results(check_pms(pms, connection, **check_options(**options)))
+            bulk = read_results(check_pms(pms, connection, bulk_load=True, chunk_size=chunk_size,
+                                          **check_options(**options)))
+        finally:
+            connection.close()
+
+        self.assertTrue(all(result is not None for pm_id, result in per_pm))
+        self.assertEqual(per_pm, bulk)
+        return per_pm
+
+    def test_same_rows(self):
+        results = dict(self.check(8, 3))
+
+        # Grouped, without tasks and with include and exclude dates
+        self.assertTrue(results['PM0001']['grouped'])
+        self.assertEqual([], results['PM0002']['rows'])
+        self.assertIn("Include Dates:\n2016-02-03", results['PM0003']['rrule'])
+        self.assertGreater(results['PM0000']['ok_count'], 0)
+        self.assertLess(results['PM0000']['ok_count'], results['PM0000']['total'])
+
+    def test_same_rows_in_window(self):
+        self.check(8, 5, since=datetime.datetime(2016, 1, 7), until=datetime.datetime(2016, 1, 12),
+                   epoch_ms=True, align=True)
+
+    def test_bind_chunks(self):
+        # More PMs than fit in one IN list
+        self.check(1001, 2000)
+
+class TestPackedJob(unittest.TestCase):
+    """
+    Tests the jobs and results sent to and from the worker processes
+    """
+    def test_round_trip(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "test.snapshot")
+            pms = write_pm_snapshot(filename, 4)
+            connection = snapshot.open_snapshot(filename)
+            fetched = [(pm, pmschedulevalidator.fetch_pm(pm, connection, "US/Eastern")) for pm in pms]
+            connection.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        options = check_options(align=True)
+        for pm, (events, tasks) in fetched:
+            expected = pmschedulevalidator.check_pm(pm['TRIIDTX'], pm['TRINAMETX'], None,
+                                                    grouped=pmschedulevalidator.is_grouped(pm),
+                                                    events=events, tasks=tasks, **options)
+
+            # Through pickle, like a process pool
+            job = pickle.loads(pickle.dumps(pmschedulevalidator.pack_job(pm, events, tasks, options)))
+            packed = pickle.loads(pickle.dumps(pmschedulevalidator.check_packed(job)))
+
+            self.assertEqual(expected, pmschedulevalidator.unpack_result(packed))
+            self.assertEqual(packed, pmschedulevalidator.pack_result(expected))
+
+class TestConstantMemory(unittest.TestCase):
+    """
+    Tests the tables of a workbook written in constant memory mode
+    """
+    NS = {'x': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+
+    def test_tables(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "test.snapshot")
+            pms = write_pm_snapshot(filename, 3)
+            outputfile = os.path.join(tmpdir, "axiom.xlsx")
+
+            connection = snapshot.open_snapshot(filename)
+            report = pmschedulevalidator.ExcelReport(outputfile, pms, "http://localhost", constant_memory=True)
+            for pm, result in check_pms(pms, connection, **check_options()):
+                report.add_pm(pm, pmschedulevalidator.is_grouped(pm), result)
+                # Still in constant memory mode after adding the table
+                self.assertTrue(pmschedulevalidator.is_constant_memory(report.workbook.worksheets()[-1]))
+            report.close()
+            connection.close()
+
+            with zipfile.ZipFile(outputfile) as xlsx:
+                tables = {}
+                for name in xlsx.namelist():
+                    if name.startswith("xl/tables/"):
+                        table = ElementTree.fromstring(xlsx.read(name))
+                        tables[table.get('name')] = table.get('ref')
+                sheets = [ElementTree.fromstring(xlsx.read("xl/worksheets/sheet{}.xml".format(i)))
+                          for i in range(1, 5)]
+        finally:
+            shutil.rmtree(tmpdir)
+
+        # The Index and the tasks of each PM. PM0002 has no tasks.
+        self.assertEqual(tables, {'Table1': 'A1:I4', 'TablePM0000': 'A5:F15', 'TablePM0001': 'A5:F15',
+                                  'TablePM0002': 'A5:F6'})
+
+        for sheet, header_row, headers in [(sheets[0], '1', ['PM ID', 'PM Schedule', 'Recurrence']),
+                                           (sheets[1], '5', ['Task ID', 'Status', 'Planned Start Date']),
+                                           (sheets[2], '5', ['Task Count', 'Status', 'Planned Start Date'])]:
+            row = sheet.find(".//x:row[@r='{}']".format(header_row), self.NS)
+            cells = row.findall('x:c', self.NS)
+            self.assertTrue(all(cell.get('t') == 'inlineStr' for cell in cells))
+            self.assertEqual(headers, [cell.find('x:is/x:t', self.NS).text for cell in cells[:3]])
+
+    def test_xlsxwriter_internals(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            workbook = xlsxwriter.Workbook(os.path.join(tmpdir, "axiom.xlsx"), {'constant_memory': True})
+            worksheet = workbook.add_worksheet()
+            # The private parts of xlsxwriter that constant memory mode uses
+            pmschedulevalidator.check_constant_memory(worksheet)
+            self.assertTrue(pmschedulevalidator.is_constant_memory(worksheet))
+            self.assertTrue(callable(worksheet._opt_close))
+            workbook.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertRaises(CommandError, pmschedulevalidator.check_constant_memory, object())
+
+class TestReports(unittest.TestCase):
+    """
+    Tests the task and summary files of the CSV and JSON Lines reports
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(self.tmpdir, "test.snapshot")
+        pm, = write_pm_snapshot(filename, 1)
+
+        connection = snapshot.open_snapshot(filename)
+        (pm_id, self.result), = read_results(check_pms([pm], connection, **check_options()))
+        connection.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, report_format, **changes):
+        outputfile = os.path.join(self.tmpdir, "axiom." + report_format)
+        pm = {'TRIIDTX': 'PM0000', 'TRINAMETX': "Daily 0", 'TRIPMTYPECLASSCL': 'DAILY'}
+
+        report = reports.REPORTS[report_format](outputfile)
+        report.add_pm(pm, False, dict(self.result, rows=iter(self.result['rows']), **changes))
+        report.close()
+        return outputfile, reports.summary_file_name(outputfile)
+
+    def check(self, rows, summaries):
+        self.assertEqual(10, len(rows))
+        self.assertEqual(rows[0], {'pm_id': 'PM0000', 'task_id': 'PM0000-0', 'status': 'Active',
+                                   'planned_start_date': '2016-01-04 08:00:00-05:00',
+                                   'expected_date': '2016-01-04 08:00:00-05:00', 'valid': True, 'match': None})
+        # A day late
+        self.assertFalse(rows[2]['valid'])
+
+        summary, = summaries
+        self.assertEqual((summary['pm_id'], summary['valid'], summary['invalid'], summary['total']),
+                         ('PM0000', self.result['ok_count'], 10 - self.result['ok_count'], 10))
+        self.assertEqual(sum(row['valid'] for row in rows), summary['valid'])
+        self.assertEqual(summary['rrule'], self.result['rrule'])
+        self.assertFalse(summary['timeout'])
+
+    def test_csv(self):
+        outputfile, summary_file = self.write('csv')
+
+        def read(filename, fields):
+            with open(filename, newline="", encoding="utf-8") as f:
+                reader = csv.DictReader(f)
+                self.assertEqual(list(fields), reader.fieldnames)
+                return list(reader)
+
+        rows = read(outputfile, reports.ROW_FIELDS)
+        summaries = read(summary_file, reports.SUMMARY_FIELDS)
+
+        # Everything is text in a CSV file
+        for row in rows:
+            row['valid'] = row['valid'] == 'True'
+            row['match'] = row['match'] or None
+        for summary in summaries:
+            for field in ('valid', 'invalid', 'total'):
+                summary[field] = int(summary[field])
+
+        self.check(rows, summaries)
+
+    def test_jsonl(self):
+        outputfile, summary_file = self.write('jsonl')
+
+        def read(filename):
+            with open(filename, encoding="utf-8") as f:
+                return [json.loads(line) for line in f]
+
+        self.check(read(outputfile), read(summary_file))
+
+    def test_timeout(self):
+        # Stopped by its budget after the first rows
+        outputfile, summary_file = self.write('jsonl', timeout=1.5, total=3, ok_count=3)
+
+        with open(summary_file, encoding="utf-8") as f:
+            summary = json.loads(f.read())
+        self.assertEqual((1.5, 3), (summary['timeout'], summary['total']))
+
+class TestStateFile(unittest.TestCase):
+    """
+    Tests reusing saved results only for PMs and options that did not change
+    """
+    WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "test.snapshot")
+        self.pms = write_pm_snapshot(self.filename, 4)
+        self.connection = snapshot.open_snapshot(self.filename)
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.tmpdir)
+
+    def run_with_state(self, state, **options):
+        return read_results(check_pms(self.pms, self.connection, state=state, **check_options(**options)))
+
+    def test_reuse(self):
+        state = StateStore(os.path.join(self.tmpdir, "state.db"))
+        expected = self.run_with_state(state)
+
+        with mock.patch('axiom.pmschedulevalidator.parse_event', side_effect=AssertionError), \
+             mock.patch('axiom.pmschedulevalidator.check_pm', side_effect=AssertionError):
+            self.assertEqual(expected, self.run_with_state(state))
+            # Printing more does not change the results
+            self.assertEqual(expected, self.run_with_state(state, verbosity=1))
+
+        # Other options validate everything again
+        check_pm = pmschedulevalidator.check_pm
+        with mock.patch('axiom.pmschedulevalidator.check_pm', side_effect=check_pm) as checked:
+            self.run_with_state(state, align=True)
+        self.assertEqual(4, checked.call_count)
+        state.close()
+
+    def fingerprint(self, change=None, pm_id='PM0003', **options):
+        """
+        The fingerprint of a PM after ``change(pm, events, tasks)``.
+        """
+        pm = dict(next(pm for pm in self.pms if pm['TRIIDTX'] == pm_id))
+        events, tasks = pmschedulevalidator.fetch_pm(pm, self.connection, "US/Eastern")
+        if change:
+            change(pm, events, tasks)
+        return pmschedulevalidator.get_fingerprint(pm, events, tasks, check_options(**options))
+
+    def test_changes(self):
+        def event(field, value):
+            def change(pm, events, tasks):
+                events[0][field] = value
+            return change
+
+        def later(rows, field):
+            def change(pm, events, tasks):
+                rows(events, tasks)[0][field] += datetime.timedelta(days=1)
+            return change
+
+        def task_status(pm, events, tasks):
+            tasks[1]['TASK_STATUS'] = 'Closed'
+
+        def new_task(pm, events, tasks):
+            tasks.append(dict(tasks[-1], TASK_ID='New'))
+
+        def grouped(pm, events, tasks):
+            pm['TRITASKGROUPINGRULELI'] = GROUPED
+
+        changes = {
+            'event': event('DAILYRECURRENCEDAYS', 2),
+            'end option': event('TRIRECURRENCEENDOPTI', 'No End Date'),
+            'start': later(lambda events, tasks: [events[0]], 'EVENTSTARTDATE'),
+            'include': later(lambda events, tasks: events[0]['_INCLUDES'], 'INC_STARTDT'),
+            'exclude start': later(lambda events, tasks: events[0]['_EXCLUDES'], 'EXCL_STARTDT'),
+            'exclude end': later(lambda events, tasks: events[0]['_EXCLUDES'], 'EXCL_ENDDT'),
+            'task date': later(lambda events, tasks: tasks, 'TRIPLANNEDSTARTDT'),
+            'task status': task_status,
+            'new task': new_task,
+            'grouped': grouped,
+        }
+
+        same = self.fingerprint()
+        self.assertEqual(same, self.fingerprint(verbosity=2))
+
+        for name, change in changes.items():
+            self.assertNotEqual(same, self.fingerprint(change), name)
+
+        plant = WorkingCalendar('Plant', {day: ['07:00-15:30'] for day in self.WEEKDAYS})
+        options = {
+            'timezone': "US/Central",
+            'working_calendar': "24/7",
+            'strip_time': True,
+            'since': datetime.datetime(2016, 1, 6),
+            'until': datetime.datetime(2016, 1, 10),
+            'align': True,
+            'epoch_ms': True,
+            'summary_only': True,
+        }
+        for name, value in options.items():
+            self.assertNotEqual(same, self.fingerprint(**{name: value}), name)
+
+        # Calendars with the same name but other hours or holidays
+        with_breaks = WorkingCalendar('Plant', {day: ['07:00-15:30'] for day in self.WEEKDAYS},
+                                      breaks=['11:30-12:00'])
+        with_holidays = WorkingCalendar('Plant', {day: ['07:00-15:30'] for day in self.WEEKDAYS},
+                                        holidays=['2016-01-01'])
+        fingerprints = [self.fingerprint(working_calendar=calendar) for calendar in (plant, with_breaks, with_holidays)]
+        self.assertEqual(3, len(set(fingerprints)))
+        self.assertEqual(fingerprints[0], self.fingerprint(
+            working_calendar=WorkingCalendar('Plant', {day: ['07:00-15:30'] for day in self.WEEKDAYS})))
+
+class TestSummaryOnly(unittest.TestCase):
+    """
+    Tests counting the rows without keeping them
+    """
+    def test_same_counts(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "test.snapshot")
+            pms = write_pm_snapshot(filename, 4)
+            connection = snapshot.open_snapshot(filename)
+            summaries = {}
+            for align in (False, True):
+                full = read_results(check_pms(pms, connection, **check_options(align=align)))
+                summary = read_results(check_pms(pms, connection, **check_options(align=align, summary_only=True)))
+                summaries[align] = summary
+
+                for (pm_id, result), (summary_pm_id, counted) in zip(full, summary):
+                    self.assertEqual(pm_id, summary_pm_id)
+                    self.assertEqual([], counted['rows'])
+                    first_mismatch = next((row for row in result['rows'] if not row[4]), None)
+                    self.assertEqual(dict(result, rows=[], first_mismatch=first_mismatch), counted)
+
+                # Only the PM without tasks has no mismatch
+                self.assertEqual([pm_id for pm_id, counted in summary if counted['first_mismatch'] is None],
+                                 ['PM0002'])
+
+            # The Index has the counts and the first invalid task
+            outputfile = os.path.join(tmpdir, "axiom.xlsx")
+            report = pmschedulevalidator.ExcelReport(outputfile, pms, "http://localhost", constant_memory=True,
+                                                     summary_only=True)
+            for pm, result in check_pms(pms, connection, **check_options(summary_only=True)):
+                report.add_pm(pm, pmschedulevalidator.is_grouped(pm), result)
+            report.close()
+            connection.close()
+
+            with zipfile.ZipFile(outputfile) as xlsx:
+                self.assertEqual(["xl/worksheets/sheet1.xml"],
+                                 [name for name in xlsx.namelist() if name.startswith("xl/worksheets/sheet")])
+                index = ElementTree.fromstring(xlsx.read("xl/worksheets/sheet1.xml"))
+        finally:
+            shutil.rmtree(tmpdir)
+
+        ns = TestConstantMemory.NS
+        cells = dict((cell.get('r'), cell.findtext('x:v', None, ns) or cell.findtext('x:is/x:t', None, ns))
+                     for cell in index.iter('{{{}}}c'.format(ns['x'])))
+
+        for row, (pm_id, counted) in enumerate(summaries[False], start=2):
+            self.assertEqual(pm_id, cells["A{}".format(row)])
+            self.assertEqual([str(counted['ok_count']), str(counted['total'] - counted['ok_count']),
+                              str(counted['total'])],
+                             [cells["{}{}".format(column, row)] for column in "EFG"])
+            first_mismatch = counted['first_mismatch']
+            self.assertEqual(cells.get("I{}".format(row)), first_mismatch and str(first_mismatch[0]))
+
+    def test_print_worst(self):
+        def summary(invalid, total, pm_id):
+            return (invalid, total, pm_id, ("T" + pm_id, 'Active', "planned", "expected", False, None))
+
+        summaries = [summary(2, 10, 'PM1'), summary(0, 10, 'PM2'), summary(5, 10, 'PM3'),
+                     summary(2, 20, 'PM4'), summary(1, 10, 'PM5')]
+
+        def worst(top):
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                pmschedulevalidator.print_worst(summaries, top)
+            return [line.split(":")[0] for line in stdout.getvalue().splitlines()[1:]]
+
+        self.assertEqual(worst(3), ['PM3', 'PM4', 'PM1'])
+        # PM2 has no invalid tasks
+        self.assertEqual(worst(10), ['PM3', 'PM4', 'PM1', 'PM5'])
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            pmschedulevalidator.print_worst([summary(0, 10, 'PM2')], 10)
+        self.assertEqual("All tasks are valid.\n", stdout.getvalue())
+
+class TestWorkers(unittest.TestCase):
+    """
+    Tests validating in worker threads with saved results
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "test.snapshot")
+        self.pms = write_pm_snapshot(self.filename, 12)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_workers(self, state, bulk_load=False):
+        connection = snapshot.open_snapshot(self.filename)
+        try:
+            return read_results(check_pms(self.pms, connection, snapshot.SnapshotPool(self.filename), workers=3,
+                                          bulk_load=bulk_load, chunk_size=5, state=state, **check_options()))
+        finally:
+            connection.close()
+
+    def test_state_file(self):
+        connection = snapshot.open_snapshot(self.filename)
+        expected = read_results(check_pms(self.pms, connection, **check_options()))
+        connection.close()
+
+        for bulk_load in (False, True):
+            state = StateStore(os.path.join(self.tmpdir, "state{}.db".format(bulk_load)))
+            self.assertEqual(expected, self.run_workers(state, bulk_load))
+
+            # Everything is reused
+            with mock.patch('axiom.pmschedulevalidator.check_pm', side_effect=AssertionError):
+                self.assertEqual(expected, self.run_workers(state, bulk_load))
+            state.close()
+
+    def test_fetch_in_workers(self):
+        threads = set()
+        fetch_pm = pmschedulevalidator.fetch_pm
+
+        def fetch(*args, **kwargs):
+            threads.add(threading.current_thread())
+            return fetch_pm(*args, **kwargs)
+
+        state = StateStore(os.path.join(self.tmpdir, "state.db"))
+        with mock.patch('axiom.pmschedulevalidator.fetch_pm', side_effect=fetch):
+            self.run_workers(state)
+        state.close()
+
+        self.assertTrue(threads)
+        self.assertNotIn(threading.main_thread(), threads)
+
+class TestEvent(unittest.TestCase):
+    """
+    Tests reading events as ``Event`` records
+    """
+    def test_recurrence_query(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "test.snapshot")
+            db = snapshot.create_snapshot(filename)
+            snapshot.write_rows(db, 'events', 'PM_ID', [
+                {'NOTES': 'Long text', 'PM_ID': 'PM1', 'EVENT_SPEC_ID': 10, 'RECURRENCEPATTERNTYPE': 'DAILY'},
+            ])
+            db.commit()
+            db.close()
+
+            connection = snapshot.open_snapshot(filename)
+            event, = execute(SQL_GET_RECURRENCE, connection, {'pm_id': 'PM1'},
+                             factory=pmeventparser.Event.factory)
+            connection.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual(event['RECURRENCEPATTERNTYPE'], 'DAILY')
+        self.assertEqual(event['EVENT_SPEC_ID'], 10)
+        # Not in the snapshot
+        self.assertIsNone(event['EVENTSTARTDATE'])
+        # Not fetched
+        self.assertNotIn('NOTES', event)
+        self.assertIsNone(event.get('NOTES'))
+        with self.assertRaises(KeyError):
+            event['NOTES']
+
+    def test_columns_in_another_order(self):
+        make = pmeventparser.Event.factory(['NOTES', 'EVENT_SPEC_ID', 'PM_ID'])
+        event = make(('Long text', 10, 'PM1'))
+        self.assertEqual(event.keys(), ['PM_ID', 'EVENT_SPEC_ID'])
+        self.assertIs(pmeventparser.Event.factory(list(EVENT_FIELDS)), pmeventparser.Event)
+
+class TestPipeline(unittest.TestCase):
+    """
+    Tests the stages of ``run_pipeline``
+    """
+    def test_order_and_errors(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        def fetch(batch):
+            if 'bad fetch' in batch:
+                raise Exception("Fetch failed")
+            return [item.upper() for item in batch]
+
+        def compute(item, value):
+            if item == 'bad compute':
+                raise Exception("Compute failed")
+            return compute_executor.submit(lambda: value + "!")
+
+        written = []
+        with ThreadPoolExecutor(4) as fetch_executor, ThreadPoolExecutor(4) as compute_executor:
+            batches = [['a', 'b'], ['bad fetch', 'c'], ['bad compute'], ['d']]
+            depths = run_pipeline(batches, fetch, compute, lambda item, result: written.append((item, result)),
+                                  fetch_executor, queue_size=1)
+
+        self.assertEqual(written, [('a', 'A!'), ('b', 'B!'), ('bad fetch', None), ('c', None),
+                                   ('bad compute', None), ('d', 'D!')])
+        self.assertTrue(all(queue.peak <= 1 for queue in depths))
+
+class TestBudget(unittest.TestCase):
+    """
+    Tests that expanding a rule stops when the budget runs out
+    """
+    def test_slow_rule(self):
+        from dateutil.rrule import rrule, rruleset, DAILY
+        # There is no February 30. dateutil searches for seconds.
+        ruleset = rruleset()
+        ruleset.rrule(rrule(DAILY, datetime.datetime(2016, 1, 4, 9), bymonth=2, bymonthday=30))
+
+        cache = OccurrenceCache()
+        with Budget(0.2) as budget:
+            self.assertRaises(BudgetExceeded, cache.get(ruleset, "8to5").get, 0, 1)
+        self.assertLess(budget.elapsed(), 2)
+        self.assertIsNone(sys.gettrace())
+
+        # The broken expansion is not reused
+        self.assertFalse(cache.get(ruleset, "8to5").broken)
+        self.assertEqual(2, cache.misses)
+
+    def test_max_occurrences(self):
+        cache = OccurrenceCache()
+        rule = TestOccurrenceCache.make_rule(None, count=20)
+        with Budget(max_occurrences=10):
+            cache.get(rule, "8to5").get(0, 10)
+            self.assertRaises(BudgetExceeded, cache.get(rule, "8to5").get, 10, 20)
+
+    def test_time_outside(self):
+        budget = Budget(0.05)
+        with budget:
+            pass
+        # Not entered, e.g. while the rows are written
+        time.sleep(0.1)
+        with budget:
+            with budget.paused():
+                time.sleep(0.1)
+            budget.check()
+        self.assertLess(budget.elapsed(), 0.05)
+
+        with budget:
+            time.sleep(0.1)
+            self.assertRaises(BudgetExceeded, budget.check)
+
+    def test_slow_writer(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "test.snapshot")
+            pm = write_pm_snapshot(filename, 1)[0]
+            connection = snapshot.open_snapshot(filename)
+            result = pmschedulevalidator.check_pm(pm['TRIIDTX'], pm['TRINAMETX'], connection, "US/Eastern",
+                                                  verbosity=0, stream=True, time_budget=0.5)
+            rows = []
+            for row in result['rows']:
+                time.sleep(0.1)
+                rows.append(row)
+            connection.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual(10, len(rows))
+        self.assertIsNone(result['timeout'])
+
+    def test_shared_broken_rule(self):
+        cache = OccurrenceCache()
+        rule = TestOccurrenceCache.make_rule(None)
+        occurrences = cache.get(rule, "8to5")
+        first = occurrences.get(0, 3)
+        # As if another PM with the same rule ran out of budget
+        occurrences.broken = True
+
+        expected, coerced = occurrences.get(0, 20)
+        self.assertEqual(list(TestOccurrenceCache.make_rule(None)), expected)
+        self.assertEqual(first[0], expected[:3])
+        self.assertFalse(occurrences.broken)
+
+class TestExport(unittest.TestCase):
+    """
+    Tests the iCalendar form of a rule
+    """
+    def test_skipped_month(self):
+        from dateutil.rrule import rrule, rruleset, MONTHLY, DAILY
+        ruleset = rruleset()
+        ruleset.rrule(rrule(MONTHLY, datetime.datetime(2016, 1, 4, 9), count=6, bymonthday=4))
+        ruleset.rdate(datetime.datetime(2016, 6, 18, 9))
+        ruleset.exrule(rrule(DAILY, datetime.datetime(2016, 1, 4, 9), bymonth=[3]))
+
+        definition = recurrence_definition(ruleset, list(ruleset))
+
+        self.assertEqual(definition, {
+            'dtstart': datetime.datetime(2016, 1, 4, 9),
+            'rrules': ['FREQ=MONTHLY;COUNT=6;BYMONTHDAY=4'],
+            'rdates': [datetime.datetime(2016, 6, 18, 9)],
+            'exdates': [datetime.datetime(2016, 3, 4, 9)],
+        })
+
+    def test_fold(self):
+        lines = fold("DESCRIPTION:" + "\u00e9" * 100).split("\r\n")
+        self.assertTrue(all(len(line.encode("utf-8")) <= 75 for line in lines))
+        self.assertEqual("DESCRIPTION:" + "\u00e9" * 100, "".join(line[1:] if i else line for i, line in enumerate(lines)))
+
+    def test_vtimezone(self):
+        lines = export.vtimezone("US/Eastern")
+        self.assertEqual(["BEGIN:VTIMEZONE", "TZID:US/Eastern"], lines[:2])
+        self.assertEqual(["BEGIN:STANDARD", "DTSTART:19691231T190000", "TZOFFSETFROM:-0500",
+                          "TZOFFSETTO:-0500", "TZNAME:EST", "END:STANDARD"], lines[2:8])
+
+        daylight = lines[lines.index("BEGIN:DAYLIGHT"):lines.index("END:DAYLIGHT")]
+        self.assertEqual("DTSTART:19700426T020000", daylight[1])
+        # The second Sunday of March, at 2:00 AM EST
+        self.assertIn("20160313T020000", daylight[2].split(":")[1].split(","))
+        self.assertEqual(["TZOFFSETFROM:-0500", "TZOFFSETTO:-0400", "TZNAME:EDT"], daylight[3:])
+
+        self.assertEqual(["BEGIN:VTIMEZONE", "TZID:Asia/Kolkata", "BEGIN:STANDARD", "DTSTART:19700101T053000",
+                          "TZOFFSETFROM:+0530", "TZOFFSETTO:+0530", "TZNAME:IST", "END:STANDARD", "END:VTIMEZONE"],
+                         export.vtimezone("Asia/Kolkata"))
+
+    def test_ics_file(self):
+        from dateutil.rrule import rrule, rruleset, DAILY
+        ruleset = rruleset()
+        ruleset.rrule(rrule(DAILY, datetime.datetime(2016, 1, 4, 9), count=3))
+        rules = [ruleset, rruleset()]
+        events = [{'PM_ID': "PM{}".format(i), 'PM_NAME': "Daily", 'EVENT_SPEC_ID': i} for i in range(2)]
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "test.ics")
+            with mock.patch.object(export, 'parse_event', side_effect=[(rule, "Daily") for rule in rules]):
+                counts = export.export_events(events, filename, None, "US/Eastern", "8to5")
+            with open(filename, encoding="utf-8", newline="") as f:
+                lines = f.read().split("\r\n")
+        finally:
+            shutil.rmtree(tmpdir)
+
+        # The event without dates is left out
+        self.assertEqual((1, 1), counts)
+        self.assertEqual(1, lines.count("BEGIN:VEVENT"))
+        self.assertIn("DTSTART;TZID=US/Eastern:20160104T090000", lines)
+        # The TZID is defined before it is used
+        self.assertLess(lines.index("TZID:US/Eastern"), lines.index("BEGIN:VEVENT"))
+
+class TestForecast(unittest.TestCase):
+    """
+    Tests counting dates into building and week bins
+    """
+    def test_weeks(self):
+        bins = Bins(datetime.datetime(2016, 1, 6), datetime.datetime(2016, 1, 20), 7)
+        self.assertEqual(bins.starts, [datetime.date(2016, 1, 4), datetime.date(2016, 1, 11),
+                                       datetime.date(2016, 1, 18)])
+
+        counts = Counts(bins)
+        dates = numpy.array([to_us(datetime.datetime(2016, 1, day, 9)) for day in (6, 8, 11, 19, 19)])
+        # Two PMs in B1, the second one grouped with 3 tasks, and one in B2
+        counts.add(['PM1', 'PM2', 'PM3'], ['B1', 'B1', 'B2'], [1, 3, 1],
+                   (dates, numpy.array([0, 1, 1, 2, 0]), []))
+
+        self.assertEqual([(building, row.tolist()) for building, row in counts.rows()],
+                         [('B1', [4, 3, 1]), ('B2', [0, 0, 1])])
+
+    def test_multiplicity(self):
+        def task(pm_id, day, tasks, status='Active'):
+            return {'PM_ID': pm_id, 'TRIPLANNEDSTARTDT': datetime.datetime(2016, 1, day, 9), 'TASK_ID': tasks,
+                    'TASK_STATUS': status}
+
+        # Four assets. One occurrence is split across two statuses and the
+        # tasks of the latest are not all created yet.
+        tasks = [task('PM1', 4, 3), task('PM1', 4, 1, 'Closed'), task('PM1', 5, 4), task('PM1', 6, 2),
+                 task('PM2', 4, 1)]
+        with mock.patch.object(pmforecast, 'execute_in', return_value=tasks):
+            self.assertEqual({'PM1': 4, 'PM2': 1}, pmforecast.get_multiplicity(None, ['PM1', 'PM2']))
+
+    def test_window(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "test.snapshot")
+            pms = write_pm_snapshot(filename, 4)
+            connection = snapshot.open_snapshot(filename)
+            since, until = datetime.datetime(2016, 6, 4), datetime.datetime(2016, 7, 1)
+            job, pm_ids, buildings, weights = pmforecast.fetch_chunk(connection, pms, "US/Eastern", since, until,
+                                                                     "8to5", 5000)
+            events = [pmeventparser.unpack_event(event) for event in job[0]]
+            connection.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        dates, owner, failed = pmforecast.expand_chunk(job)
+
+        # The same as expanding each rule from its start
+        expected = []
+        for i, event in enumerate(events):
+            rules = pmeventparser.parse_event(event, default_count=5000, verbosity=0)[0]
+            working = pmeventparser.restrict_to_working_calendar_array(
+                [date for date in rules if date < until], "8to5").astype(numpy.int64)
+            expected.extend((date, i) for date in working.tolist() if to_us(since) <= date < to_us(until))
+
+        self.assertEqual([], failed)
+        self.assertTrue(expected)
+        self.assertEqual(expected, list(zip(dates.tolist(), owner.tolist())))
+
+class TestServe(unittest.TestCase):
+    """
+    Tests answering requests without a database
+    """
+    def setUp(self):
+        self.service = Service(None, "US/Eastern", "8to5")
+
+    def test_bad_requests(self):
+        self.assertEqual(self.service.handle("/validate")[0], 404)
+        self.assertEqual(self.service.handle("/expand/PM1?count=x")[0], 400)
+        self.assertEqual(self.service.handle("/expand/PM1?bogus=1")[0], 400)
+
+        status, response = self.service.handle("/health")
+        self.assertEqual(status, 200)
+        self.assertEqual((response['requests'], response['errors']), (3, 3))
+
+class TestStartup(unittest.TestCase):
+    """
+    Tests that --help and shell completion don't import the commands
+    """
+    def test_no_heavy_imports(self):
+        code = ("import sys, axiom.axiom; "
+                "print(' '.join(name for name in ('cx_Oracle', 'numpy', 'dateutil', 'pytz', 'xlsxwriter', 'tqdm') "
+                "if name in sys.modules))")
+        root = os.path.join(os.path.dirname(__file__), "..", "..")
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=root, universal_newlines=True)
+        self.assertEqual(output.strip(), "")
+
+    def test_help_lists_commands(self):
+        root = os.path.join(os.path.dirname(__file__), "..", "..")
+        output = subprocess.check_output([sys.executable, "-m", "axiom", "--help"], cwd=root,
+                                         universal_newlines=True)
+        self.assertIn("Other commands: snapshot, forecast, serve.", output)
+
+    def test_command_name_as_pm_id(self):
+        from ..axiom import COMMANDS, make_parser, schedulevalidator_entry
+        from ..commands import schedulevalidator
+
+        with mock.patch('axiom.axiom.run_command') as run_command:
+            for argv in (["serve", "--port", "8000"], ["--", "serve"], ["PM1", "serve"]):
+                with mock.patch.object(sys, 'argv', ["axiom"] + argv):
+                    schedulevalidator_entry()
+        self.assertEqual([call[0][:2] for call in run_command.call_args_list],
+                         [(COMMANDS['serve'], ["--port", "8000"]),
+                          (schedulevalidator, ["--", "serve"]),
+                          (schedulevalidator, ["PM1", "serve"])])
+
+        args = make_parser(schedulevalidator).parse_args(["--from-snapshot", "prod.snapshot", "--", "serve"])
+        self.assertEqual(["serve"], args.pm_id)
+
+class TestProfiler(unittest.TestCase):
+    """
+    Tests the spans of ``--profile``
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_trace_and_summary(self):
+        filename = os.path.join(self.tmpdir, "trace.json")
+        profiler.start(filename)
+        with profiler.span('check_pm', 'PM1'):
+            with profiler.query_span(SQL_GET_TASKS):
+                pass
+        summary = profiler.stop()
+
+        self.assertIs(profiler.span('check_pm'), profiler._NULL_SPAN)
+
+        with open(filename) as f:
+            events = [event for event in json.load(f)['traceEvents'] if event['ph'] == 'X']
+        self.assertEqual([(event['cat'], event['name']) for event in events],
+                         [('query', 'SQL_GET_TASKS'), ('check_pm', 'PM1')])
+
+        with open(profiler.summary_file_name(filename)) as f:
+            self.assertEqual(summary, f.read())
+        self.assertIn("check_pm", summary)
+
+    def test_stopped_when_run_fails(self):
+        filename = os.path.join(self.tmpdir, "trace.json")
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            with self.assertRaises(CommandError):
+                pmschedulevalidator.schedulevalidator(["PM1"], site_url="", working_calendar="NOSUCH",
+                                                      profile=filename)
+
+        self.assertIs(profiler.span('check_pm'), profiler._NULL_SPAN)
+        self.assertTrue(os.path.exists(filename))
+
 if __name__ == '__main__':
     unittest.main()
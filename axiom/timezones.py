@@ -0,0 +1,112 @@
+"""
+Convert whole arrays of dates between UTC and a local timezone.
+
+The dates are int64 microseconds since 1970-01-01: UTC instants, or naive
+local wall times. The UTC offsets come from the transition table of the pytz
+timezone, so the results are the same as converting each date with pytz.
+"""
+
+import functools
+import numpy
+
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+ONE_US = timedelta(microseconds=1)
+
+US_PER_HOUR = 60 * 60 * 1000000
+US_PER_DAY = 24 * US_PER_HOUR
+
+@functools.lru_cache(maxsize=None)
+def get_transition_table(timezone):
+    """
+    Returns the ``TransitionTable`` of a timezone name. They are cached.
+    """
+    import pytz
+    return TransitionTable(pytz.timezone(timezone))
+
+class TransitionTable:
+    """
+    The UTC offset periods of a pytz timezone. Period ``i`` starts at
+    ``times[i]`` (UTC) and its dates use ``tzinfos[i]``.
+    """
+
+    def __init__(self, tz):
+        if hasattr(tz, '_utc_transition_times'):
+            times = tz._utc_transition_times
+            infos = tz._transition_info
+            self.tzinfos = [tz._tzinfos[info] for info in infos]
+        else:
+            # Same offset at all times, e.g. UTC
+            times = [datetime(1, 1, 1)]
+            infos = [(tz.utcoffset(EPOCH), tz.dst(EPOCH), None)]
+            self.tzinfos = [tz]
+
+        self.times = numpy.array([(time - EPOCH) // ONE_US for time in times], numpy.int64)
+        self.offsets = numpy.array([utcoffset // ONE_US for utcoffset, dst, name in infos], numpy.int64)
+        self.dst = numpy.array([bool(dst) for utcoffset, dst, name in infos])
+
+    def period(self, utc):
+        """
+        The period of each UTC instant.
+        """
+        return numpy.maximum(numpy.searchsorted(self.times, utc, side='right') - 1, 0)
+
+    def to_local(self, utc):
+        """
+        Convert UTC instants to local wall times, like ``localize_date``.
+        Returns the wall times and their periods.
+        """
+        period = self.period(utc)
+        return utc + self.offsets[period], period
+
+    def localize(self, local):
+        """
+        Convert local wall times to UTC instants, like ``tz.localize`` with
+        ``is_dst=False``. Returns the instants and the periods of the tzinfo
+        that pytz would give them.
+        """
+        # The candidates are the offsets a day before and after, as in pytz.
+        # A candidate is valid if its instant really has that offset.
+        offset1 = self.offsets[self.period(local - US_PER_DAY)]
+        offset2 = self.offsets[self.period(local + US_PER_DAY)]
+
+        utc1 = local - offset1
+        utc2 = local - offset2
+        period1 = self.period(utc1)
+        period2 = self.period(utc2)
+        valid1 = self.offsets[period1] == offset1
+        valid2 = self.offsets[period2] == offset2
+
+        utc = numpy.where(valid1, utc1, utc2)
+        period = numpy.where(valid1, period1, period2)
+
+        # Ambiguous, at the end of DST. Prefer the one that is not DST, or
+        # the later one.
+        ambiguous = valid1 & valid2 & (utc1 != utc2)
+        if ambiguous.any():
+            standard1 = ~self.dst[period1]
+            standard2 = ~self.dst[period2]
+            pick2 = numpy.where(standard1 == standard2, utc2 > utc1, standard2)
+            utc = numpy.where(ambiguous & pick2, utc2, utc)
+            period = numpy.where(ambiguous & pick2, period2, period)
+
+        # Skipped, at the start of DST. pytz uses the time 6 hours earlier and
+        # adds 6 hours back, keeping its offset.
+        skipped = ~(valid1 | valid2)
+        if skipped.any():
+            utc = utc.copy()
+            period = period.copy()
+            earlier_utc, earlier_period = self.localize(local[skipped] - 6 * US_PER_HOUR)
+            utc[skipped] = earlier_utc + 6 * US_PER_HOUR
+            period[skipped] = earlier_period
+
+        return utc, period
+
+    def to_datetimes(self, local, period):
+        """
+        Make aware datetimes from local wall times and their periods.
+        """
+        naive = local.astype('datetime64[us]').astype(object).tolist()
+        tzinfos = self.tzinfos
+        return [date.replace(tzinfo=tzinfos[i]) for date, i in zip(naive, period.tolist())]
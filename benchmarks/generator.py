@@ -0,0 +1,180 @@
+"""
+Generate synthetic PM Schedules, events and tasks.
+
+The rows have the same shape as the ones returned by the queries in
+``axiom/queries.py``: dates are naive UTC and the events have the
+``T_PMEVENT`` columns that ``parse_event`` reads. Every recurrence pattern,
+daily/monthly/yearly option, end option, skip months, includes and excludes
+are used in turn.
+
+The tasks follow the recurrence of their event, moved into the 8to5 working
+calendar, except that every seventh task is a day late so that some tasks
+are invalid.
+"""
+
+import copy
+import itertools
+import pytz
+import random
+
+from datetime import datetime, timedelta
+
+from axiom.pmeventparser import parse_event, prepare_event, month_map, weekday_map, weekofmonth_map
+from axiom.pmeventparser import restrict_to_working_calendar
+
+MONTHS = list(month_map)
+WEEKDAYS = list(weekday_map)
+WEEKS_OF_MONTH = list(weekofmonth_map)
+
+# (RECURRENCEPATTERNTYPE, option) of each kind of event, in the order they
+# are generated.
+PATTERNS = (
+    ('DAILY', 'Every [x] day(s)'),
+    ('DAILY', 'Every weekday'),
+    ('DAILY', 'Every weekend day'),
+    ('WEEKLY', None),
+    ('MONTHLY', 'Day [x] of every [x] month(s)'),
+    ('MONTHLY', 'The [First] [Monday] of every [x] month(s)'),
+    ('YEARLY', 'Every [May] [1]'),
+    ('YEARLY', 'The [First] [Monday] of [May]'),
+    ('Ad hoc', None),
+    ('Single Occurrence', None),
+)
+
+END_OPTIONS = ('No End Date', 'End After', 'End Date')
+
+# The event columns that are 'TRUE' or 'FALSE'
+FLAG_COLUMNS = (['WEEKLY' + day.upper() for day in WEEKDAYS] +
+                ['TRI' + month.upper() + 'BL' for month in MONTHS])
+
+def generate(count, tasks_per_pm=50, timezone="US/Eastern", seed=0):
+    """
+    Generate ``count`` PM Schedules. Returns a list of dicts with the
+    ``pm`` row, the ``event`` row, its ``includes`` and ``excludes`` and the
+    ``tasks`` rows.
+    """
+    rnd = random.Random(seed)
+    local_tz = pytz.timezone(timezone)
+
+    return [generate_pm(i, rnd, tasks_per_pm, local_tz) for i in range(count)]
+
+def to_utc(local_date, local_tz):
+    return local_tz.localize(local_date).astimezone(pytz.utc).replace(tzinfo=None)
+
+def generate_pm(i, rnd, tasks_per_pm, local_tz):
+    pm_id = "PM{:07d}".format(i)
+    spec_id = 1000000 + i
+    pattern, option = PATTERNS[i % len(PATTERNS)]
+    end_option = END_OPTIONS[i // len(PATTERNS) % len(END_OPTIONS)]
+    grouped = i % 4 == 3
+
+    start = datetime(2014, 1, 1, rnd.randint(6, 18), rnd.choice((0, 30))) + timedelta(days=rnd.randint(0, 365))
+
+    event = dict((column, 'FALSE') for column in FLAG_COLUMNS)
+    event.update({
+        'PM_ID': pm_id,
+        'PM_NAME': "Synthetic {} {}".format(pattern, i),
+        'EVENT_SPEC_ID': spec_id,
+        'EVENTSTARTDATE': to_utc(start, local_tz),
+        'EVENTENDDATE': to_utc(start + timedelta(days=3650), local_tz),
+        'EVENTDURATION': tasks_per_pm,
+        'RECURRENCEPATTERNTYPE': pattern,
+        'TRIRECURRENCEENDOPTI': end_option,
+        'TRIRECURRENCEDAILYOP': None,
+        'DAILYRECURRENCEDAYS': None,
+        'WEEKLYRECURRENCEWEEKS': None,
+        'TRIRECURRENCEMONTHLY': None,
+        'MONTHLYDAYOFMONTH': None,
+        'MONTHLYRECURRENCEMON': None,
+        'MONTHLYDAYOFWEEK': None,
+        'MONTHLYWEEKOFMONTH': None,
+        'TRIRECURRENCEYEARLYO': None,
+        'YEARLYDAYOFMONTH': None,
+        'YEARLYMONTH': None,
+        'YEARLYDAYOFWEEK': None,
+        'YEARLYWEEKOFMONTH': None,
+    })
+
+    if pattern == 'DAILY':
+        event['TRIRECURRENCEDAILYOP'] = option
+        event['DAILYRECURRENCEDAYS'] = rnd.randint(1, 3)
+    elif pattern == 'WEEKLY':
+        event['WEEKLYRECURRENCEWEEKS'] = rnd.randint(1, 4)
+        for day in rnd.sample(WEEKDAYS, rnd.randint(1, 3)):
+            event['WEEKLY' + day.upper()] = 'TRUE'
+    elif pattern == 'MONTHLY':
+        event['TRIRECURRENCEMONTHLY'] = option
+        event['MONTHLYRECURRENCEMON'] = rnd.randint(1, 3)
+        event['MONTHLYDAYOFMONTH'] = rnd.randint(1, 28)
+        event['MONTHLYDAYOFWEEK'] = rnd.choice(WEEKDAYS)
+        event['MONTHLYWEEKOFMONTH'] = rnd.choice(WEEKS_OF_MONTH)
+        # Skip months
+        for month in rnd.sample(MONTHS, rnd.randint(0, 3)):
+            event['TRI' + month.upper() + 'BL'] = 'TRUE'
+    elif pattern == 'YEARLY':
+        event['TRIRECURRENCEYEARLYO'] = option
+        event['YEARLYMONTH'] = rnd.choice(MONTHS)
+        event['YEARLYDAYOFMONTH'] = rnd.randint(1, 28)
+        event['YEARLYDAYOFWEEK'] = rnd.choice(WEEKDAYS)
+        event['YEARLYWEEKOFMONTH'] = rnd.choice(WEEKS_OF_MONTH)
+
+    includes_count = tasks_per_pm if pattern == 'Ad hoc' else rnd.randint(0, 2)
+    includes = [{'SPEC_ID': spec_id,
+                 'INC_STARTDT': to_utc(start + timedelta(days=rnd.randint(1, 3000)), local_tz)}
+                for _ in range(includes_count)]
+
+    excludes = []
+    for _ in range(rnd.randint(0, 2)):
+        excl_start = start + timedelta(days=rnd.randint(1, 3000))
+        excludes.append({'SPEC_ID': spec_id,
+                         'EXCL_STARTDT': to_utc(excl_start, local_tz),
+                         'EXCL_ENDDT': to_utc(excl_start + timedelta(days=rnd.randint(1, 30)), local_tz)})
+
+    pm = {
+        'TRIIDTX': pm_id,
+        'SPEC_ID': spec_id,
+        'TRINAMETX': event['PM_NAME'],
+        'TRIREQUESTCLASSTX': None,
+        'TRIPMSCHEDULETYPELI': None,
+        'TRIPMTYPECLASSCL': pattern,
+        'TRIRULECREATEPROJECT': None,
+        'TRITASKGROUPINGRULELI': 'Create Task For Each Asset/Location' if grouped else None,
+    }
+
+    dates = expected_dates(event, includes, excludes, tasks_per_pm, local_tz)
+    tasks = generate_tasks(pm_id, dates, grouped, rnd, local_tz)
+
+    return {'pm': pm, 'event': event, 'includes': includes, 'excludes': excludes, 'tasks': tasks}
+
+def expected_dates(event, includes, excludes, count, local_tz):
+    """
+    The first ``count`` occurrences of an event in the 8to5 calendar, as
+    naive local dates.
+    """
+    event = copy.deepcopy(event)
+    # Only the dates are needed. 'End Date' is expanded like 'No End Date'.
+    event['TRIRECURRENCEENDOPTI'] = 'No End Date'
+    prepare_event(event, copy.deepcopy(includes), copy.deepcopy(excludes), local_tz)
+
+    rules, description = parse_event(event, verbosity=0)
+    return [restrict_to_working_calendar(date) for date in itertools.islice(rules, count)]
+
+def generate_tasks(pm_id, dates, grouped, rnd, local_tz):
+    tasks = []
+    for i, date in enumerate(dates):
+        if i % 7 == 6:
+            date += timedelta(days=1)
+
+        task = {
+            'TRINAMETX': None,
+            'TRIREQUESTCLASSTX': None,
+            'TRIPMSCHEDULETYPELI': None,
+            'TRIPMTYPECLASSCL': None,
+            'TRIPLANNEDSTARTDT': to_utc(date, local_tz),
+            'TASK_NAME': "Task {}".format(i),
+            'TASK_ID': rnd.randint(1, 5) if grouped else "{}-{}".format(pm_id, i),
+            'TASK_STATUS': rnd.choice(('Active', 'Closed', 'Completed')),
+        }
+        tasks.append(task)
+
+    return tasks
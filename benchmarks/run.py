@@ -0,0 +1,292 @@
+"""
+Time the parts of the validation on synthetic data and save the results as
+JSON. See ``generator.py`` for the data.
+
+Run from the root of the repository::
+
+    python -m benchmarks.run --scales 10 100 1000 -o bench.json
+    python -m benchmarks.run --compare bench.json
+
+Each benchmark is run ``--repeat`` times on fresh copies of the rows and the
+fastest time is kept.
+"""
+
+import argh
+import copy
+import itertools
+import json
+import os
+import platform
+import pytz
+import shutil
+import sys
+import tempfile
+import time
+
+from argh import arg
+from datetime import datetime
+
+from axiom.axiom import __version__
+from axiom.pmeventparser import parse_event, prepare_event, localize_date
+from axiom.pmeventparser import restrict_to_working_calendar, restrict_to_working_calendar_array
+from axiom.pmschedulevalidator import ExcelReport, check_pm, validate_pm, is_grouped
+from axiom.reports import REPORTS
+
+from .generator import generate
+
+def prepared_events(data, local_tz):
+    """
+    Copies of the events, localized and with their includes and excludes.
+    """
+    events = []
+    for item in copy.deepcopy(data):
+        prepare_event(item['event'], item['includes'], item['excludes'], local_tz)
+        events.append(item['event'])
+    return events
+
+def parse_all(events):
+    rules = []
+    errors = 0
+    for event in events:
+        try:
+            rules.append(parse_event(event, verbosity=0)[0])
+        except Exception:
+            errors += 1
+    return rules, errors
+
+def bench_localize_date(data, local_tz):
+    dates = [task['TRIPLANNEDSTARTDT'] for item in data for task in item['tasks']]
+
+    def run(dates):
+        for date in dates:
+            localize_date(date, local_tz)
+        return len(dates), 0
+
+    return lambda: dates, run
+
+def bench_prepare_event(data, local_tz):
+    def run(data):
+        for item in data:
+            prepare_event(item['event'], item['includes'], item['excludes'], local_tz)
+        return len(data), 0
+
+    return lambda: copy.deepcopy(data), run
+
+def bench_parse_event(data, local_tz):
+    def run(events):
+        rules, errors = parse_all(events)
+        return len(events), errors
+
+    return lambda: prepared_events(data, local_tz), run
+
+def bench_rrule_iteration(data, local_tz):
+    rules, errors = parse_all(prepared_events(data, local_tz))
+    counts = [len(item['tasks']) for item in data]
+
+    def run(rules):
+        items = 0
+        for rule, count in zip(rules, counts):
+            items += sum(1 for date in itertools.islice(rule, count))
+        return items, errors
+
+    # The rules cache their dates. Parse them again for every run.
+    return lambda: parse_all(prepared_events(data, local_tz))[0], run
+
+def occurrences(data, local_tz):
+    rules, errors = parse_all(prepared_events(data, local_tz))
+    counts = [len(item['tasks']) for item in data]
+    return [date for rule, count in zip(rules, counts) for date in itertools.islice(rule, count)]
+
+def bench_restrict_to_working_calendar(data, local_tz):
+    dates = occurrences(data, local_tz)
+
+    def run(dates):
+        for date in dates:
+            restrict_to_working_calendar(date)
+        return len(dates), 0
+
+    return lambda: dates, run
+
+def bench_restrict_to_working_calendar_array(data, local_tz):
+    dates = occurrences(data, local_tz)
+
+    def run(dates):
+        restrict_to_working_calendar_array(dates)
+        return len(dates), 0
+
+    return lambda: dates, run
+
+def bench_check_pm(data, local_tz):
+    def run(data):
+        errors = 0
+        for item in data:
+            try:
+                check_pm(item['pm']['TRIIDTX'], item['pm']['TRINAMETX'], None, local_tz.zone,
+                         grouped=is_grouped(item['pm']), verbosity=0,
+                         events=[item['event']], tasks=item['tasks'])
+            except Exception:
+                errors += 1
+        return len(data), errors
+
+    return lambda: prepared_data(data, local_tz), run
+
+def bench_validate_pm(data, local_tz, directory):
+    def run(data):
+        report = ExcelReport(os.path.join(directory, "validate_pm.xlsx"), [item['pm'] for item in data], "http://localhost")
+        errors = 0
+        for item in data:
+            try:
+                validate_pm(item['pm']['TRIIDTX'], item['pm']['TRINAMETX'], report.workbook, None, local_tz.zone,
+                            grouped=is_grouped(item['pm']), verbosity=0,
+                            events=[item['event']], tasks=item['tasks'])
+            except Exception:
+                errors += 1
+        report.close()
+        return len(data), errors
+
+    return lambda: prepared_data(data, local_tz), run
+
+def bench_report(data, local_tz, directory, report_format):
+    pms = [item['pm'] for item in data]
+    results = []
+    for item in prepared_data(data, local_tz):
+        try:
+            results.append(check_pm(item['pm']['TRIIDTX'], item['pm']['TRINAMETX'], None, local_tz.zone,
+                                    grouped=is_grouped(item['pm']), verbosity=0,
+                                    events=[item['event']], tasks=item['tasks']))
+        except Exception:
+            results.append(None)
+
+    def run(results):
+        outputfile = os.path.join(directory, "report." + report_format)
+        if report_format == 'xlsx':
+            report = ExcelReport(outputfile, pms, "http://localhost")
+        else:
+            report = REPORTS[report_format](outputfile)
+
+        for pm, result in zip(pms, results):
+            report.add_pm(pm, is_grouped(pm), result)
+        report.close()
+        return len(results), results.count(None)
+
+    return lambda: results, run
+
+def prepared_data(data, local_tz):
+    data = copy.deepcopy(data)
+    for item in data:
+        prepare_event(item['event'], item['includes'], item['excludes'], local_tz)
+    return data
+
+def get_benchmarks(directory):
+    """
+    The benchmarks by name. Each takes the generated data and the timezone
+    and returns a function that makes the input of a run, and the run. A run
+    returns the number of items it processed and how many of them failed.
+    """
+    return {
+        'localize_date': bench_localize_date,
+        'prepare_event': bench_prepare_event,
+        'parse_event': bench_parse_event,
+        'rrule_iteration': bench_rrule_iteration,
+        'restrict_to_working_calendar': bench_restrict_to_working_calendar,
+        'restrict_to_working_calendar_array': bench_restrict_to_working_calendar_array,
+        'check_pm': bench_check_pm,
+        'validate_pm': lambda data, local_tz: bench_validate_pm(data, local_tz, directory),
+        'report_xlsx': lambda data, local_tz: bench_report(data, local_tz, directory, 'xlsx'),
+        'report_csv': lambda data, local_tz: bench_report(data, local_tz, directory, 'csv'),
+    }
+
+def time_benchmark(setup, run, repeat):
+    """
+    Returns the fastest of ``repeat`` runs, and the items and errors of the
+    last one.
+    """
+    best = None
+    for _ in range(repeat):
+        inputs = setup()
+        start = time.perf_counter()
+        items, errors = run(inputs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, items, errors
+
+def print_comparison(results, baseline_file):
+    """
+    Print the time of each benchmark compared with a saved run.
+    """
+    with open(baseline_file, encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    before = dict(((r['benchmark'], r['scale']), r['seconds']) for r in baseline['results'])
+
+    print("{:<36} {:>7} {:>12} {:>12} {:>8}".format("Benchmark", "Scale", "Before (s)", "After (s)", "Change"))
+    for r in results:
+        old = before.get((r['benchmark'], r['scale']))
+        if old is None:
+            continue
+        print("{:<36} {:>7} {:>12.4f} {:>12.4f} {:>+8.0%}".format(
+            r['benchmark'], r['scale'], old, r['seconds'], r['seconds'] / old - 1 if old else 0))
+
+@arg('-s', '--scales', nargs='+', type=int, help="Numbers of PM Schedules to run each benchmark with.", default=[10, 100, 1000])
+@arg('-t', '--tasks', type=int, help="Number of tasks of each PM Schedule.", default=50)
+@arg('-b', '--benchmark', nargs='+', help="Only run these benchmarks.", default=None)
+@arg('-r', '--repeat', type=int, help="Run each benchmark this many times and keep the fastest.", default=3)
+@arg('-z', '--timezone', help="The local timezone", default="US/Eastern")
+@arg('-o', '--outputfile', help="Save the results to this JSON file.", default=None)
+@arg('-c', '--compare', help="Compare the results with a JSON file from an earlier run.", default=None)
+@arg('--seed', type=int, help="Seed of the random data.", default=0)
+def run(scales=None, tasks=None, benchmark=None, repeat=None, timezone=None, outputfile=None, compare=None, seed=None):
+    """
+    Run the benchmarks.
+    """
+    local_tz = pytz.timezone(timezone)
+    directory = tempfile.mkdtemp(prefix="axiom-bench")
+    benchmarks = get_benchmarks(directory)
+
+    names = benchmark or list(benchmarks)
+    unknown = set(names) - set(benchmarks)
+    if unknown:
+        raise argh.CommandError("Unknown benchmarks: {}. Choose from: {}".format(
+            ", ".join(sorted(unknown)), ", ".join(benchmarks)))
+
+    results = []
+    try:
+        for scale in scales:
+            data = generate(scale, tasks, timezone, seed)
+            for name in names:
+                setup, bench = benchmarks[name](data, local_tz)
+                seconds, items, errors = time_benchmark(setup, bench, repeat)
+                results.append({
+                    'benchmark': name,
+                    'scale': scale,
+                    'items': items,
+                    'errors': errors,
+                    'seconds': seconds,
+                    'us_per_item': seconds / items * 1000000 if items else None,
+                })
+                print("{:<36} {:>7} {:>10.4f}s {:>8} items {:>5} errors".format(name, scale, seconds, items, errors),
+                      file=sys.stderr)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    output = {
+        'axiom_version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.now().isoformat(),
+        'tasks_per_pm': tasks,
+        'timezone': timezone,
+        'repeat': repeat,
+        'seed': seed,
+        'results': results,
+    }
+
+    if outputfile:
+        with open(outputfile, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+
+    if compare:
+        print_comparison(results, compare)
+
+if __name__ == '__main__':
+    argh.dispatch_command(run)
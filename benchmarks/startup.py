@@ -0,0 +1,200 @@
+"""
+Time how long ``axiom`` takes to start, each time in a new Python process,
+and save the results as JSON.
+
+Run from the root of the repository::
+
+    python -m benchmarks.startup -o startup.json
+    python -m benchmarks.startup --compare startup.json --max-slowdown 0.25
+
+The cases are:
+
+    help            axiom --help
+    help_forecast   axiom forecast --help
+    complete        a shell completion request for ``axiom --ti``
+    noop            validating one synthetic PM Schedule from a snapshot
+
+``help`` and ``complete`` must not import cx_Oracle, NumPy, dateutil, pytz,
+xlsxwriter or tqdm. Each case is also run once with ``-X importtime`` to find
+the heavy modules it imports, and the run fails if these two import any. With
+``--max-slowdown`` it also fails if a case is that much slower than in the
+``--compare`` file.
+"""
+
+import argh
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from argh import arg
+from datetime import datetime
+
+from axiom.axiom import __version__
+from axiom.snapshot import create_snapshot, write_rows
+
+from .generator import generate
+
+# Modules that only the commands need
+HEAVY_MODULES = ('cx_Oracle', 'numpy', 'dateutil', 'pytz', 'xlsxwriter', 'tqdm')
+
+# Cases that must not import HEAVY_MODULES
+LIGHT_CASES = ('help', 'help_forecast', 'complete')
+
+def completion_env(line, output):
+    """
+    The environment of a completion request from bash for ``line``. The
+    completions are written to ``output``.
+    """
+    env = dict(os.environ)
+    env.update({
+        '_ARGCOMPLETE': '1',
+        'COMP_LINE': line,
+        'COMP_POINT': str(len(line)),
+        '_ARGCOMPLETE_STDOUT_FILENAME': output,
+    })
+    return env
+
+def write_noop_snapshot(filename):
+    """
+    A snapshot with one synthetic PM Schedule.
+    """
+    item, = generate(1, tasks_per_pm=10)
+    db = create_snapshot(filename)
+    write_rows(db, 'pmscheds', 'TRIIDTX', [item['pm']])
+    write_rows(db, 'events', 'PM_ID', [item['event']])
+    write_rows(db, 'tasks', 'PM_ID', [dict(task, PM_ID=item['pm']['TRIIDTX']) for task in item['tasks']])
+    db.commit()
+    db.close()
+
+def get_cases(directory):
+    """
+    The cases by name: the arguments of ``python -m axiom`` and the
+    environment.
+    """
+    snapshot = os.path.join(directory, "noop.snapshot")
+    write_noop_snapshot(snapshot)
+
+    return {
+        'help': (['--help'], None),
+        'help_forecast': (['forecast', '--help'], None),
+        'complete': ([], completion_env("axiom --ti", os.path.join(directory, "complete.txt"))),
+        'noop': (['--from-snapshot', snapshot, '-r', 'csv', '-f', os.path.join(directory, "noop.csv")], None),
+    }
+
+def run_case(args, env, options=()):
+    """
+    Run ``python -m axiom`` once. Returns the seconds it took and stderr.
+    """
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable] + list(options) + ['-m', 'axiom'] + args, env=env,
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    elapsed = time.perf_counter() - start
+
+    if process.returncode != 0:
+        raise argh.CommandError("axiom {} failed:\n{}".format(" ".join(args), process.stderr))
+
+    return elapsed, process.stderr
+
+def heavy_imports(args, env):
+    """
+    The ``HEAVY_MODULES`` that a case imports.
+    """
+    elapsed, stderr = run_case(args, env, ['-X', 'importtime'])
+    imported = set()
+    for line in stderr.splitlines():
+        if line.startswith("import time:"):
+            name = line.rsplit("|", 1)[-1].strip().split(".")[0]
+            if name in HEAVY_MODULES:
+                imported.add(name)
+    return sorted(imported)
+
+def print_comparison(results, baseline_file, max_slowdown=None):
+    """
+    Print the time of each case compared with a saved run. Returns the cases
+    that are more than ``max_slowdown`` slower.
+    """
+    with open(baseline_file, encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    before = dict((r['case'], r['seconds']) for r in baseline['results'])
+
+    slower = []
+    print("{:<16} {:>12} {:>12} {:>8}".format("Case", "Before (ms)", "After (ms)", "Change"))
+    for r in results:
+        old = before.get(r['case'])
+        if old is None:
+            continue
+        change = r['seconds'] / old - 1 if old else 0
+        print("{:<16} {:>12.1f} {:>12.1f} {:>+8.0%}".format(r['case'], old * 1000, r['seconds'] * 1000, change))
+        if max_slowdown is not None and change > max_slowdown:
+            slower.append(r['case'])
+
+    return slower
+
+@arg('-c', '--case', nargs='+', help="Only run these cases.", default=None)
+@arg('-r', '--repeat', type=int, help="Run each case this many times and keep the fastest.", default=10)
+@arg('-o', '--outputfile', help="Save the results to this JSON file.", default=None)
+@arg('--compare', help="Compare the results with a JSON file from an earlier run.", default=None)
+@arg('--max-slowdown', type=float, help="With --compare, fail if a case is slower by more than this fraction, e.g. 0.25.", default=None)
+def run(case=None, repeat=None, outputfile=None, compare=None, max_slowdown=None):
+    """
+    Run the startup benchmarks.
+    """
+    directory = tempfile.mkdtemp(prefix="axiom-startup")
+
+    failures = []
+    results = []
+    try:
+        cases = get_cases(directory)
+
+        names = case or list(cases)
+        unknown = set(names) - set(cases)
+        if unknown:
+            raise argh.CommandError("Unknown cases: {}. Choose from: {}".format(
+                ", ".join(sorted(unknown)), ", ".join(cases)))
+
+        for name in names:
+            args, env = cases[name]
+            seconds = min(run_case(args, env)[0] for _ in range(repeat))
+            imported = heavy_imports(args, env)
+            results.append({
+                'case': name,
+                'seconds': seconds,
+                'heavy_imports': imported,
+            })
+            print("{:<16} {:>8.1f}ms  {}".format(name, seconds * 1000, ", ".join(imported) or "-"),
+                  file=sys.stderr)
+
+            if name in LIGHT_CASES and imported:
+                failures.append("{} imports {}".format(name, ", ".join(imported)))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    output = {
+        'axiom_version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.now().isoformat(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+    if outputfile:
+        with open(outputfile, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+
+    if compare:
+        failures += ["{} is more than {:.0%} slower".format(name, max_slowdown)
+                     for name in print_comparison(results, compare, max_slowdown)]
+
+    if failures:
+        sys.exit("Startup regressions: " + "; ".join(failures))
+
+if __name__ == '__main__':
+    argh.dispatch_command(run)